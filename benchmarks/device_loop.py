@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+# make main.py importable, and device drivers findable (DeviceConfig loads them from drivers/)
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.chdir(REPO_DIR)
+from main import Device, DeviceConfig
+
+# Measure the overhead of the Device control loops, without the GUI: the CPU time used by
+# idle devices (long dt, no commands), and the latency from queueing a command (as
+# ControlGUI.queue_command() does) to its event being recorded. Devices are built from
+# drivers/test_slowdata.py. Run it on two commits to compare them.
+# Usage: python benchmarks/device_loop.py --devices 12 --dt 5 --idle 10 --commands 200
+
+def make_device(i, args, time_offset):
+    config = DeviceConfig("device_configs/test/test_slowdata.ini")
+    config["name"] = "test_slowdata_{0}".format(i)
+    config["control_params"]["enabled"]["value"] = 2
+    config["control_params"]["dt"]["value"] = str(args.dt)
+    dev = Device(config)
+    dev.setup_connection(time_offset)
+    return dev
+
+def queue_command(dev, cmd):
+    dev.commands.append(cmd)
+    # (older versions of Device have no wake() and poll the command list instead)
+    if hasattr(dev, "wake"):
+        dev.wake()
+
+def command_latency(dev, cmd):
+    # time from queueing a command until its return value is in the events queue
+    n_events = len(dev.events_queue)
+    t0 = time.perf_counter()
+    queue_command(dev, cmd)
+    while len(dev.events_queue) == n_events:
+        time.sleep(0.0002)
+    return time.perf_counter() - t0
+
+def percentiles(values):
+    values = np.asarray(values)
+    return {
+            "p50" : float(np.percentile(values, 50)),
+            "p90" : float(np.percentile(values, 90)),
+            "p99" : float(np.percentile(values, 99)),
+            "max" : float(np.max(values)),
+        }
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                    stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    time_offset = time.time()
+    devices = [make_device(i, args, time_offset) for i in range(args.devices)]
+    for dev in devices:
+        dev.start()
+
+    # idle CPU use: nothing queued, ReadValue() every dt
+    time.sleep(1)
+    cpu_start, time_start = time.process_time(), time.perf_counter()
+    time.sleep(args.idle)
+    idle_cpu = (time.process_time() - cpu_start) / (time.perf_counter() - time_start)
+
+    # command latency, spread over the devices, at random times relative to their loops
+    rng = np.random.default_rng(0)
+    latencies = []
+    for k in range(args.commands):
+        time.sleep(rng.uniform(0, 0.05))
+        latencies.append(command_latency(devices[k % len(devices)], args.command))
+
+    for dev in devices:
+        dev.active.clear()
+        if hasattr(dev, "wake"):
+            dev.wake()
+    time_stop = time.perf_counter()
+    for dev in devices:
+        dev.join()
+
+    return {
+            "commit"                : git_commit(),
+            "params"                : vars(args),
+            "idle_cpu_percent"      : 100 * idle_cpu,
+            "command_latency_s"     : percentiles(latencies),
+            "stop_time_s"           : time.perf_counter() - time_stop,
+        }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the Device control loops with test devices.")
+    parser.add_argument("--devices", type=int, default=12, help="number of devices")
+    parser.add_argument("--dt", type=float, default=5, help="loop cycle (time between ReadValue() calls) of the devices [s]")
+    parser.add_argument("--idle", type=float, default=10, help="seconds to measure idle CPU use for")
+    parser.add_argument("--commands", type=int, default=200, help="number of commands to measure the latency of")
+    parser.add_argument("--command", default="GetWarnings()", help="the command to send")
+    parser.add_argument("--output", default=None, help="JSON file for the results (default: print)")
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=4)
+    else:
+        print(json.dumps(result, indent=4))
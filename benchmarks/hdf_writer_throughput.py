@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+import h5py
+import numpy as np
+
+# make main.py importable, and device drivers findable (DeviceConfig loads them from drivers/)
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.chdir(REPO_DIR)
+from main import Device, DeviceConfig, HDF_writer
+
+# Measure how many records/s HDF_writer sustains, without the GUI. Synthetic devices built
+# from drivers/test_fastdata.py and drivers/test_slowdata.py push data into their Device
+# queues at the given rate, and HDF_writer.write_queues_to_HDF_InfluxDB() writes them every
+# --loop-delay seconds. The result is printed (or saved) as JSON, to compare versions.
+# Usage: python benchmarks/hdf_writer_throughput.py --fast 2 --slow 10 --rate 100 --duration 10
+
+class Label:
+    # stands in for the HDF status label of the GUI
+    def setText(self, text):
+        pass
+
+    def text(self):
+        return ""
+
+class ControlGUI:
+    def __init__(self):
+        self.HDF_status = Label()
+
+class BenchmarkParent:
+    # the parts of CentrexGUI that HDF_writer uses
+    def __init__(self, hdf_fname, args):
+        self.config = {
+                "general"        : {
+                        "run_name"       : "benchmark",
+                        "hdf_loop_delay" : str(args.loop_delay),
+                        "hdf_swmr"       : str(args.swmr),
+                    },
+                "files"          : {"hdf_fname": hdf_fname},
+                "influxdb"       : {"enabled": "False"},
+                "run_attributes" : {},
+                "time_offset"    : time.time(),
+            }
+        self.devices = {}
+        self.hdf_file = None
+        self.hdf_file_lock = threading.RLock()
+        self.ControlGUI = ControlGUI()
+
+def make_device(parent, driver, i, args):
+    config = DeviceConfig("device_configs/test/{0}.ini".format(driver))
+    config["name"] = "{0}_{1}".format(driver, i)
+    config["hdf_group"] = config["name"]
+    config["hdf_layout"] = args.layout
+    config["control_params"]["enabled"]["value"] = 2
+    config["control_params"]["HDF_enabled"]["value"] = 1
+    config["control_params"]["InfluxDB_enabled"]["value"] = "False"
+
+    # the driver is opened as for a run (setup_connection(), then open_connection() in the
+    # control loop), and closed by run() when done
+    dev = Device(config)
+    dev.setup_connection(parent.config["time_offset"])
+    device = dev.open_connection()
+
+    # the driver sets the shape and dtype of the data
+    if driver == "test_fastdata":
+        device.shape = tuple(args.fast_shape)
+        device.dtype = args.fast_dtype
+        # one column name per channel
+        n_ch = args.fast_shape[1]
+        config["attributes"] = dict(config["attributes"])
+        config["attributes"]["column_names"] = ", ".join("ch{0}".format(j) for j in range(n_ch))
+        config["attributes"]["units"] = ", ".join(["V"] * n_ch)
+    else:
+        device.dtype = args.slow_dtype
+    config["shape"] = device.shape
+    config["dtype"] = device.dtype
+
+    dev.col_names_list = [x.strip() for x in config["attributes"]["column_names"].split(",")]
+    dev.records = 0
+    dev.nbytes = 0
+    parent.devices[config["name"]] = dev
+    return dev
+
+def produce(dev, rate, duration):
+    # call ReadValue() at a fixed rate (or as fast as possible if rate is 0) and queue the data
+    time_start = time.time()
+    k = 0
+    device = dev.open_connection()
+    while time.time() - time_start < duration:
+        data = device.ReadValue()
+        dev.queue_data(data)
+        dev.records += 1 if dev.config["slow_data"] else len(data[0])
+        dev.nbytes += dev.data_nbytes(data)
+        k += 1
+        if rate:
+            time.sleep(max(0, time_start + k/rate - time.time()))
+
+def percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values)
+    return {
+            "p50" : float(np.percentile(values, 50)),
+            "p90" : float(np.percentile(values, 90)),
+            "p99" : float(np.percentile(values, 99)),
+            "max" : float(np.max(values)),
+        }
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                    stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args, hdf_fname):
+    parent = BenchmarkParent(hdf_fname, args)
+    try:
+        for i in range(args.fast):
+            make_device(parent, "test_fastdata", i, args)
+        for i in range(args.slow):
+            make_device(parent, "test_slowdata", i, args)
+        return benchmark(parent, list(parent.devices.values()), args, hdf_fname)
+    finally:
+        for dev in parent.devices.values():
+            dev.close_connection()
+
+def benchmark(parent, devices, args, hdf_fname):
+    if args.trace_memory:
+        tracemalloc.start()
+
+    writer = HDF_writer(parent)
+    for dev in devices:
+        dev.control_started = True
+        dev.active.set()
+
+    producers = [threading.Thread(target=produce, args=(dev, args.rate, args.duration)) for dev in devices]
+    time_start = time.time()
+    for p in producers:
+        p.start()
+
+    # the write loop of HDF_writer.run(), with a fixed delay and timing of each write
+    latencies, write_times = [], []
+    def write():
+        time_queued = [dev.queue_time for dev in devices if dev.queue_time]
+        t0 = time.perf_counter()
+        writer.write_queues_to_HDF_InfluxDB(writer.hdf_file)
+        writer.unflushed = True
+        writer.flush()
+        write_times.append(time.perf_counter() - t0)
+        latencies.extend(time.time() - t for t in time_queued)
+
+    while any(p.is_alive() for p in producers):
+        time.sleep(args.loop_delay)
+        write()
+    write()
+    duration = time.time() - time_start
+
+    writer.close()
+    peak_memory = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+    if args.trace_memory:
+        tracemalloc.stop()
+
+    records = sum(dev.records for dev in devices)
+    nbytes = sum(dev.nbytes for dev in devices)
+    return {
+            "commit"                    : git_commit(),
+            "h5py"                      : h5py.__version__,
+            "hdf5"                      : h5py.version.hdf5_version,
+            "numpy"                     : np.__version__,
+            "params"                    : vars(args),
+            "records"                   : records,
+            "MB"                        : nbytes/1024/1024,
+            "duration_s"                : duration,
+            "throughput_records_per_s"  : records/duration,
+            "throughput_MB_per_s"       : nbytes/1024/1024/duration,
+            "flush_latency_s"           : percentiles(latencies),
+            "write_time_s"              : percentiles(write_times),
+            "file_size_MB"              : os.path.getsize(hdf_fname)/1024/1024,
+            "peak_memory_MB"            : peak_memory/1024/1024 if peak_memory is not None else None,
+        }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark HDF_writer with synthetic test devices.")
+    parser.add_argument("--fast", type=int, default=1, help="number of fast-data devices")
+    parser.add_argument("--slow", type=int, default=4, help="number of slow-data devices")
+    parser.add_argument("--fast-shape", type=int, nargs=3, default=[1, 2, 100],
+            help="fast data shape: records, channels, samples per ReadValue()")
+    parser.add_argument("--fast-dtype", default="f", help="fast data dtype")
+    parser.add_argument("--slow-dtype", default="f", help="slow data dtype")
+    parser.add_argument("--rate", type=float, default=100, help="ReadValue() calls per second per device (0: as fast as possible)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of data production")
+    parser.add_argument("--loop-delay", type=float, default=0.5, help="seconds between writes")
+    parser.add_argument("--layout", default="records", choices=["records", "consolidated"], help="fast data HDF layout")
+    parser.add_argument("--swmr", action="store_true", help="write in SWMR mode")
+    parser.add_argument("--no-trace-memory", dest="trace_memory", action="store_false",
+            help="don't measure peak memory (tracemalloc slows down allocations)")
+    parser.add_argument("--hdf", default=None, help="HDF file to write (default: a temporary file)")
+    parser.add_argument("--output", default=None, help="JSON file for the results (default: print)")
+    args = parser.parse_args()
+
+    if args.hdf:
+        result = run(args, os.path.abspath(args.hdf))
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            result = run(args, os.path.join(tmp, "benchmark.hdf"))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=4)
+    else:
+        print(json.dumps(result, indent=4))
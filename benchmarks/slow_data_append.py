@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+import h5py
+import tempfile
+import numpy as np
+
+# make main.py importable when running this script from any directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import rows_to_struct_array
+
+# Compare the old row-by-row append of slow data in HDF_writer.write_queues_to_HDF_InfluxDB()
+# with the vectorized append (one resize and one write per device per flush).
+# Usage: python benchmarks/slow_data_append.py
+
+def make_rows(n):
+    # rows as returned by novatech409B.ReadValue(): time, channel, amplitude, frequency, phase
+    return [[i*0.1, 1, 50.0, 80.1, 0.0] for i in range(n)]
+
+def append_row_by_row(dset, data):
+    list_len = len(data)
+    dset.resize(dset.shape[0]+list_len, axis=0)
+    for idx, d in enumerate(data):
+        idx_start = -list_len + idx
+        idx_stop = -list_len + idx + 1
+        d = np.array([tuple(d)], dtype = dset.dtype)
+        if idx_stop == 0:
+            dset[idx_start:] = d
+        else:
+            dset[idx_start:idx_stop] = d
+
+def append_vectorized(dset, data):
+    rows = rows_to_struct_array(data, dset.dtype)
+    dset.resize(dset.shape[0]+len(rows), axis=0)
+    dset[-len(rows):] = rows
+
+def run(fname, append, n):
+    dtype = np.dtype([(name, typ) for name, typ in
+                zip(["time", "ch", "amp", "freq", "phase"], ('f','int','f','f','f'))])
+    data = make_rows(n)
+    with h5py.File(fname, "w") as f:
+        dset = f.create_dataset("novatech409B", (0,), maxshape=(None,), dtype=dtype)
+        t0 = time.perf_counter()
+        append(dset, data)
+        dt = time.perf_counter() - t0
+    return n/dt
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, "benchmark.hdf")
+        print("{:>8s} {:>16s} {:>16s} {:>8s}".format("rows", "before [rows/s]", "after [rows/s]", "speedup"))
+        for n in [1000, 10000, 100000]:
+            before = run(fname, append_row_by_row, n)
+            after = run(fname, append_vectorized, n)
+            print("{:>8d} {:>16.0f} {:>16.0f} {:>8.1f}".format(n, before, after, after/before))
@@ -3,7 +3,9 @@ import time
 import logging
 import traceback
 import nidaqmx
+from nidaqmx.stream_readers import AnalogSingleChannelReader
 import matplotlib.pyplot as plt
+from drivers.buffer_pool import BufferPool, time_axis
 
 
 class PCIe6351_ai:
@@ -20,6 +22,9 @@ class PCIe6351_ai:
         self.dtype = 'f'
         self.shape = (1, 2, self.samp_num)
 
+        # arrays for ReadValue() returns, reused once written to HDF (see buffer_pool.py)
+        self.pool = BufferPool(self.shape, np.float64)
+
         # HDF attributes generated when constructor is run
         self.new_attributes = []
 
@@ -73,6 +78,7 @@ class PCIe6351_ai:
                 trigger_edge = nidaqmx.constants.Edge.RISING
             )
         self.task.triggers.start_trigger.retriggerable = True
+        self.reader = AnalogSingleChannelReader(self.task.in_stream)
         # If retriggerbale = False, for CONTINUOUS or FINITE reading mode,
         # only the first read can be triggered by the specified trigger source,
         # and following readings start when task.read() is called,
@@ -86,17 +92,17 @@ class PCIe6351_ai:
         self.task.start()
 
     def ReadValue(self):
+        data = self.pool.borrow()
+        data[0, 0] = time_axis(self.samp_num, self.samp_rate) # in ms
         try:
-            reading = self.task.read(number_of_samples_per_channel=self.samp_num, timeout=10.0) # what will happen if time out?
+            # read straight into the buffer
+            self.reader.read_many_sample(data[0, 1], number_of_samples_per_channel=self.samp_num, timeout=10.0) # what will happen if time out?
 
         except Exception as err:
             logging.error("PCIe6351 reading error!")
             # logging.error(traceback.format_exc())
-            reading = [np.NaN]*self.samp_num
+            data[0, 1] = np.nan
 
-        time = np.arange(self.samp_num) * (1/self.samp_rate*1000) # in ms
-        data = np.append(time, np.array(reading))
-        data = np.array(data).reshape(self.shape)
         attr = {"source": "Teensy with DDS", "trigger": "function generator"}
 
         return [data, [attr]]
@@ -150,6 +156,7 @@ class PCIe6351_ai:
         try:
             self.daq_init()
             self.shape = (1, 2, self.samp_num)
+            self.pool = BufferPool(self.shape, np.float64)
 
         except Exception as err:
             print(err)
@@ -4,6 +4,7 @@ import logging
 import traceback
 import nidaqmx
 import matplotlib.pyplot as plt
+from drivers.buffer_pool import BufferPool, time_axis
 
 
 class PCIe6351_ao_led:
@@ -97,8 +98,9 @@ class PCIe6351_ao_led:
             writing_sample = [np.NaN]*self.samp_num
             self.task.close()
 
-        data = np.append(self.timestamp, writing_sample)
-        data = np.array(data).reshape(self.shape)
+        data = self.pool.borrow()
+        data[0, 0] = self.timestamp
+        data[0, 1] = writing_sample
         attr = {"source": "Teensy with DDS", "trigger": "function generator"}
 
         return [data, [attr]]
@@ -126,9 +128,13 @@ class PCIe6351_ao_led:
         self.writing = np.append(self.writing, np.ones(round(self.t_control[1]/1000*self.samp_rate))*self.y_control[0])
         self.writing = np.append(self.writing, np.zeros(1))
         self.samp_num = len(self.writing)
-        self.timestamp = np.arange(self.samp_num)*(1/self.samp_rate)*1000 # in ms
+        self.timestamp = time_axis(self.samp_num, self.samp_rate) # in ms
         self.shape = (1, 2, self.samp_num)
 
+        # arrays for ReadValue() returns, reused once written to HDF (see buffer_pool.py)
+        if not hasattr(self, "pool") or self.pool.shape != self.shape:
+            self.pool = BufferPool(self.shape, np.float64)
+
     def update_t(self, i, arg):
         self.t_control[int(i)] = float(arg)
         self.update_waveform()
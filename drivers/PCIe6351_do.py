@@ -4,6 +4,7 @@ import logging
 import traceback
 import nidaqmx
 import matplotlib.pyplot as plt
+from drivers.buffer_pool import BufferPool, time_axis
 
 
 class PCIe6351_do:
@@ -95,8 +96,9 @@ class PCIe6351_do:
             writing_sample = [np.NaN]*self.samp_num
             self.task.close()
 
-        data = np.append(self.timestamp, writing_sample)
-        data = np.array(data).reshape(self.shape)
+        data = self.pool.borrow()
+        data[0, 0] = self.timestamp
+        data[0, 1] = writing_sample
         attr = {"source": "Teensy with DDS", "trigger": "function generator"}
 
         return [data, [attr]]
@@ -121,9 +123,13 @@ class PCIe6351_do:
         self.writing = np.append(self.writing, np.array([0]))
         self.writing = [int(elem) for elem in self.writing]
         self.samp_num = len(self.writing)
-        self.timestamp = np.arange(self.samp_num)*(1/self.samp_rate)*1000 # in ms
+        self.timestamp = time_axis(self.samp_num, self.samp_rate) # in ms
         self.shape = (1, 2, self.samp_num)
 
+        # arrays for ReadValue() returns, reused once written to HDF (see buffer_pool.py)
+        if not hasattr(self, "pool") or self.pool.shape != self.shape:
+            self.pool = BufferPool(self.shape, np.float64)
+
     def update_control(self, i, j, arg):
         if int(i) == 0:
             self.ctrl_param[int(i)][int(j)] = float(arg)
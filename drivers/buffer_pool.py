@@ -0,0 +1,60 @@
+import weakref
+import functools
+import threading
+import numpy as np
+
+# Reusable arrays for the data returned by fast-data drivers, e.g.
+#
+#     self.pool = BufferPool(self.shape, np.float64)
+#     ...
+#     data = self.pool.borrow()
+#     data[0, 0] = time_axis(self.samp_num, self.samp_rate)
+#     data[0, 1] = reading
+#     return [data, [attr]]
+#
+# A buffer goes back to the pool when it's released, which main.py does once the HDF writer
+# has written it and it's no longer among the latest records kept for the plots (see
+# DataQueue and Device.release_data() in main.py), so at a steady rate no new arrays are
+# allocated. A buffer that is never released (e.g. a record dropped before it was written)
+# is simply garbage collected, and a new one is allocated in its place.
+
+class BufferPool:
+    def __init__(self, shape, dtype):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.free = []
+
+        # the buffers lent out and not released yet (only weakly referenced, so that buffers
+        # which are never released don't stay around), and the number of buffers allocated
+        self.borrowed = weakref.WeakValueDictionary()
+        self.allocated = 0
+
+        # buffers are borrowed by the driver, and released from other threads
+        self.lock = threading.Lock()
+
+    def borrow(self):
+        # an array of the shape and dtype of the pool; its contents are undefined
+        with self.lock:
+            if self.free:
+                buf = self.free.pop()
+            else:
+                buf = np.empty(self.shape, dtype=self.dtype)
+                self.allocated += 1
+            self.borrowed[id(buf)] = buf
+        return buf
+
+    def release(self, buf):
+        # give a borrowed buffer back, once nothing uses it anymore; arrays not lent out by
+        # this pool (e.g. by the pool used before the shape changed) are ignored
+        with self.lock:
+            if self.borrowed.get(id(buf)) is buf:
+                del self.borrowed[id(buf)]
+                self.free.append(buf)
+
+@functools.lru_cache(maxsize=32)
+def time_axis(samp_num, samp_rate):
+    # sample times (in ms) of a record of samp_num samples at samp_rate S/s; the array is
+    # shared by all callers, so it's read-only
+    t = np.arange(samp_num) * (1/samp_rate*1000)
+    t.setflags(write=False)
+    return t
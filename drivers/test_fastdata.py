@@ -35,10 +35,11 @@ class test_fastdata:
     def ReadValue(self):
         # a (the 1st returned element) has to be a 3-dim np array, corresponding to self.shape
         # b (the 2nd return element) has to be a 1-dim list of dict, each dict will be the attrbute of a dset in .hdf file
-        a = np.linspace(0,199,200) + (np.random.random_sample(200)*10-5)
+        n = int(np.prod(self.shape))
+        a = np.linspace(0,n-1,n) + (np.random.random_sample(n)*10-5)
         b = {"info": "test", "info2": "test2"}
         return [
-                a.reshape(self.shape), [b]
+                a.reshape(self.shape).astype(self.dtype), [b] * self.shape[0]
                ]
 
     def GetWarnings(self):
@@ -1,18 +1,26 @@
 ﻿import re
+import ast
 import h5py
 import time
 import json
 import PyQt5
 import pickle
 import pyvisa
+import contextlib
+import functools
 import logging
 import itertools
 import traceback
 import threading
+import asyncio
+import concurrent.futures
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
 import configparser
 from datetime import datetime
-import wmi, pythoncom
+import shutil
 import pyqtgraph as pg
 import PyQt5.QtGui as QtGui
 import PyQt5.QtWidgets as qt
@@ -24,6 +32,9 @@ from influxdb_client.client.write_api import SYNCHRONOUS
 import nidaqmx
 import socket
 import struct
+import sqlite3
+import pathlib
+import zlib
 
 ##########################################################################
 ##########################################################################
@@ -132,6 +143,931 @@ def update_QComboBox(cbx, options, value=None):
 def split(string, separator=","):
     return [x.strip() for x in string.split(separator)]
 
+@functools.lru_cache(maxsize=4096)
+def compile_command(cmd):
+    # Parse a device command, e.g. "scan('ch0_freq(MHz)', 80.1)", only once: returns the name
+    # of the driver method and its (literal) arguments. Commands that are not a single method
+    # call with literal arguments are compiled to a code object instead, which is evaluated
+    # with the driver instance as "device" (see Device.run_command()).
+    cmd = cmd.strip()
+    try:
+        node = ast.parse(cmd, mode="eval").body
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            args = tuple(ast.literal_eval(arg) for arg in node.args)
+            kwargs = tuple((kw.arg, ast.literal_eval(kw.value)) for kw in node.keywords if kw.arg)
+            if len(kwargs) == len(node.keywords):
+                return node.func.id, args, kwargs, None
+    except (SyntaxError, ValueError, TypeError):
+        logging.info(traceback.format_exc())
+    return None, None, None, compile("device." + cmd, "<command>", "eval")
+
+def rows_to_struct_array(rows, dtype):
+    # convert a list of rows (e.g. slow data ReadValue() returns) into one structured array
+    try:
+        return np.array([tuple(row) for row in rows], dtype=dtype)
+    except (ValueError, TypeError):
+        logging.info(traceback.format_exc())
+
+    # fall back to converting row by row, dropping rows that don't fit the dtype
+    good_rows = []
+    for row in rows:
+        try:
+            good_rows.append(np.array(tuple(row), dtype=dtype))
+        except (ValueError, TypeError) as err:
+            logging.error("Error in rows_to_struct_array(): cannot convert " + str(row) + ": " + str(err))
+            logging.error(traceback.format_exc())
+    return np.array(good_rows, dtype=dtype)
+
+def influxdb_points(dev_name, run_name, time_offset, col_names, data):
+    # convert slow data rows (time first) into InfluxDB points, one per non-NaN value
+    meas = "Dev: " + dev_name
+    tag_name = "run_name"
+    tag_val = run_name
+    record = []
+
+    for i in range(len(data)):
+        if len(data[i]) < 2:
+            continue
+        data_time = round((data[i][0] + time_offset)*1e9)
+        if np.isnan(data_time):
+            continue
+        for j in range(len(data[i])-1):
+            field_name = col_names[j+1]
+            field_val = data[i][j+1]
+            if not np.isnan(field_val):
+                data_point = Point(meas).tag(tag_name, tag_val).field(field_name, field_val).time(data_time)
+                # print(data_point.to_line_protocol())
+                record.append(data_point)
+
+    return record
+
+# Events are stored as records: the time is a float, the command is an index into a table
+# of strings (<dev_name>_events_strings), so that each distinct command is only written
+# once, and the return value (mostly unique) is stored as a string.
+EVENTS_DTYPE = np.dtype([("time", "f8"), ("command", "i4"), ("return_value", h5py.special_dtype(vlen=str))])
+
+def create_events_datasets(grp, dev_name):
+    grp.create_dataset(dev_name + "_events", (0,), maxshape=(None,),
+            dtype=EVENTS_DTYPE, chunks=(256,))
+    grp.create_dataset(dev_name + "_events_strings", (0,), maxshape=(None,),
+            dtype=h5py.special_dtype(vlen=str), chunks=(256,))
+
+def write_events(grp, dev_name, events, strings):
+    # append a batch of [time, command, return value] events; strings is the writer's
+    # dict mapping strings already in <dev_name>_events_strings to their indices
+    strings_dset = grp[dev_name + "_events_strings"]
+    if not strings and strings_dset.shape[0] > 0:
+        strings.update((s, i) for i, s in enumerate(strings_dset.asstr()[:]))
+
+    n_strings = len(strings)
+    new_strings = []
+    rows = np.empty(len(events), dtype=EVENTS_DTYPE)
+    for i, (t, c, ret_val) in enumerate(events):
+        c = str(c)
+        if c not in strings:
+            strings[c] = len(strings)
+            new_strings.append(c)
+        rows[i] = (t, strings[c], str(ret_val))
+
+    # write the new strings, then the events
+    if new_strings:
+        strings_dset.resize(len(strings), axis=0)
+        strings_dset[n_strings:] = new_strings
+    events_dset = grp[dev_name + "_events"]
+    events_dset.resize(events_dset.shape[0]+len(rows), axis=0)
+    events_dset[-len(rows):] = rows
+
+def format_event(event):
+    t, c, ret_val = event
+    return ", ".join(["{:.3f} [s]".format(t), str(c), str(ret_val)])
+
+def write_rows_to_HDF(grp, dev_name, dev, rows):
+    # write records of the dtype given by HDF_writer.record_dtype() to the datasets of a device;
+    # dev is a dict with the slow_data, hdf_layout and dset_dtype of the device
+
+    # slow data: the rows already have the dtype of the dataset
+    if dev["slow_data"]:
+        dset = grp[dev_name]
+        dset.resize(dset.shape[0]+len(rows), axis=0)
+        dset[-len(rows):] = rows
+        return
+
+    # fast data: records are padded to the size of the record dtype, n_samp is the number of
+    # samples of each (spool files written before n_samp was added hold full records)
+    if "n_samp" in rows.dtype.names:
+        n_samps = rows["n_samp"]
+    else:
+        n_samps = np.full(len(rows), rows["data"].shape[2])
+
+    # fast data, consolidated layout
+    if dev["hdf_layout"] == "consolidated":
+        dset = grp[dev_name]
+        index_dset = grp[dev_name + "_index"]
+        if n_samps.max() > dset.shape[2]:
+            dset.resize(int(n_samps.max()), axis=2)
+        batch = np.full((len(rows), dset.shape[1], dset.shape[2]), dset.fillvalue, dtype=dset.dtype)
+        for i, (row, n_samp) in enumerate(zip(rows, n_samps)):
+            batch[i, :, :n_samp] = row["data"][:, :n_samp]
+        n_old = dset.shape[0]
+        dset.resize(n_old + len(rows), axis=0)
+        dset[n_old:] = batch
+
+        index = np.zeros(len(rows), dtype=index_dset.dtype)
+        index["index"] = np.arange(n_old, n_old + len(rows))
+        index["time"] = rows["time"]
+        index["attrs"] = [attrs.decode() for attrs in rows["attrs"]]
+        index_dset.resize(n_old + len(rows), axis=0)
+        index_dset[n_old:] = index
+
+    # fast data, one dataset per record
+    else:
+        rec_num = next_record_number(grp, dev_name)
+        indices = list(range(rec_num, rec_num + len(rows)))
+        for i, row, n_samp in zip(indices, rows, n_samps):
+            rec_data = np.rec.fromarrays(row["data"][:, :n_samp], dtype=dev["dset_dtype"])
+            dset = grp.create_dataset(
+                    name        = dev_name + "_{:06d}".format(i),
+                    data        = rec_data,
+                    shape       = (len(rec_data),),
+                    compression = None
+                )
+        write_record_attrs(grp, dev_name, indices, [json.loads(row["attrs"].decode()) for row in rows])
+
+def next_record_number(grp, dev_name):
+    # records of fast devices in the records layout are numbered consecutively;
+    # the numbering starts at the number of objects in the group, as it always has, not
+    # counting the datasets that older versions didn't make (so the first record of a run
+    # is still <dev_name>_000001, after <dev_name>_events)
+    table = grp.get(dev_name + "_attrs")
+    if table is not None and table.shape[0] > 0:
+        return int(table[-1]["index"]) + 1
+    return len(grp) - sum(name in grp for name in [dev_name + "_events_strings", dev_name + "_attrs"])
+
+def write_record_attrs(grp, dev_name, indices, all_attrs):
+    # Record attributes (e.g. {"source": ..., "trigger": ...}) are stored as columns of the
+    # table <dev_name>_attrs, one row per record, keyed by the record number. The columns
+    # are those of the first record: numbers as floats, anything else as strings.
+    # Attributes that don't fit the table are written to the record's dataset, as before.
+    if not indices:
+        return
+
+    table = grp.get(dev_name + "_attrs")
+    if table is None:
+        fields = [("index", "i8")]
+        for key, val in all_attrs[0].items():
+            if isinstance(val, (int, float, np.number)):
+                fields.append((key, "f8"))
+            else:
+                fields.append((key, h5py.special_dtype(vlen=str)))
+        table = grp.create_dataset(dev_name + "_attrs", (0,), maxshape=(None,),
+                    dtype=np.dtype(fields), chunks=(256,))
+
+    rows = np.zeros(len(indices), dtype=table.dtype)
+    rows["index"] = indices
+    for name in table.dtype.names[1:]:
+        rows[name] = np.nan if table.dtype[name].kind == "f" else ""
+
+    for row, index, attrs in zip(rows, indices, all_attrs):
+        for key, val in attrs.items():
+            if key in table.dtype.names[1:]:
+                if table.dtype[key].kind != "f":
+                    row[key] = val if isinstance(val, str) else json.dumps(val, default=str)
+                    continue
+                elif isinstance(val, (int, float, np.number)):
+                    row[key] = val
+                    continue
+            grp[dev_name + "_{:06d}".format(index)].attrs[key] = val
+
+    table.resize(table.shape[0]+len(rows), axis=0)
+    table[-len(rows):] = rows
+
+def dedup_record_attrs(grp, dev_name):
+    # At the end of a run, record attributes that had the same value for every record are
+    # written once as group attributes, and their columns are removed from <dev_name>_attrs.
+    table = grp.get(dev_name + "_attrs")
+    if table is None or table.shape[0] == 0:
+        return
+    rows = table[()]
+
+    constant = {}
+    for name in rows.dtype.names[1:]:
+        val = rows[name][0]
+        if isinstance(val, bytes):
+            val = val.decode()
+        if not np.all(rows[name] == rows[name][0]):
+            continue
+        # don't overwrite different group attributes of the same name (e.g. from the device config)
+        if name in grp.attrs and not np.array_equal(grp.attrs[name], val):
+            continue
+        constant[name] = val
+    if not constant:
+        return
+
+    for name, val in constant.items():
+        grp.attrs[name] = val
+
+    keep = [name for name in rows.dtype.names if name not in constant]
+    new_rows = np.zeros(len(rows), dtype=np.dtype([(name, table.dtype[name]) for name in keep]))
+    for name in keep:
+        new_rows[name] = rows[name]
+    del grp[dev_name + "_attrs"]
+    grp.create_dataset(dev_name + "_attrs", data=new_rows, maxshape=(None,), chunks=(256,))
+
+@contextlib.contextmanager
+def open_HDF_reader(parent, fname):
+    # While control is running, HDF_writer keeps the HDF file open for the whole run.
+    # Readers of the same file share that handle instead of opening/closing the file,
+    # which is slow for large files. Other files are opened read-only as usual.
+    with parent.hdf_file_lock:
+        f = parent.hdf_file
+        if f and os.path.abspath(f.filename) == os.path.abspath(fname):
+            yield f
+            return
+
+    # if the file is being written by another process (see HDF_writer_process),
+    # it can only be read in SWMR mode
+    try:
+        f = h5py.File(fname, 'r')
+    except OSError:
+        logging.info(traceback.format_exc())
+        try:
+            f = h5py.File(fname, 'r', libver="latest", swmr=True)
+        except OSError as err:
+            # the writer process didn't start SWMR mode (see HDF_writer_process.start_swmr())
+            raise OSError("{0} is being written and can't be read until the run stops: {1}".format(fname, err))
+
+    with f:
+        yield f
+
+class LogHistogram:
+    # Counts of values (e.g. times in seconds) in logarithmic bins, 1-2-5 per decade from
+    # lowest to highest; bin i counts values in [edges[i], edges[i+1]), the last one all
+    # values above highest, and the first one all values below lowest.
+    def __init__(self, lowest=1e-6, highest=100):
+        decades = range(int(np.floor(np.log10(lowest))), int(np.ceil(np.log10(highest))))
+        self.edges = np.array([0] + [m*10.0**d for d in decades for m in (1, 2, 5)] + [10.0**decades[-1]*10])
+        self.counts = np.zeros(len(self.edges), dtype=np.int64)
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        value = max(value, 0)
+        self.counts[np.searchsorted(self.edges, value, side="right") - 1] += 1
+        self.total += 1
+        self.max = max(self.max, value)
+
+    def write_attrs(self, attrs, prefix):
+        attrs[prefix + "_edges"] = self.edges
+        attrs[prefix + "_counts"] = self.counts
+        attrs[prefix + "_max"] = self.max
+
+class HdrHistogram:
+    # Counts of durations in ns, in HDR-style buckets: one bucket per ns below 2**sub_bits ns,
+    # then 2**(sub_bits-1) equal buckets per power of 2 (so a bucket is within 1/2**(sub_bits-1)
+    # of its values), up to 2**max_bits ns. Recording a value is a few integer operations.
+    def __init__(self, sub_bits=5, max_bits=40):
+        self.sub_bits = sub_bits
+        self.counts = [0] * (((max_bits - sub_bits) << (sub_bits - 1)) + (1 << sub_bits))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns):
+        shift = ns.bit_length() - self.sub_bits
+        i = ns if shift <= 0 else (shift << (self.sub_bits - 1)) + (ns >> shift)
+        self.counts[min(i, len(self.counts) - 1)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def bucket_start(self, i):
+        # the lowest value counted in bucket i
+        if i < (1 << self.sub_bits):
+            return i
+        shift = (i >> (self.sub_bits - 1)) - 1
+        return (i - (shift << (self.sub_bits - 1))) << shift
+
+    def percentile(self, q):
+        # (the start of the bucket of) the q-th percentile
+        target = q / 100 * self.count
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if c and n >= target:
+                return self.bucket_start(i)
+        return 0
+
+    def write_attrs(self, attrs, prefix):
+        # only the buckets with counts
+        buckets = [i for i, c in enumerate(self.counts) if c]
+        attrs[prefix + "_bucket_ns"] = np.array([self.bucket_start(i) for i in buckets], dtype=np.int64)
+        attrs[prefix + "_counts"] = np.array([self.counts[i] for i in buckets], dtype=np.int64)
+        attrs[prefix + "_count"] = self.count
+        attrs[prefix + "_mean_s"] = self.total / self.count / 1e9 if self.count else 0
+        attrs[prefix + "_max_s"] = self.max / 1e9
+
+def format_ns(ns):
+    if ns >= 1e9:
+        return "{0:.2f} s".format(ns / 1e9)
+    elif ns >= 1e6:
+        return "{0:.1f} ms".format(ns / 1e6)
+    return "{0:.0f} us".format(ns / 1e3)
+
+class WarningChannel:
+    # The warnings of a device. Any thread put()s warnings on a deque (appending to and
+    # popping from a deque are atomic, so no lock is needed); Monitoring, the one reader,
+    # drain()s it, merging repeats of a warning (same key) into one entry that counts them:
+    #     {"key", "message", "count", "first_seen", "last_seen", "reported", "reported_count"}
+    # (times are time.time()). due() limits how often each warning is reported.
+    def __init__(self, max_entries=100):
+        self.queue = deque()
+        self.entries = {}
+        self.max_entries = max_entries
+
+    def put(self, message, key=None, time_seen=None):
+        # message is a string, or a dict with a "message"; key defaults to the message
+        if isinstance(message, dict):
+            message = message.get("message", str(message))
+        message = str(message)
+        self.queue.append((key or message, message, time_seen or time.time()))
+
+    def __len__(self):
+        return len(self.queue)
+
+    def drain(self):
+        # the entries of the warnings put since the last call
+        updated = {}
+        while self.queue:
+            key, message, time_seen = self.queue.popleft()
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = {"key": key, "message": message, "count": 0, "first_seen": time_seen,
+                        "last_seen": time_seen, "reported": 0, "reported_count": 0}
+            entry["message"] = message
+            entry["count"] += 1
+            entry["last_seen"] = max(entry["last_seen"], time_seen)
+            updated[key] = entry
+
+        # forget the warnings not seen for the longest time
+        if len(self.entries) > self.max_entries:
+            for entry in sorted(self.entries.values(), key=lambda e: e["last_seen"])[:len(self.entries)-self.max_entries]:
+                del self.entries[entry["key"]]
+
+        return list(updated.values())
+
+    def due(self, entry, interval):
+        # whether to report the entry now: the first time it's seen, then at most every interval
+        if entry["reported"] and time.time() - entry["reported"] < interval:
+            return False
+        entry["reported"] = time.time()
+        return True
+
+    def describe(self, entry):
+        # the message, and how often it's been seen since it was last reported
+        repeats = entry["count"] - entry["reported_count"]
+        entry["reported_count"] = entry["count"]
+        if entry["count"] == 1:
+            return entry["message"]
+        return "{0} ({1} times, {2} since last reported; first seen {3})".format(entry["message"], entry["count"],
+                repeats, time.strftime("%H:%M:%S", time.localtime(entry["first_seen"])))
+
+class DataQueue:
+    # Bounded ring buffer of the ReadValue() returns of a device, with size preallocated slots.
+    # HDF_writer takes each record once, through its own cursor (get()); the plots and
+    # Monitoring look at the latest records (latest()), which stay in the buffer until they're
+    # overwritten. When HDF_writer has max_backlog records (at most size) waiting, put()
+    # either waits for it ("block", for at most block_timeout, then drops the oldest record),
+    # or drops the oldest ("drop-oldest") or the new ("drop-newest") record; dropped counts
+    # them. Records that HDF_writer has written (or that were dropped) are let go of once
+    # they're not among the latest keep records anymore, and passed to on_release, so that
+    # their memory can be reused (see drivers/buffer_pool.py). HDF_writer takes the next
+    # records only after writing the last ones, so those taken before the last get() are written.
+    policies = ["block", "drop-oldest", "drop-newest"]
+
+    def __init__(self, size=10000, policy="drop-oldest", block_timeout=1.0, keep=None, max_backlog=None,
+                 on_release=None):
+        self.size = max(int(size), 1)
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.keep = self.size if keep is None else keep
+        self.max_backlog = self.size if max_backlog is None else max(min(int(max_backlog), self.size), 1)
+        self.slots = [None] * self.size
+        self.on_release = on_release
+
+        # head: number of records put so far; cursor: number of records taken by HDF_writer;
+        # written: number of records HDF_writer is done with; released: number of records let go of
+        self.head = 0
+        self.cursor = 0
+        self.written = 0
+        self.released = 0
+        self.dropped = 0
+        self.high_watermark = 0
+        self.lock = threading.Condition()
+
+    def __len__(self):
+        # number of records waiting for HDF_writer
+        return self.head - self.cursor
+
+    def put(self, item, hdf=True):
+        # returns False if the record was dropped; with hdf=False, the record is only for the
+        # plots (when the data goes to HDF through a SharedRingBuffer instead)
+        with self.lock:
+            if hdf and self.head - self.cursor >= self.max_backlog:
+                if self.policy == "block":
+                    self.lock.wait_for(lambda: self.head - self.cursor < self.max_backlog, self.block_timeout)
+                if self.head - self.cursor >= self.max_backlog:
+                    self.dropped += 1
+                    if self.policy == "drop-newest":
+                        return False
+                    self.cursor += 1
+            self.slots[self.head % self.size] = item
+            self.head += 1
+            if not hdf:
+                self.cursor = self.written = self.head
+                self.release()
+            self.high_watermark = max(self.high_watermark, self.head - self.cursor)
+            return True
+
+    def release(self):
+        # empty the slots of the records written by HDF_writer that are older than the latest keep
+        # (records overwritten before that are not passed to on_release, since they may still be
+        # being written)
+        stop = min(self.written, self.head - self.keep)
+        for i in range(max(self.released, self.head - self.size), stop):
+            item, self.slots[i % self.size] = self.slots[i % self.size], None
+            if self.on_release and item is not None:
+                self.on_release(item)
+        self.released = max(self.released, stop)
+
+    def get(self):
+        # all records HDF_writer hasn't taken yet, oldest first
+        with self.lock:
+            items = [self.slots[i % self.size] for i in range(self.cursor, self.head)]
+            self.written = self.cursor
+            self.cursor = self.head
+            self.release()
+            self.lock.notify_all()
+        return items
+
+    def latest(self, n):
+        # the last n records (or as many as there are), oldest first
+        with self.lock:
+            n = max(min(n, self.head - self.released, self.size), 0)
+            return [self.slots[i % self.size] for i in range(self.head - n, self.head)]
+
+    def clear(self):
+        with self.lock:
+            self.slots = [None] * self.size
+            self.head = 0
+            self.cursor = 0
+            self.written = 0
+            self.released = 0
+            self.lock.notify_all()
+
+class SharedRingBuffer:
+    """A single-producer, single-consumer ring buffer of numpy records in shared memory."""
+    # The producer and consumer may live in different processes: the consumer attaches
+    # to the buffer by name (see spec()), and records are copied in and out as numpy arrays,
+    # without pickling.
+
+    # header: index of the next record to read, index of the next record to write,
+    # capacity, and number of records dropped because the buffer was full
+    HEAD, TAIL, CAPACITY, DROPPED = range(4)
+    HEADER_BYTES = 64
+
+    def __init__(self, dtype, capacity=None, name=None):
+        self.dtype = np.dtype(dtype)
+
+        if name is None:
+            # create a new buffer
+            self.shm = shared_memory.SharedMemory(create=True,
+                    size=self.HEADER_BYTES + int(capacity)*self.dtype.itemsize)
+            self.owner = True
+            self.header = np.ndarray((self.HEADER_BYTES//8,), dtype=np.int64, buffer=self.shm.buf)
+            self.header[:] = 0
+            self.header[self.CAPACITY] = int(capacity)
+        else:
+            # attach to an existing buffer
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+            self.header = np.ndarray((self.HEADER_BYTES//8,), dtype=np.int64, buffer=self.shm.buf)
+
+        self.capacity = int(self.header[self.CAPACITY])
+        self.slots = np.ndarray((self.capacity,), dtype=self.dtype, buffer=self.shm.buf, offset=self.HEADER_BYTES)
+
+    def spec(self):
+        # what another process needs to attach to this buffer
+        return {"name": self.shm.name, "dtype": self.dtype}
+
+    def __len__(self):
+        return int(self.header[self.TAIL] - self.header[self.HEAD])
+
+    def dropped(self):
+        return int(self.header[self.DROPPED])
+
+    def put(self, rows):
+        # copy rows (a 1D array of self.dtype) into the buffer; called by the producer only
+        head, tail = int(self.header[self.HEAD]), int(self.header[self.TAIL])
+        n = min(len(rows), self.capacity - (tail - head))
+        if n < len(rows):
+            self.header[self.DROPPED] += len(rows) - n
+
+        # copy the data first (in at most two pieces, if it wraps around), then publish it by moving the tail
+        start = tail % self.capacity
+        first = min(n, self.capacity - start)
+        self.slots[start:start+first] = rows[:first]
+        self.slots[:n-first] = rows[first:n]
+        self.header[self.TAIL] = tail + n
+        return n
+
+    def get(self):
+        # copy all available rows out of the buffer; called by the consumer only
+        head, tail = int(self.header[self.HEAD]), int(self.header[self.TAIL])
+        idx = np.arange(head, tail) % self.capacity
+        rows = self.slots[idx]
+        self.header[self.HEAD] = tail
+        return rows
+
+    def close(self):
+        # numpy views have to be released before the shared memory can be closed
+        del self.header, self.slots
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class RunIndex:
+    """An SQLite index of the runs written under one hdf_fname, and the files they are in."""
+    # Listing the runs of a large HDF file (or of several files, see HDF_writer.check_rollover())
+    # is slow, so the runs are listed here instead, each with the file it was written to and
+    # the time it started and stopped writing to it. A run spread over several files has
+    # one row per file. The index is created next to hdf_fname (by HDF_writer), and the runs
+    # already in hdf_fname are added to it when it is created. A readonly index (for
+    # browsing, see hdf_runs()) never creates or changes the index file. HDF_writer keeps
+    # the index open for the whole run (see open()), other users connect for each query.
+    def __init__(self, hdf_fname, readonly=False):
+        self.hdf_fname = hdf_fname
+        self.fname = os.path.splitext(hdf_fname)[0] + "_index.sqlite"
+        self.dir = os.path.dirname(os.path.abspath(self.fname))
+        self.readonly = readonly
+        self.con = None
+
+    def open(self):
+        # keep one connection until close(); HDF_writer uses it from its own thread
+        self.con = self.open_connection(check_same_thread=False)
+
+    def close(self):
+        if self.con is not None:
+            self.con.close()
+            self.con = None
+
+    def open_connection(self, **kwargs):
+        new = not os.path.exists(self.fname)
+        con = sqlite3.connect(self.fname, timeout=10, **kwargs)
+        try:
+            with con:
+                con.execute("CREATE TABLE IF NOT EXISTS runs "
+                            "(run_name TEXT, fname TEXT, time_start REAL, time_stop REAL)")
+                # one row per run and file (indices made by older versions may have duplicates)
+                if not con.execute("SELECT name FROM sqlite_master WHERE name = 'runs_unique'").fetchone():
+                    con.execute("DELETE FROM runs WHERE rowid NOT IN "
+                                "(SELECT MIN(rowid) FROM runs GROUP BY run_name, fname)")
+                    con.execute("CREATE UNIQUE INDEX runs_unique ON runs (run_name, fname)")
+                if new:
+                    self.add_existing_runs(con)
+        except sqlite3.Error:
+            con.close()
+            raise
+        return con
+
+    @contextlib.contextmanager
+    def connect(self):
+        if self.con is not None:
+            with self.con:
+                yield self.con
+            return
+
+        if self.readonly:
+            # (raises sqlite3.OperationalError if there's no index)
+            con = sqlite3.connect(pathlib.Path(os.path.abspath(self.fname)).as_uri() + "?mode=ro", uri=True, timeout=10)
+            try:
+                yield con
+            finally:
+                con.close()
+            return
+
+        con = self.open_connection()
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def add_existing_runs(self, con):
+        if not os.path.exists(self.hdf_fname):
+            return
+        try:
+            with h5py.File(self.hdf_fname, 'r') as f:
+                runs = [(run, f[run].attrs.get("time_offset", 0)) for run in f.keys()]
+        except OSError as err:
+            logging.warning("RunIndex warning: cannot list runs in {0}: {1}".format(self.hdf_fname, err))
+            logging.info(traceback.format_exc())
+            return
+        for run, time_start in runs:
+            con.execute("INSERT OR IGNORE INTO runs VALUES (?, ?, ?, NULL)",
+                        (run, os.path.relpath(self.hdf_fname, self.dir), float(time_start)))
+
+    def exists(self):
+        return os.path.exists(self.fname) or os.path.exists(self.hdf_fname)
+
+    def add(self, run_name, fname, time_start):
+        with self.connect() as con:
+            con.execute("INSERT OR IGNORE INTO runs VALUES (?, ?, ?, NULL)",
+                        (run_name, os.path.relpath(fname, self.dir), time_start))
+
+    def stop(self, run_name, fname, time_stop):
+        with self.connect() as con:
+            con.execute("UPDATE runs SET time_stop = ? WHERE run_name = ? AND fname = ?",
+                        (time_stop, run_name, os.path.relpath(fname, self.dir)))
+
+    def runs(self):
+        # all runs, oldest first
+        if not self.exists():
+            raise OSError("no HDF file or run index: " + self.hdf_fname)
+        with self.connect() as con:
+            rows = con.execute("SELECT run_name FROM runs GROUP BY run_name ORDER BY MIN(rowid)").fetchall()
+        return [row[0] for row in rows]
+
+    def files(self, run_name):
+        # files of a run, in the order they were written
+        with self.connect() as con:
+            rows = con.execute("SELECT fname FROM runs WHERE run_name = ? GROUP BY fname ORDER BY MIN(rowid)",
+                               (run_name,)).fetchall()
+        return [os.path.normpath(os.path.join(self.dir, row[0])) for row in rows]
+
+    def latest_file(self):
+        with self.connect() as con:
+            row = con.execute("SELECT fname FROM runs ORDER BY rowid DESC LIMIT 1").fetchone()
+        return os.path.normpath(os.path.join(self.dir, row[0])) if row else None
+
+    def file_start(self, fname):
+        # time the first run in a file started writing to it
+        with self.connect() as con:
+            row = con.execute("SELECT MIN(time_start) FROM runs WHERE fname = ?",
+                              (os.path.relpath(fname, self.dir),)).fetchone()
+        return row[0] if row else None
+
+def hdf_runs(parent, fname):
+    # list of runs under fname, from its run index if there is one (only read here, so that
+    # browsing a file doesn't leave an index next to it), otherwise from the file itself
+    index = RunIndex(fname, readonly=True)
+    if os.path.exists(index.fname):
+        try:
+            return index.runs()
+        except sqlite3.Error as err:
+            logging.warning("RunIndex warning: {0}".format(err))
+            logging.info(traceback.format_exc())
+    with open_HDF_reader(parent, fname) as f:
+        return list(f.keys())
+
+def hdf_run_files(fname, run_name):
+    # files a run was written to, oldest first
+    index = RunIndex(fname, readonly=True)
+    files = []
+    if os.path.exists(index.fname):
+        try:
+            files = index.files(run_name)
+        except sqlite3.Error as err:
+            logging.info(traceback.format_exc())
+    return files if files else [fname]
+
+class SpoolFile:
+    """An append-only file of the records and events of one device, written before they go to HDF."""
+    # If the program dies while writing, an HDF file can be corrupted, while a spool file
+    # at most loses its last (incomplete) record. HDF_spool_merger copies the spool files
+    # into the HDF file during the run, and recover_spools() does the same after a crash.
+    #
+    # File layout: MAGIC, the length of the metadata, the metadata (JSON), then records of
+    # RECORD_HEADER (magic, kind, # of rows, payload length, CRC32 of payload) and payload.
+    # DATA payloads are raw numpy records of the dtype in the metadata, EVENTS payloads are JSON.
+    MAGIC = b"CNTRXSPL"
+    META_HEADER = struct.Struct("<I")
+    RECORD_MAGIC = b"REC1"
+    RECORD_HEADER = struct.Struct("<4sB3xIQI")
+    DATA, EVENTS = 0, 1
+
+    def __init__(self, fname, meta=None):
+        self.fname = fname
+        self.file = None
+
+        # create a new spool file
+        if meta is not None:
+            meta = dict(meta)
+            for key in ["dtype", "dset_dtype"]:
+                meta[key] = np.lib.format.dtype_to_descr(np.dtype(meta[key]))
+            meta_bytes = json.dumps(meta).encode()
+            self.file = open(fname, "wb")
+            self.file.write(self.MAGIC + self.META_HEADER.pack(len(meta_bytes)) + meta_bytes)
+            self.sync()
+
+        # read the metadata of an existing spool file
+        with open(fname, "rb") as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError("{0} is not a spool file".format(fname))
+            meta_len, = self.META_HEADER.unpack(f.read(self.META_HEADER.size))
+            self.meta = json.loads(f.read(meta_len).decode())
+            self.data_start = f.tell()
+
+        for key in ["dtype", "dset_dtype"]:
+            self.meta[key] = np.lib.format.descr_to_dtype(self.meta[key])
+        self.dtype = self.meta["dtype"]
+
+    def append(self, kind, payload, n):
+        header = self.RECORD_HEADER.pack(self.RECORD_MAGIC, kind, n, len(payload), zlib.crc32(payload))
+        self.file.write(header + payload)
+
+    def append_rows(self, rows):
+        if len(rows) > 0:
+            self.append(self.DATA, np.ascontiguousarray(rows, dtype=self.dtype).tobytes(), len(rows))
+
+    def append_events(self, events):
+        if events:
+            self.append(self.EVENTS, json.dumps(events, default=str).encode(), len(events))
+
+    def sync(self):
+        # hand the buffered records to the OS, so that HDF_spool_merger can read them
+        self.file.flush()
+
+    def fsync(self):
+        # make sure the records are on disk
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def read(self, offset=None):
+        # yields (kind, rows or events, offset of the next record) for each complete record;
+        # stops at the first incomplete or corrupted record, e.g. the one being written
+        # when the program crashed
+        offset = self.data_start if offset is None else offset
+        with open(self.fname, "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(self.RECORD_HEADER.size)
+                if len(header) < self.RECORD_HEADER.size:
+                    return
+                magic, kind, n, length, crc = self.RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if magic != self.RECORD_MAGIC or len(payload) < length:
+                    return
+                if zlib.crc32(payload) != crc:
+                    logging.warning("SpoolFile warning: corrupted record at byte {0} of {1}.".format(offset, self.fname))
+                    return
+                offset += self.RECORD_HEADER.size + length
+                if kind == self.DATA:
+                    yield kind, np.frombuffer(payload, dtype=self.dtype, count=n), offset
+                else:
+                    yield kind, json.loads(payload.decode()), offset
+
+    def merged_offset(self):
+        # offset up to which the records have been written to the HDF file
+        try:
+            with open(self.fname + ".merged", "r") as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return self.data_start
+
+    def set_merged_offset(self, offset):
+        with open(self.fname + ".merged.tmp", "w") as f:
+            f.write(str(offset))
+        os.replace(self.fname + ".merged.tmp", self.fname + ".merged")
+
+    def close(self):
+        if self.file:
+            self.fsync()
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+        for fname in [self.fname, self.fname + ".merged"]:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+def recover_spools(spool_dir, hdf_fname=None, from_start=False):
+    # Rebuild HDF data from the spool files left behind by a crash. Records not yet merged
+    # are appended to the HDF file the spool files were written for, or, if hdf_fname is
+    # given, all records are written to that file (e.g. when the original file is corrupted).
+    # Missing groups and datasets are created. The spool files are kept.
+    for spool_fname in sorted(glob.glob(os.path.join(spool_dir, "*.spool"))):
+        spool = SpoolFile(spool_fname)
+        meta = spool.meta
+        fname = hdf_fname if hdf_fname else meta["hdf_fname"]
+        # the run may have continued in another file (see HDF_writer.check_rollover())
+        if not hdf_fname and meta.get("hdf_index"):
+            # (only read, since the run may still be writing to the index)
+            try:
+                fname = (RunIndex(meta["hdf_index"], readonly=True).files(meta["run_name"]) or [fname])[-1]
+            except sqlite3.Error as err:
+                logging.warning("recover_spools: cannot read the run index: {0}".format(err))
+                logging.info(traceback.format_exc())
+        if from_start or (hdf_fname and os.path.abspath(hdf_fname) != os.path.abspath(meta["hdf_fname"])):
+            offset = spool.data_start
+        else:
+            offset = spool.merged_offset()
+
+        n_rows, n_events = 0, 0
+        with h5py.File(fname, "a") as f:
+            root = f.require_group(meta["run_name"])
+            if "time_offset" not in root.attrs:
+                root.attrs["time_offset"] = meta["time_offset"]
+            grp = root.require_group(meta["hdf_group"])
+            create_spool_datasets(grp, meta)
+
+            events_strings = {}
+            for kind, obj, offset in spool.read(offset):
+                if kind == SpoolFile.DATA:
+                    write_rows_to_HDF(grp, meta["dev_name"], meta, obj)
+                    n_rows += len(obj)
+                else:
+                    write_events(grp, meta["dev_name"], obj, events_strings)
+                    n_events += len(obj)
+
+        if not hdf_fname:
+            spool.set_merged_offset(offset)
+        logging.warning("recover_spools: {0}: {1} records and {2} events written to {3}.".format(
+                os.path.basename(spool_fname), n_rows, n_events, fname))
+
+def create_consolidated_datasets(grp, dev_name, dev):
+    # one dataset of shape (# of records, # of channels, # of samples) for all records,
+    # and one table with the index, time and attributes of each record; dev is a dict
+    # given by HDF_writer.consolidated_spec()
+    n_ch, n_samp = dev["n_ch"], dev["n_samp"]
+
+    # chunk shape: records per chunk, optionally followed by channels and samples per chunk
+    try:
+        chunks = [int(x) for x in dev["hdf_chunk_shape"]]
+    except ValueError:
+        logging.warning("HDF_writer warning: invalid hdf_chunk_shape for device {0}.".format(dev_name))
+        logging.info(traceback.format_exc())
+        chunks = [16]
+    chunks = (chunks + [n_ch, n_samp][len(chunks)-1:])[0:3]
+    chunks = (max(1, chunks[0]), min(max(1, chunks[1]), n_ch), max(1, chunks[2]))
+
+    compression = dev["hdf_compression"]
+    if compression in ["None", "none", ""]:
+        compression, compression_opts = None, None
+    elif compression == "gzip":
+        compression_opts = dev["hdf_compression_opts"]
+    else:
+        compression_opts = None
+
+    dset = grp.create_dataset(
+            dev_name,
+            (0, n_ch, n_samp),
+            maxshape         = (None, n_ch, None),
+            chunks           = chunks,
+            dtype            = dev["dtype"],
+            compression      = compression,
+            compression_opts = compression_opts,
+            fillvalue        = np.nan if np.dtype(dev["dtype"]).kind == "f" else 0,
+        )
+    for attr_name, attr in dev["attributes"].items():
+        dset.attrs[attr_name] = attr
+
+    grp.create_dataset(
+            dev_name + "_index",
+            (0,),
+            maxshape = (None,),
+            chunks   = (chunks[0],),
+            dtype    = np.dtype([
+                            ("index", "i8"),
+                            ("time", "f8"),
+                            ("attrs", h5py.special_dtype(vlen=str)),
+                        ]),
+        )
+
+def create_spool_datasets(grp, meta):
+    # create the datasets of a device described by the metadata of a spool file, if missing
+    dev_name = meta["dev_name"]
+    if meta["slow_data"]:
+        if dev_name not in grp:
+            dset = grp.create_dataset(dev_name, (0,), maxshape=(None,), dtype=meta["dset_dtype"])
+            for attr_name, attr in meta["attributes"].items():
+                dset.attrs[attr_name] = attr
+    else:
+        if meta["hdf_layout"] == "consolidated" and dev_name not in grp:
+            # as HDF_writer makes them; spool files written before the metadata had "consolidated"
+            # get the default chunks and no compression
+            n_ch, n_samp = meta["dtype"]["data"].shape
+            spec = {"dtype": meta["dtype"]["data"].base.str, "n_ch": n_ch, "n_samp": n_samp,
+                    "attributes": meta["attributes"], "hdf_chunk_shape": ["16"],
+                    "hdf_compression": "None", "hdf_compression_opts": 4}
+            spec.update(meta.get("consolidated", {}))
+            create_consolidated_datasets(grp, dev_name, spec)
+        for attr_name, attr in meta["attributes"].items():
+            grp.attrs[attr_name] = attr
+    if dev_name + "_events" not in grp:
+        create_events_datasets(grp, dev_name)
+
 # a combobox that won't respond if the mouse just hovers over it and scrolls the wheel,
 # it will respond if it's clicked and get focus
 # the purpose is to avoid accidental value change
@@ -212,6 +1148,10 @@ class FlexibleGridLayout(qt.QHBoxLayout):
 ##########################################################################
 
 class Device(threading.Thread):
+    # longest time the control loop waits without checking the device (for warnings, and
+    # changes to dt and enabled made in the GUI)
+    max_idle = 0.5
+
     def __init__(self, config):
         threading.Thread.__init__(self)
         self.config = config
@@ -221,24 +1161,76 @@ class Device(threading.Thread):
         self.active = threading.Event()
         self.active.clear()
 
+        # set to wake the control loop up when there's something to do (see wake());
+        # when the device runs on an AsyncDeviceRuntime, async_wakeup does the same
+        self.wakeup = threading.Event()
+        self.async_loop = None
+        self.async_wakeup = None
+
         # whether the connection to the device was successful
         self.operational = 0
         self.error_message = ""
 
+        # the open driver instance, as (driver, the object returned by its __enter__(),
+        # driver name and constructor parameters): made by setup_connection() and used by
+        # the control loop, and with keep_warm kept open after it for the next run
+        self.connection = None
+        self.keep_warm = False
+
+        # set when setup_connection() takes too long and the device is given up on (see
+        # ControlGUI.setup_connections()); the driver it opens late is then closed by it
+        self.setup_lock = threading.Lock()
+        self.setup_abandoned = False
+
         # for commands sent to the device
+        # (command_methods caches the driver methods that commands call, see run_command())
         self.commands = []
+        self.command_methods = {}
+
+        # the last event, as [time, command, return value], of the device and of those written
+        # to HDF (by HDF_writer); Monitoring displays them from here
         self.last_event = []
+        self.last_written_event = []
+        # monitoring commands are added by Monitoring and taken by the control loop, under monitoring_lock
         self.monitoring_commands = set()
+        self.monitoring_lock = threading.Lock()
         self.sequencer_commands = deque()
         self.sequencer_active = False
 
-        # for warnings about device abnormal condition
-        self.warnings = []
+        # for warnings about device abnormal condition (see WarningChannel)
+        self.warnings = WarningChannel()
+
+        # schedule of ReadValue(): slot k is due at read_start + k*read_dt on the
+        # time.monotonic() clock, and next_read is the deadline of the next slot (see
+        # schedule_next_read()); read_jitter counts how late reads start, read_overrun how
+        # long reads take beyond their slot
+        self.read_start = None
+        self.read_dt = None
+        self.read_slot = 0
+        self.next_read = 0
+        self.missed_slots = 0
+        self.read_jitter = LogHistogram()
+        self.read_overrun = LogHistogram()
+
+        # timing of the parts of the control loop (see record_time()); switched on and off at
+        # runtime with the "Device timing" checkbox, and costs only a check when off
+        self.timing_enabled = False
+        self.timing = {}
+        self.timed_ns = 0
 
         # the data and events queues
         self.time_last_read = 0
-        self.data_queue = deque()
-        self.config["plots_queue"] = deque(maxlen=self.config["plots_queue_maxlen"])
+        # (the size and overflow policy of data_queue are set by HDF_writer)
+        self.data_queue = DataQueue()
+        # shared memory buffer that replaces data_queue when HDF_writer runs in a separate process
+        self.hdf_ring = None
+
+        # backlog of the data queue, used by HDF_writer to decide when to write
+        # (time the oldest record not yet taken by HDF_writer was queued, and approximate size)
+        self.queue_time = None
+        self.queue_bytes = 0
+        self.hdf_flush_latency = None
+
         self.events_queue = deque()
         self.monitoring_events_queue = deque()
         self.sequencer_events_queue = deque()
@@ -251,6 +1243,8 @@ class Device(threading.Thread):
         self.previous_data = True
 
     def setup_connection(self, time_offset):
+        with self.setup_lock:
+            self.setup_abandoned = False
         self.time_offset = time_offset
 
         # get the parameters that are to be passed to the driver constructor
@@ -263,25 +1257,50 @@ class Device(threading.Thread):
         for cp in self.config["constr_params"]:
             self.constr_params.append(self.config["control_params"][cp]["value"])
 
+        # a driver kept open since the last run is used again if it was made with the same
+        # parameters (apart from the time offset), and closed otherwise
+        if self.connection:
+            driver, dev, driver_name, params = self.connection
+            if (driver_name, params) == (self.config["driver"], self.constr_params[1:]):
+                self.set_time_offset(dev)
+                self.operational = 2
+                return
+            self.close_connection()
+
         # check we are allowed to instantiate the driver before the main loop starts
         if not self.config["double_connect_dev"]:
             self.operational = 2
             return
 
-        # verify the device responds correctly
-        with self.config["driver_class"](*self.constr_params) as dev:
+        # verify the device responds correctly; the driver is then kept open for the control loop
+        driver = self.driver()
+        try:
+            dev = driver.__enter__()
+        except Exception:
+            driver.__exit__(*sys.exc_info())
+            raise
+        with self.setup_lock:
+            abandoned = self.setup_abandoned
+            if not abandoned:
+                self.connection = (driver, dev, self.config["driver"], self.constr_params[1:])
+        if abandoned:
+            driver.__exit__(None, None, None)
+            return
+
+        operational, error_message = 0, self.error_message
+        try:
             if dev.init_error:
                 if dev.init_error[0] == 'warning':
-                    self.operational = 1
-                    self.error_message = dev.init_error[1]
+                    operational = 1
+                    error_message = dev.init_error[1]
                 elif dev.init_error[0] == 'error':
-                    self.operational = 0
-                    self.error_message = dev.init_error[1]
+                    operational = 0
+                    error_message = dev.init_error[1]
                 else:
-                    self.operational = 0
-                    self.error_message = dev.init_error
+                    operational = 0
+                    error_message = dev.init_error
             else:
-                self.operational = 2
+                operational = 2
 
             # get parameters and attributes, if any, from the driver
             self.config["shape"] = dev.shape
@@ -289,12 +1308,68 @@ class Device(threading.Thread):
             self.config["dtype"] = dev.dtype
             for attr_name, attr_val in dev.new_attributes:
                 self.config["attributes"][attr_name] = attr_val
+        finally:
+            with self.setup_lock:
+                if not self.setup_abandoned:
+                    self.operational, self.error_message = operational, error_message
+                if self.setup_abandoned or not operational:
+                    self.close_connection()
 
         # Check dtype for compound dataset
         if self.config["compound_dataset"]:
             if not isinstance(self.config["dtype"], (list, tuple)):
                 logging.warning("Compound dataset device {0} requires list of dtypes".format(self.config["name"]))
 
+    def abandon_setup(self, error_message):
+        # called when setup_connection() doesn't finish in time, while it's still running
+        with self.setup_lock:
+            self.setup_abandoned = True
+            self.operational = 0
+            self.error_message = error_message
+
+    def driver(self):
+        # an instance of the driver, or for process_isolated devices a proxy to an instance
+        # running in a child process (see DriverProxy)
+        if self.config["process_isolated"]:
+            return DriverProxy(self.config, self.constr_params)
+        return self.config["driver_class"](*self.constr_params)
+
+    def set_time_offset(self, dev):
+        # the drivers timestamp their data relative to the time offset of the run they were
+        # made for, so a driver kept open from an earlier run needs the new one
+        if isinstance(dev, DriverProxy):
+            dev.set_time_offset(self.time_offset)
+        else:
+            dev.time_offset = self.time_offset
+
+    def open_connection(self):
+        # the driver for the control loop: the one opened by setup_connection(), if any
+        if self.connection is None:
+            driver = self.driver()
+            try:
+                dev = driver.__enter__()
+            except Exception:
+                driver.__exit__(*sys.exc_info())
+                raise
+            self.connection = (driver, dev, self.config["driver"], self.constr_params[1:])
+        return self.connection[1]
+
+    def release_connection(self, failed=False):
+        # at the end of the control loop: keep the driver open for the next run, unless the
+        # loop ended with an exception, which may have left the driver in a bad state
+        if failed or not self.keep_warm:
+            self.close_connection()
+
+    def close_connection(self):
+        if self.connection is None:
+            return
+        driver, self.connection = self.connection[0], None
+        try:
+            driver.__exit__(None, None, None)
+        except Exception as err:
+            logging.warning("Device {0}: error closing the driver: {1}".format(self.config["name"], err))
+            logging.warning(traceback.format_exc())
+
     def change_plots_queue_maxlen(self, maxlen):
         # sanity check
         try:
@@ -303,13 +1378,330 @@ class Device(threading.Thread):
             logging.info(traceback.format_exc())
             return
 
-        # create a new deque with a different maxlen
-        self.config["plots_queue"] = deque(maxlen=self.config["plots_queue_maxlen"])
+        # the plots show the latest records of data_queue, which holds at most its size
+        self.data_queue.keep = self.config["plots_queue_maxlen"]
+        if self.config["plots_queue_maxlen"] > self.data_queue.size:
+            logging.warning("Device {0}: only the last {1} records can be plotted (data_queue_size).".format(
+                    self.config["name"], self.data_queue.size))
+
+    def release_data(self, data):
+        # give the array of a fast-data ReadValue() return back to the BufferPool of the driver,
+        # if it has one (see drivers/buffer_pool.py), once DataQueue is done with it
+        connection = self.connection
+        if connection is None or isinstance(connection[1], DriverProxy):
+            return
+        pool = getattr(connection[1], "pool", None)
+        if pool is not None:
+            pool.release(data[0])
 
     def clear_queues(self):
         self.data_queue.clear()
         self.events_queue.clear()
 
+    def queue_data(self, data):
+        if self.hdf_ring is None:
+            # when HDF_writer falls behind, the data queue drops records, or makes the device
+            # wait (see DataQueue)
+            dropped = self.data_queue.dropped
+            queued = self.data_queue.put(data)
+            if self.data_queue.dropped > dropped == 0:
+                logging.warning("Device {0}: HDF writer falling behind, dropping data ({1}).".format(
+                        self.config["name"], self.data_queue.policy))
+            if not queued:
+                return
+            if self.queue_time is None:
+                self.queue_time = time.time()
+            self.queue_bytes += self.data_nbytes(data)
+            return
+
+        # hand the data over to the HDF writer process through shared memory, and keep it for the plots
+        try:
+            self.hdf_ring.put(self.to_records(data, self.hdf_ring.dtype))
+        except (ValueError, TypeError, IndexError, AttributeError) as err:
+            logging.warning("Device {0}: cannot pass data to the HDF writer process: {1}".format(self.config["name"], err))
+            logging.info(traceback.format_exc())
+        self.data_queue.put(data, hdf=False)
+
+    def wake(self):
+        # make the control loop run now, e.g. after queueing commands, or to stop it
+        self.wakeup.set()
+        # (run_async() may let go of both at any time, so they're read only once)
+        event, loop = self.async_wakeup, self.async_loop
+        if event is not None and loop is not None:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # the event loop has already been closed
+                pass
+
+    def work_pending(self):
+        return bool(self.commands or self.monitoring_commands or (self.sequencer_commands and self.sequencer_active))
+
+    def wait_timeout(self, dt):
+        # how long the control loop can sleep until the next ReadValue() is due
+        if self.config["control_params"]["enabled"]["value"] < 1:
+            timeout = self.max_idle
+        elif self.work_pending():
+            timeout = 0
+        elif self.config["control_params"]["enabled"]["value"] < 2:
+            timeout = self.max_idle
+        else:
+            timeout = min(max(self.next_read - time.monotonic(), 0), dt, self.max_idle)
+        return timeout
+
+    def wait(self, dt):
+        # sleep until the next ReadValue() is due, or wake() is called
+        timeout = self.wait_timeout(dt)
+        if timeout > 0:
+            self.wakeup.wait(timeout)
+        self.wakeup.clear()
+
+    async def wait_async(self, dt):
+        # same as wait(), on the event loop of an AsyncDeviceRuntime
+        timeout = self.wait_timeout(dt)
+        if timeout > 0:
+            try:
+                await asyncio.wait_for(self.async_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.async_wakeup.clear()
+        self.wakeup.clear()
+
+    def run_command(self, device, c):
+        # call a driver method; the command string is parsed only the first time it's seen
+        name, args, kwargs, code = compile_command(c)
+        if code is not None:
+            return eval(code, globals(), {"device": device})
+
+        method = self.command_methods.get(name)
+        if method is None:
+            method = self.command_methods[name] = getattr(device, name)
+        return method(*args, **dict(kwargs))
+
+    def data_nbytes(self, data):
+        # approximate size of one ReadValue() return
+        if self.config["slow_data"]:
+            return 8 * len(data)
+        try:
+            return np.asarray(data[0]).nbytes
+        except (TypeError, IndexError, ValueError):
+            return 0
+
+    def to_records(self, data, dtype):
+        # convert one ReadValue() return into records of the dtype given by HDF_writer.record_dtype()
+
+        # slow data: one ReadValue() return is one row
+        if self.config["slow_data"]:
+            return np.array([tuple(data)], dtype=dtype)
+
+        # fast data: [records, [attrs of each record]], records having shape (# of records, # of channels, # of samples);
+        # the number of samples may change during a run (e.g. PCIe6351_ai.update_samp_num()), up to
+        # the size of the record dtype (see HDF_writer.record_dtype())
+        records, all_attrs = np.asarray(data[0]), data[1]
+        n_ch, max_samp = dtype["data"].shape
+        if records.ndim != 3 or records.shape[1] != n_ch:
+            raise ValueError("data shape {0} doesn't match (n, {1}, n_samples)".format(records.shape, n_ch))
+        if records.shape[2] > max_samp:
+            raise ValueError("records of {0} samples don't fit in {1} samples (see hdf_max_samples)".format(records.shape[2], max_samp))
+        attrs = [json.dumps(attrs, default=str).encode() for attrs in all_attrs][0:len(records)] + \
+                [b"{}"] * (len(records) - len(all_attrs))
+        # the attrs field has a fixed size; truncated JSON couldn't be read back when merging
+        max_len = max([len(a) for a in attrs], default=0)
+        if max_len > dtype["attrs"].itemsize:
+            raise ValueError("attributes of {0} bytes don't fit in {1} bytes".format(max_len, dtype["attrs"].itemsize))
+        rows = np.zeros(len(records), dtype=dtype)
+        rows["time"] = time.time() - self.time_offset
+        rows["attrs"] = attrs
+        rows["n_samp"] = records.shape[2]
+        rows["data"][:, :, :records.shape[2]] = records
+        return rows
+
+    def qsize(self):
+        # number of records waiting to be written
+        if self.hdf_ring is not None:
+            return len(self.data_queue) + len(self.hdf_ring)
+        return len(self.data_queue)
+
+    def loop_delay(self):
+        # get and sanity check loop delay
+        try:
+            dt = float(self.config["control_params"]["dt"]["value"])
+            if dt < 0.02:
+                logging.warning("Device dt too small.")
+                raise ValueError
+        except ValueError:
+            logging.info(traceback.format_exc())
+            dt = 0.1
+        return dt
+
+    def record_time(self, section, ns):
+        hist = self.timing.get(section)
+        if hist is None:
+            hist = self.timing[section] = HdrHistogram()
+        hist.record(ns)
+        self.timed_ns += ns
+
+    def timing_summary(self):
+        # median and 99th percentile time of each part of the control loop
+        return "\n".join("{0}: {1} / {2}".format(section, format_ns(hist.percentile(50)), format_ns(hist.percentile(99)))
+                         for section, hist in sorted(self.timing.items()))
+
+    def run_step(self, device, dt):
+        # loop_step(), and (when timing) the time it spends outside of the timed parts
+        if not self.timing_enabled:
+            return self.loop_step(device, dt)
+        self.timed_ns = 0
+        t = time.perf_counter_ns()
+        self.loop_step(device, dt)
+        self.record_time("loop overhead", max(time.perf_counter_ns() - t - self.timed_ns, 0))
+
+    def loop_step(self, device, dt):
+        # one cycle of the control loop: commands, then ReadValue() if it's due
+        timing = self.timing_enabled
+
+        # level 1: check device is enabled for sending commands
+        if self.config["control_params"]["enabled"]["value"] < 1:
+            return
+
+        # check device for abnormal conditions
+        t = time.perf_counter_ns() if timing else 0
+        warning = device.GetWarnings()
+        if timing:
+            self.record_time("GetWarnings", time.perf_counter_ns() - t)
+        # (each in format [time.time()-time_offset, "warning content"])
+        if warning:
+            for w in warning:
+                if isinstance(w, (list, tuple)) and len(w) == 2 and isinstance(w[0], (int, float)):
+                    self.warnings.put(w[1], time_seen=w[0]+self.time_offset)
+                else:
+                    self.warnings.put(w)
+
+        # send control commands, if any, to the device, and record return values
+        commands, self.commands = self.commands, []
+        for c in commands:
+            t = time.perf_counter_ns() if timing else 0
+            try:
+                ret_val = self.run_command(device, c)
+            except Exception as err:
+                logging.warning(traceback.format_exc())
+                ret_val = str(err)
+            if timing:
+                self.record_time(c.split("(")[0].strip() + "()", time.perf_counter_ns() - t)
+            if (c == "ReadValue()") and ret_val:
+                self.queue_data(ret_val)
+            ret_val = "None" if not ret_val else ret_val
+            self.last_event = [time.time()-self.time_offset, c, str(ret_val)]
+            self.events_queue.append(self.last_event)
+
+        # send sequencer commands, if any, to the device, and record return values
+        if self.sequencer_commands and self.sequencer_active:
+            cmd_list = self.sequencer_commands.popleft()
+            for c in cmd_list:
+                t = time.perf_counter_ns() if timing else 0
+                try:
+                    ret_val = self.run_command(device, c)
+                except Exception as err:
+                    logging.warning(traceback.format_exc())
+                    ret_val = None
+                if timing:
+                    self.record_time(c.split("(")[0].strip() + "()", time.perf_counter_ns() - t)
+                if (c == "ReadValue()") and ret_val:
+                    self.queue_data(ret_val)
+                self.sequencer_events_queue.append([time.time()-self.time_offset, c, ret_val])
+                self.sequencer_active = False
+
+        # send monitoring commands, if any, to the device, and record return values
+        with self.monitoring_lock:
+            monitoring_commands, self.monitoring_commands = self.monitoring_commands, set()
+        for c in monitoring_commands:
+            t = time.perf_counter_ns() if timing else 0
+            try:
+                ret_val = self.run_command(device, c)
+            except Exception as err:
+                logging.warning(traceback.format_exc())
+                # ret_val = str(err)
+                ret_val = "Error"
+            if timing:
+                self.record_time(c.split("(")[0].strip() + "()", time.perf_counter_ns() - t)
+            ret_val = "None" if not ret_val else ret_val
+            self.monitoring_events_queue.append( [ time.time()-self.time_offset, c, ret_val ] )
+
+        # level 2: check device is enabled for regular ReadValue
+        # (the timeline of reads restarts when the device is enabled again)
+        if self.config["control_params"]["enabled"]["value"] < 2:
+            self.read_start = None
+            return
+
+        # (re)start the timeline of reads when starting, or when dt was changed
+        time_read = time.monotonic()
+        if self.read_start is None or dt != self.read_dt:
+            self.read_start, self.read_dt, self.read_slot = time_read, dt, 0
+            self.next_read = time_read
+
+        # record numerical values
+        if time_read >= self.next_read:
+            t = time.perf_counter_ns() if timing else 0
+            last_data = device.ReadValue()
+            if timing:
+                self.record_time("ReadValue()", time.perf_counter_ns() - t)
+            self.time_last_read = time.time()
+            self.schedule_next_read(time_read)
+            if last_data:
+                t = time.perf_counter_ns() if timing else 0
+                self.queue_data(last_data)
+                if timing:
+                    self.record_time("queue", time.perf_counter_ns() - t)
+
+            # turn on sequence parameter change for next cycle
+            if self.config["block_thread"]:
+                self.sequencer_active = True
+
+            # keep track of the number of (sequential and total) NaN returns
+            if isinstance(last_data, float):
+                if np.isnan(last_data):
+                    self.nan_count += 1
+                    if isinstance(self.previous_data, float) and np.isnan(self.previous_data):
+                        self.sequential_nan_count += 1
+                else:
+                    self.sequential_nan_count = 0
+            self.previous_data = last_data
+
+            # issue a warning if there's been too many sequential NaN returns
+            try:
+                max_NaN_count = int(self.config["max_NaN_count"])
+            except TypeError:
+                logging.info(traceback.format_exc())
+                max_NaN_count = 10
+            if self.sequential_nan_count > max_NaN_count:
+                self.warnings.put("excess sequential NaN returns: " + str(self.sequential_nan_count),
+                        key="sequential_NaN_count_exceeded")
+
+    def schedule_next_read(self, time_read):
+        # move on to the next slot of the timeline that's still ahead, skipping (and counting)
+        # the slots missed because the read took too long, or started too late
+        time_done = time.monotonic()
+        self.read_jitter.add(time_read - self.next_read)
+        if time_done > self.next_read + self.read_dt:
+            self.read_overrun.add(time_done - self.next_read - self.read_dt)
+
+        slot = self.read_slot + 1
+        slot_ahead = int((time_done - self.read_start) // self.read_dt) + 1
+        if slot_ahead > slot:
+            if self.missed_slots == 0:
+                logging.warning("Device {0}: ReadValue() missed its slot, the device can't keep up with dt = {1} s.".format(
+                        self.config["name"], self.read_dt))
+            self.missed_slots += slot_ahead - slot
+            slot = slot_ahead
+        self.read_slot = slot
+        self.next_read = self.read_start + slot * self.read_dt
+
+    def report_exception(self):
+        # report any exception that has occurred in the run() function
+        logging.info(traceback.format_exc())
+        err_msg = traceback.format_exc()
+        self.warnings.put("exception in " + self.config["name"] + ": " + err_msg,
+                key="exception: " + err_msg.strip().splitlines()[-1])
+
     def run(self):
         # check connection to the device was successful
         if not self.operational:
@@ -319,128 +1711,350 @@ class Device(threading.Thread):
             self.control_started = True
 
         # main control loop
+        failed = False
         try:
-            with self.config["driver_class"](*self.constr_params) as device:
-                while self.active.is_set():
-                    # get and sanity check loop delay
-                    try:
-                        dt = float(self.config["control_params"]["dt"]["value"])
-                        if dt < 0.02:
-                            logging.warning("Device dt too small.")
-                            raise ValueError
-                    except ValueError:
-                        logging.info(traceback.format_exc())
-                        dt = 0.1
+            device = self.open_connection()
+            self.command_methods = {}
+            while self.active.is_set():
+                dt = self.loop_delay()
+
+                # wait for commands, or for the next ReadValue() to be due
+                self.wait(dt)
+                if not self.active.is_set():
+                    break
 
-                    # 50 Hz loop delay
-                    time.sleep(0.02)
+                self.run_step(device, dt)
 
-                    # level 1: check device is enabled for sending commands
-                    if self.config["control_params"]["enabled"]["value"] < 1:
-                        continue
+        except Exception as err:
+            failed = True
+            self.report_exception()
 
-                    # check device for abnormal conditions
-                    warning = device.GetWarnings()
-                    if warning:
-                        self.warnings += warning
-
-                    # send control commands, if any, to the device, and record return values
-                    for c in self.commands:
-                        try:
-                            ret_val = eval("device." + c.strip())
-                        except Exception as err:
-                            logging.warning(traceback.format_exc())
-                            ret_val = str(err)
-                        if (c == "ReadValue()") and ret_val:
-                            self.data_queue.append(ret_val)
-                            self.config["plots_queue"].append(ret_val)
-                        ret_val = "None" if not ret_val else ret_val
-                        self.last_event = ["{:.3f} [s]".format(time.time()-self.time_offset), c, str(ret_val)]
-                        # self.last_event = [ time.time()-self.time_offset, c, str(ret_val) ]
-                        self.events_queue.append(self.last_event)
-                    self.commands = []
-
-                    # send sequencer commands, if any, to the device, and record return values
-                    if self.sequencer_commands and self.sequencer_active:
-                        cmd_list = self.sequencer_commands.popleft()
-                        for c in cmd_list:
-                            try:
-                                ret_val = eval("device." + c.strip())
-                            except Exception as err:
-                                logging.warning(traceback.format_exc())
-                                ret_val = None
-                            if (c == "ReadValue()") and ret_val:
-                                self.data_queue.append(ret_val)
-                                self.config["plots_queue"].append(ret_val)
-                            self.sequencer_events_queue.append([time.time()-self.time_offset, c, ret_val])
-                            self.sequencer_active = False
-
-                    # send monitoring commands, if any, to the device, and record return values
-                    for c in self.monitoring_commands:
-                        try:
-                            ret_val = eval("device." + c.strip())
-                        except Exception as err:
-                            logging.warning(traceback.format_exc())
-                            # ret_val = str(err)
-                            ret_val = "Error"
-                        ret_val = "None" if not ret_val else ret_val
-                        self.monitoring_events_queue.append( [ time.time()-self.time_offset, c, ret_val ] )
-                    self.monitoring_commands = set()
-
-                    # level 2: check device is enabled for regular ReadValue
-                    if self.config["control_params"]["enabled"]["value"] < 2:
-                        continue
+        finally:
+            self.release_connection(failed)
 
-                    # record numerical values
-                    if time.time() - self.time_last_read >= dt:
-                        last_data = device.ReadValue()
-                        self.time_last_read = time.time()
-                        if last_data:
-                            self.data_queue.append(last_data)
-                            self.config["plots_queue"].append(last_data)
-
-                        # turn on sequence parameter change for next cycle
-                        if self.config["block_thread"]:
-                            self.sequencer_active = True
-
-                        # keep track of the number of (sequential and total) NaN returns
-                        if isinstance(last_data, float):
-                            if np.isnan(last_data):
-                                self.nan_count += 1
-                                if isinstance(self.previous_data, float) and np.isnan(self.previous_data):
-                                    self.sequential_nan_count += 1
-                            else:
-                                self.sequential_nan_count = 0
-                        self.previous_data = last_data
-
-                        # issue a warning if there's been too many sequential NaN returns
-                        try:
-                            max_NaN_count = int(self.config["max_NaN_count"])
-                        except TypeError:
-                            logging.info(traceback.format_exc())
-                            max_NaN_count = 10
-                        if self.sequential_nan_count > max_NaN_count:
-                            warning_dict = {
-                                    "message" : "excess sequential NaN returns: " + str(self.sequential_nan_count),
-                                    "sequential_NaN_count_exceeded" : 1,
-                                }
-                            self.warnings.append([time.time(), warning_dict])
+    async def run_async(self, executor):
+        # the same as run(), as a coroutine of an AsyncDeviceRuntime; the driver is only
+        # called from the threads of the executor, since its calls block
+        if not self.operational:
+            return
+        else:
+            self.active.set()
+            self.control_started = True
 
+        loop = asyncio.get_running_loop()
+        self.async_loop = loop
+        self.async_wakeup = asyncio.Event()
+        failed = False
+        try:
+            device = await loop.run_in_executor(executor, self.open_connection)
+            self.command_methods = {}
+            while self.active.is_set():
+                dt = self.loop_delay()
+                await self.wait_async(dt)
+                if not self.active.is_set():
+                    break
+                await loop.run_in_executor(executor, self.run_step, device, dt)
 
-        # report any exception that has occurred in the run() function
         except Exception as err:
+            failed = True
+            self.report_exception()
+
+        finally:
+            self.async_wakeup = None
+            self.async_loop = None
+            await loop.run_in_executor(executor, self.release_connection, failed)
+
+class AsyncDeviceRuntime(threading.Thread):
+    # Runs the control loops of several devices (see Device.run_async()) on one asyncio event
+    # loop, instead of a thread per device. Driver calls block (e.g. pyvisa I/O), so they're
+    # made from a small thread pool of max_workers threads.
+    def __init__(self, devices, max_workers):
+        threading.Thread.__init__(self)
+        self.devices = devices
+        self.max_workers = max_workers
+
+    def run(self):
+        asyncio.run(self.run_devices())
+
+    async def run_devices(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            await asyncio.gather(*[dev.run_async(executor) for dev in self.devices])
+
+class DriverProcessError(RuntimeError):
+    # the process of a DriverProxy crashed or hung, and was restarted
+    pass
+
+class DriverProcess(multiprocessing.Process):
+    # Runs the driver of a process_isolated device for a DriverProxy: calls its methods as
+    # requested over conn, and passes the arrays returned by fast data devices back through
+    # shared memory (the rest of the return values are pickled).
+    def __init__(self, driver, constr_params, conn):
+        multiprocessing.Process.__init__(self, daemon=True)
+        self.driver = driver
+        self.constr_params = constr_params
+        self.conn = conn
+
+    def run(self):
+        self.shm = None
+        try:
+            driver_spec = importlib.util.spec_from_file_location(self.driver, "drivers/" + self.driver + ".py")
+            driver_module = importlib.util.module_from_spec(driver_spec)
+            driver_spec.loader.exec_module(driver_module)
+            driver = getattr(driver_module, self.driver)(*self.constr_params)
+            device = driver.__enter__()
+        except Exception as err:
+            self.conn.send(("error", traceback.format_exc()))
+            return
+
+        # what the Device needs to know about the driver (see Device.setup_connection())
+        self.conn.send(("ok", {
+                "init_error"     : getattr(device, "init_error", ""),
+                "shape"          : getattr(device, "shape", None),
+                "dtype"          : getattr(device, "dtype", None),
+                "new_attributes" : getattr(device, "new_attributes", []),
+            }))
+
+        try:
+            while True:
+                try:
+                    msg = self.conn.recv()
+                except EOFError:
+                    # the main program has gone away
+                    break
+                if msg[0] == "exit":
+                    break
+
+                name, args, kwargs = msg[1:]
+                try:
+                    self.conn.send(self.reply(getattr(device, name)(*args, **kwargs)))
+                except Exception as err:
+                    self.conn.send(("error", traceback.format_exc()))
+        finally:
+            driver.__exit__(None, None, None)
+            if self.shm:
+                self.shm.close()
+                self.shm.unlink()
+
+    def reply(self, ret):
+        # fast data returns are [array of records, [attrs]]
+        if not (isinstance(ret, list) and len(ret) == 2 and isinstance(ret[0], np.ndarray)):
+            return ("ok", ret)
+
+        # the shared memory is only replaced when it's too small; the proxy has copied the
+        # previous array out of it before making another call
+        arr = np.ascontiguousarray(ret[0])
+        if self.shm is None or self.shm.size < arr.nbytes:
+            if self.shm:
+                self.shm.close()
+                self.shm.unlink()
+            self.shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=self.shm.buf)[...] = arr
+        return ("array", (self.shm.name, arr.shape, arr.dtype.str, ret[1]))
+
+class DriverProxy:
+    # Stands in for the driver of a process_isolated device, so that a driver blocking or
+    # crashing doesn't take the rest of the program with it. The driver runs in a
+    # DriverProcess, and the proxy's methods forward calls to it. If the process dies, or a
+    # call takes longer than process_timeout, the process is restarted (and the call raises
+    # DriverProcessError, except ReadValue() and GetWarnings(), which return nothing).
+    def __init__(self, config, constr_params):
+        self.dev_name = config["name"]
+        self.driver_name = config["driver"]
+        self.timeout = config["process_timeout"]
+        self.constr_params = constr_params
+        self.time_offset = constr_params[0]
+        self.process = None
+        self.conn = None
+        self.shm = None
+        self.restarts = 0
+        self.warnings = []
+        self.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def __getattr__(self, name):
+        # any other method of the driver (only called for names the proxy doesn't have)
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
+
+    def start(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = DriverProcess(self.driver_name, self.constr_params, child_conn)
+        self.process.start()
+        child_conn.close()
+
+        # (starting a process, and connecting to the device, may take longer than a call)
+        try:
+            status, info = self.receive(max(self.timeout, 60))
+        except (TimeoutError, EOFError, OSError) as err:
+            status, info = "error", "{0}: {1}".format(type(err).__name__, err)
+        if status == "error":
+            self.stop()
+            raise RuntimeError("Driver of {0} failed to start in its own process:\n{1}".format(self.dev_name, info))
+
+        self.init_error = info["init_error"]
+        self.shape = info["shape"]
+        self.dtype = info["dtype"]
+        self.new_attributes = info["new_attributes"]
+
+    def stop(self):
+        try:
+            self.conn.send(("exit",))
+        except OSError:
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+        if self.shm:
+            self.shm.close()
+            self.shm = None
+
+    def restart(self, reason):
+        logging.warning("Device {0}: driver process {1}, restarting it.".format(self.dev_name, reason))
+        self.warnings.append([time.time()-self.time_offset, "driver process " + reason + ", restarted"])
+        self.restarts += 1
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+        # the process can't clean up its shared memory anymore
+        if self.shm:
+            self.shm.close()
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+            self.shm = None
+
+        self.start()
+
+    def receive(self, timeout):
+        if not self.conn.poll(timeout):
+            raise TimeoutError("no reply in {0} s".format(timeout))
+        return self.conn.recv()
+
+    def call(self, name, *args, **kwargs):
+        if not self.process.is_alive():
+            self.restart("died")
+
+        try:
+            self.conn.send(("call", name, args, kwargs))
+            status, ret = self.receive(self.timeout)
+        except TimeoutError:
+            self.restart("timed out in {0}()".format(name))
+            raise DriverProcessError("{0}() timed out after {1} s".format(name, self.timeout))
+        except (EOFError, OSError):
+            self.restart("crashed in {0}()".format(name))
+            raise DriverProcessError("driver process crashed in {0}()".format(name))
+
+        if status == "error":
+            raise RuntimeError(ret)
+        elif status == "array":
+            return self.from_shared_memory(*ret)
+        return ret
+
+    def from_shared_memory(self, name, shape, dtype, attrs):
+        if self.shm is None or self.shm.name != name:
+            if self.shm:
+                self.shm.close()
+            self.shm = shared_memory.SharedMemory(name=name)
+        data = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf).copy()
+        return [data, attrs]
+
+    def set_time_offset(self, time_offset):
+        # (also for the driver made when the process is restarted)
+        self.call("__setattr__", "time_offset", time_offset)
+        self.time_offset = time_offset
+        self.constr_params = [time_offset] + self.constr_params[1:]
+
+    def ReadValue(self):
+        # a crashed or hung driver loses this reading, but doesn't stop the device
+        try:
+            return self.call("ReadValue")
+        except DriverProcessError:
             logging.info(traceback.format_exc())
-            err_msg = traceback.format_exc()
-            warning_dict = {
-                    "message" : "exception in " + self.config["name"] + ": " + err_msg,
-                    "exception" : 1,
-                }
-            self.warnings.append([time.time(), warning_dict])
+            return None
+
+    def GetWarnings(self):
+        try:
+            driver_warnings = self.call("GetWarnings")
+        except DriverProcessError:
+            logging.info(traceback.format_exc())
+            driver_warnings = []
+        warnings, self.warnings = self.warnings, []
+        return warnings + (driver_warnings or [])
+
+class DiskMonitor:
+    # Free space on the disk of the HDF file, sampled at most every interval seconds, and the
+    # time until it's full at the rate the HDF file grows (averaged over the last few samples).
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self.time_sampled = 0
+        self.usage = None
+        self.rate = None
+        self.time_to_full = None
+
+        # the HDF file, and its size, at the previous sample
+        self.file = None
+        self.file_size = 0
+
+    def sample(self, hdf_fname, written_fname=None):
+        # returns True if sampled; written_fname is the file the HDF writer is writing to,
+        # if it's running (it changes on rollover)
+        now = time.time()
+        if now - self.time_sampled < self.interval:
+            return False
+
+        # (the HDF file, or even its directory, may not exist yet)
+        path = os.path.dirname(os.path.abspath(hdf_fname))
+        while not os.path.isdir(path) and os.path.dirname(path) != path:
+            path = os.path.dirname(path)
+        try:
+            self.usage = shutil.disk_usage(path)
+        except OSError as err:
+            logging.info(traceback.format_exc())
+            return False
+
+        # the HDF write rate
+        if written_fname:
+            try:
+                size = os.path.getsize(written_fname)
+            except OSError:
+                size = self.file_size if written_fname == self.file else 0
+            if self.file is not None and self.time_sampled:
+                # after a rollover, the new file started empty
+                growth = size - self.file_size if written_fname == self.file else size
+                rate = max(growth, 0) / (now - self.time_sampled)
+                self.rate = rate if self.rate is None else 0.7*self.rate + 0.3*rate
+            self.file, self.file_size = written_fname, size
+        else:
+            self.file, self.rate = None, None
+
+        self.time_to_full = self.usage.free / self.rate if self.rate else None
+        self.time_sampled = now
+        return True
+
+def format_duration(seconds):
+    if seconds >= 2*86400:
+        return "{0:.1f} days".format(seconds/86400)
+    elif seconds >= 2*3600:
+        return "{0:.1f} h".format(seconds/3600)
+    return "{0:.0f} min".format(seconds/60)
 
 class Monitoring(threading.Thread,PyQt5.QtCore.QObject):
-    # signal to update the style of a QWidget
-    # It will be connected to a function in ControlGUI
-    update_style = PyQt5.QtCore.pyqtSignal(qt.QWidget)
+    # Each cycle, Monitoring builds a snapshot of what the GUI should show: a new dict of
+    # (device name, element) -> value, never modified once made. Only the values that changed
+    # since the previous snapshot are sent, with the update_gui signal, to the GUI thread, which
+    # applies them (see ControlGUI.apply_monitoring_update()); the widgets themselves are not
+    # touched from this thread. Elements of the GUI (rather than a device) have device name None.
+    update_gui = PyQt5.QtCore.pyqtSignal(object)
 
     def __init__(self, parent):
         threading.Thread.__init__(self)
@@ -448,26 +2062,32 @@ class Monitoring(threading.Thread,PyQt5.QtCore.QObject):
         self.parent = parent
         self.active = threading.Event()
 
-        # HDF filename at the time run started (in case it's renamed while running)
-        self.hdf_fname = self.parent.config["files"]["hdf_fname"]
-
         self.time_last_monitored = 0
 
+        # when each (device, monitoring command) was last sent (see DeviceConfig.index_indicators())
+        self.time_polled = {}
+
+        # the previous snapshot; the last value of each indicator, and the last data formatted
+        self.snapshot = {}
+        self.indicators = {}
+        self.last_data = {}
+        self.last_warning = None
+
     def run(self):
         while self.active.is_set():
 
+            snapshot = {}
+
             # check amount of remaining free disk space
-            self.parent.ControlGUI.check_free_disk_space()
+            disk_usage = self.parent.ControlGUI.check_free_disk_space()
+            if disk_usage:
+                snapshot[(None, "disk_usage")] = disk_usage
 
             # check that we have written to HDF recently enough
-            HDF_status = self.parent.ControlGUI.HDF_status
             if (time.time() - self.parent.HDF_last_write) > 5.0:
-                HDF_status.setProperty("state", "error")
+                snapshot[(None, "HDF_status")] = "error"
             else:
-                HDF_status.setProperty("state", "enabled")
-
-            # update style
-            self.update_style.emit(HDF_status)
+                snapshot[(None, "HDF_status")] = "enabled"
 
             # monitoring dt
             try:
@@ -479,6 +2099,13 @@ class Monitoring(threading.Thread,PyQt5.QtCore.QObject):
                 logging.info(traceback.format_exc())
                 dt = 0.5
 
+            # how often to report a warning that keeps coming
+            try:
+                warnings_interval = float(self.parent.config["general"].get("warnings_interval", "60"))
+            except ValueError:
+                logging.info(traceback.format_exc())
+                warnings_interval = 60
+
             time.sleep(dt)
 
             # monitor operation of individual devices
@@ -492,78 +2119,140 @@ class Monitoring(threading.Thread,PyQt5.QtCore.QObject):
                     continue
 
                 # check device for abnormal conditions
-                if len(dev.warnings) != 0:
-                    logging.warning("Abnormal condition in " + str(dev_name))
-                    for warning in dev.warnings:
-                        logging.warning(str(warning))
-                    if self.parent.config["influxdb"]["enabled"] in [1, 2, "2", "1", "True", "true"]:
-                        if dev.config["control_params"]["InfluxDB_enabled"]["value"] in [1, 2, "2", "1", "True", "true"]:
-                            self.push_warnings_to_influxdb(dev_name, dev.warnings)
-                    self.parent.ControlGUI.update_warnings(str(dev.warnings[-1]))
-                    dev.warnings = []
-
-                # find out and display the data queue length
-                dev.config["monitoring_GUI_elements"]["qsize"].setText(str(len(dev.data_queue)))
-
-                # get the last event (if any) of the device
-                self.display_last_event(dev)
-
-                # send monitoring commands
-                for c_name, params in dev.config["control_params"].items():
-                    if params.get("type") in ["indicator", "indicator_button", "indicator_lineedit"]:
-                        dev.monitoring_commands.add( params["monitoring_command"] )
-                        # make sure at the end of each monitoring_command, a pair of parenthesis is included
-
-                # obtain monitoring events and update any indicator controls
-                self.display_monitoring_events(dev)
-
-                # get the last row of data from the plots_queue
-                if len(dev.config["plots_queue"]) > 0:
-                    data = dev.config["plots_queue"][-1]
+                self.report_warnings(dev_name, dev.warnings, warnings_interval,
+                        dev.config["control_params"]["InfluxDB_enabled"]["value"] in [1, 2, "2", "1", "True", "true"])
+
+                # send the monitoring commands that are due
+                # (make sure at the end of each monitoring_command, a pair of parenthesis is included)
+                time_now = time.time()
+                with dev.monitoring_lock:
+                    for cmd, ind in dev.config["indicators"].items():
+                        if ind["interval"] and time_now - self.time_polled.get((dev_name, cmd), 0) < ind["interval"]:
+                            continue
+                        self.time_polled[(dev_name, cmd)] = time_now
+                        dev.monitoring_commands.add(cmd)
+                    due = bool(dev.monitoring_commands)
+                if due:
+                    dev.wake()
+
+                # obtain monitoring events, for the indicator controls
+                self.update_indicators(dev)
+                for ind in dev.config["indicators"].values():
+                    for c_name in ind["controls"]:
+                        value = self.indicators.get((dev_name, c_name))
+                        if value is None:
+                            continue
+                        # (an indicator_lineedit being edited is left alone; leaving it out of the
+                        # snapshot makes it count as changed once the editing is done)
+                        if dev.config["control_params"][c_name]["type"] == "indicator_lineedit" and \
+                                dev.config["control_GUI_elements"][c_name]["currently_editing"]:
+                            continue
+                        snapshot[(dev_name, c_name)] = value
+
+                # the rest is shown in the monitoring frames, if they're not hidden
+                if self.parent.config["monitoring_visible"]:
+                    self.monitoring_snapshot(dev, snapshot)
+
+            # warnings about the disk of the HDF file (see ControlGUI.check_free_disk_space())
+            self.report_warnings("disk", self.parent.ControlGUI.disk_warnings, warnings_interval, True)
+
+            if self.last_warning:
+                snapshot[(None, "warnings")] = self.last_warning
+
+            # send what changed to the GUI thread
+            changes = {key: val for key, val in snapshot.items() if self.snapshot.get(key) != val}
+            self.snapshot = snapshot
+            if changes:
+                self.update_gui.emit(changes)
+
+    def report_warnings(self, name, channel, warnings_interval, influxdb_enabled):
+        # a warning that keeps coming is reported (logged, and pushed to InfluxDB) at most
+        # every warnings_interval (see WarningChannel)
+        warnings = channel.drain()
+        if not warnings:
+            return
+        to_report = []
+        for entry in warnings:
+            if channel.due(entry, warnings_interval):
+                message = channel.describe(entry)
+                logging.warning("Abnormal condition in " + str(name) + ": " + message)
+                to_report.append([entry["last_seen"] - self.parent.config["time_offset"], message])
+        if to_report and influxdb_enabled and self.parent.config["influxdb"]["enabled"] in [1, 2, "2", "1", "True", "true"]:
+            self.push_warnings_to_influxdb(name, to_report)
+        entry = warnings[-1]
+        self.last_warning = "{0}: {1}{2}".format(name, entry["message"],
+                " (x{0})".format(entry["count"]) if entry["count"] > 1 else "")
+
+    def monitoring_snapshot(self, dev, snapshot):
+        dev_name = dev.config["name"]
+
+        # the data queue length
+        snapshot[(dev_name, "qsize")] = "{0} ({1:.1f} MB), max {2}".format(
+                dev.qsize(), dev.queue_bytes/1024/1024, dev.data_queue.high_watermark)
+
+        # time it took the last data to get written, and how much was dropped
+        if dev.hdf_flush_latency is None:
+            flush_text = "N/A"
+        else:
+            flush_text = "{0:.2f} s".format(dev.hdf_flush_latency)
+        if dev.data_queue.dropped:
+            flush_text += ", {0} dropped".format(dev.data_queue.dropped)
+        snapshot[(dev_name, "hdf_flush")] = flush_text
+
+        # where the time goes in the control loop
+        if dev.timing:
+            snapshot[(dev_name, "timing")] = dev.timing_summary()
+
+        # the last event (if any) of the device
+        snapshot[(dev_name, "events")] = self.last_event_text(dev)
+
+        # the last row of data from the data queue, formatted only when it's new
+        data = dev.data_queue.latest(1)
+        data = data[-1] if data else None
+        if isinstance(data, list):
+            last = self.last_data.get(dev_name)
+            if last and last[0] is data:
+                snapshot[(dev_name, "data")] = last[1]
+                return
+            try:
+                if dev.config["slow_data"]:
+                    formatted_data = ["{0:.3e}".format(x) if not isinstance(x,str) else x for x in data]
                 else:
-                    data = None
-
-                # format the data
-                if isinstance(data, list):
-                    try:
-                        if dev.config["slow_data"]:
-                            formatted_data = [np.format_float_scientific(x, precision=3) if not isinstance(x,str) else x for x in data]
-                        else:
-                            formatted_data = [np.format_float_scientific(x, precision=3) for x in data[0][-1,:,-1]]
-                            # data[0] is assumed to be a 3-dim np array: # of records, # of channels, # of samples in each record from each channel
-                            # such notation ([0,:,-1]) only works for np.array, not python native list
-                    except TypeError as err:
-                        logging.warning("Warning in Monitoring: " + str(err))
-                        logging.warning(traceback.format_exc())
-                        continue
-                    dev.config["monitoring_GUI_elements"]["data"].setText("\n".join(formatted_data))
+                    formatted_data = ["{0:.3e}".format(x) for x in data[0][-1,:,-1]]
+                    # data[0] is assumed to be a 3-dim np array: # of records, # of channels, # of samples in each record from each channel
+                    # such notation ([0,:,-1]) only works for np.array, not python native list
+            except (TypeError, ValueError) as err:
+                logging.warning("Warning in Monitoring: " + str(err))
+                logging.warning(traceback.format_exc())
+                return
+            self.last_data[dev_name] = (data, "\n".join(formatted_data))
+            snapshot[(dev_name, "data")] = self.last_data[dev_name][1]
+        elif (dev_name, "data") in self.snapshot:
+            snapshot[(dev_name, "data")] = self.snapshot[(dev_name, "data")]
 
-    def display_monitoring_events(self, dev):
-        # check device enabled
-        if not dev.config["control_params"]["enabled"]["value"] == 2:
-            return
+    def update_indicators(self, dev):
+        # the values of the indicator controls of the device, from its monitoring events: for
+        # indicator, [text, state]; for indicator_button, [text, checked, state]; for
+        # indicator_lineedit, its text
 
-        # empty the monitoring events queue
-        monitoring_events = []
+        # the monitoring events, oldest first
         while len(dev.monitoring_events_queue) > 0:
-            monitoring_events.append( dev.monitoring_events_queue.pop() )
-
-        # check any events were returned
-        if not monitoring_events:
-            return
-
-        for c_name, params in dev.config["control_params"].items():
-            # check we're dealing with indicator controls
-            if not params.get("type") in ["indicator", "indicator_button", "indicator_lineedit"]:
+            event = dev.monitoring_events_queue.popleft()
+            ind = dev.config["indicators"].get(event[1])
+            if not ind:
                 continue
 
-            # check the returned events
-            for event in monitoring_events:
-                # skip event if it's related to a different command
-                if not params["monitoring_command"] == event[1]:
-                    continue
-                # check if there's any matching return value
-                if params.get("type") in ["indicator_button"]:
+            for c_name in ind["controls"]:
+                params = dev.config["control_params"][c_name]
+                if params.get("type") == "indicator":
+                    if event[2][1] in params.get("states"):
+                        value = (event[2][0], event[2][1])
+                    else:
+                        logging.warning("device "+dev.config['name']+" ["+c_name+"] doesn't have state: "+event[2][1])
+                        value = (event[2][0], None)
+
+                elif params.get("type") == "indicator_button":
+                    # check if there's any matching return value
                     try:
                         if event[2] in params["return_values"]:
                             idx = params["return_values"].index(event[2])
@@ -572,61 +2261,26 @@ class Monitoring(threading.Thread,PyQt5.QtCore.QObject):
                     except ValueError:
                         logging.info(traceback.format_exc())
                         idx = -2
-
-                # update indicator text and style if necessary
-
-                if params.get("type") == "indicator":
-                    ind = dev.config["control_GUI_elements"][c_name]["QLabel"]
-                    if ind.text() != event[2][0]:
-                        ind.setText(event[2][0])
-                    if event[2][1] in params.get("states"):
-                        ind.setProperty("state", event[2][1])
-                        self.update_style.emit(ind)
-                    else:
-                        logging.warning("device "+dev.config['name']+" ["+c_name+"] doesn't have state: "+event[2][1])
-
-                elif params.get("type") == "indicator_button":
-                    ind = dev.config["control_GUI_elements"][c_name]["QPushButton"]
-                    if ind.text() != params["texts"][idx]:
-                        ind.setText(params["texts"][idx])
-                        ind.setChecked(params["checked"][idx])
-                        ind.setProperty("state", params["states"][idx])
-                        self.update_style.emit(ind)
+                    value = (params["texts"][idx], params["checked"][idx], params["states"][idx])
 
                 elif params.get("type") == "indicator_lineedit":
-                    if not dev.config["control_GUI_elements"][c_name]["currently_editing"]:
-                        ind = dev.config["control_GUI_elements"][c_name]["QLineEdit"]
-                        ind.setText(str(event[2]))
-                        # setText itself would emit a signal, so no need to call update_style
-
-    def display_last_event(self, dev):
-        # check device enabled for reading
-        if not dev.config["control_params"]["enabled"]["value"] == 2:
-            return
+                    value = str(event[2])
 
-        # if HDF writing enabled for this device, get events from the HDF file
+                self.indicators[(dev.config["name"], c_name)] = value
+
+    def last_event_text(self, dev):
+        # if HDF writing enabled for this device, the last event written to HDF, otherwise
+        # the last event of the device (the HDF file itself isn't read here, since the writer
+        # holds it, and reading it for each device on every cycle adds up)
         if dev.config["control_params"]["HDF_enabled"]["value"]:
-            with h5py.File(self.hdf_fname, 'r') as f:
-                grp = f[self.parent.run_name + "/" + dev.config["hdf_group"]]
-                events_dset = grp[dev.config["name"] + "_events"]
-                if events_dset.shape[0] == 0:
-                    dev.config["monitoring_GUI_elements"]["events"].setText("(no event)")
-                    return
-                else:
-                    last_event = events_dset[-1]
-                    # print(", ".join(last_event))
-                    dev.config["monitoring_GUI_elements"]["events"].setText(", ".join(last_event))
-                    return last_event
+            last_event = dev.last_written_event
+        else:
+            last_event = dev.last_event
 
-        # if HDF writing not enabled for this device, get events from the events_queue
+        if not last_event:
+            return "(no event)"
         else:
-            try:
-                last_event = dev.events_queue.pop()
-                dev.config["monitoring_GUI_elements"]["events"].setText(", ".join(last_event))
-                return last_event
-            except IndexError:
-                logging.info(traceback.format_exc())
-                return
+            return format_event(last_event)
 
     def push_warnings_to_influxdb(self, dev_name, warning_list):
         record = []
@@ -655,90 +2309,608 @@ class HDF_writer(threading.Thread):
         # self.parent.run_name = str(int(time.time())) + " " + self.parent.config["general"]["run_name"]
         self.parent.run_name = current_time_str + " " + self.parent.config["general"]["run_name"]
 
-        # create/open HDF file, groups, and datasets
-        with h5py.File(self.filename, "a") as f:
-            root = f.create_group(self.parent.run_name)
+        # whether to write the HDF file from a separate process (see HDF_writer_process)
+        self.process = self.parent.config["general"].get("hdf_writer_process", "False") in ["1", "True", "true"]
+
+        # whether to write in single-writer/multiple-reader (SWMR) mode
+        # (always tried with the HDF writer process, otherwise the file can't be read while it's written;
+        # SWMR mode isn't possible with fast devices in the records layout, so with the writer process
+        # the Plotter can only read the file after the run if there are any, see start_swmr())
+        self.swmr = self.parent.config["general"].get("hdf_swmr", "False") in ["1", "True", "true"] or self.process
+
+        # whether to write data to spool files first, which are merged into the HDF file by
+        # HDF_spool_merger (see SpoolFile)
+        self.spool = self.parent.config["general"].get("hdf_spool", "False") in ["1", "True", "true"]
+        if self.spool and self.process:
+            logging.warning("HDF_writer warning: hdf_spool is not used with hdf_writer_process.")
+            self.spool = False
+
+        # strings already written to each device's events strings table (see write_events())
+        self.events_strings = {}
+
+        # state of the write schedule (see run() and write_due())
+        self.time_last_cycle = 0
+        self.time_last_flush = time.time()
+        self.unflushed = False
+        self.drained = {}
+
+        # back-pressure: at most data_queue_size records per device wait for HDF_writer, and
+        # data_queue_policy decides what to do when there are more: make the device wait for
+        # at most data_queue_timeout seconds ("block"), or drop records ("drop-oldest",
+        # "drop-newest"); the queues also hold the records plotted (see DataQueue)
+        for key in ["hdf_backpressure", "hdf_max_backlog", "hdf_backpressure_timeout"]:
+            if key in self.parent.config["general"]:
+                logging.warning("HDF_writer warning: {0} is no longer used, see data_queue_size, "
+                                "data_queue_policy and data_queue_timeout.".format(key))
+        policy = self.parent.config["general"].get("data_queue_policy", "drop-oldest")
+        if policy not in DataQueue.policies:
+            logging.warning("HDF_writer warning: invalid data_queue_policy {0}, using drop-oldest.".format(policy))
+            policy = "drop-oldest"
+        max_backlog = int(self.float_option("data_queue_size", 10000))
+        for dev_name, dev in self.parent.devices.items():
+            dev.hdf_flush_latency = None
+            dev.data_queue = DataQueue(max(max_backlog, dev.config["plots_queue_maxlen"]), policy,
+                                       self.float_option("data_queue_timeout", 1.0),
+                                       keep=dev.config["plots_queue_maxlen"], max_backlog=max_backlog,
+                                       on_release=None if dev.config["slow_data"] else dev.release_data)
+
+        # the runs are listed in an index next to hdf_fname, and can be spread over several
+        # files when hdf_rollover_MB or hdf_rollover_hours are set (see RunIndex); a new index
+        # is made from the runs in hdf_fname here, before this run's group is created
+        self.run_index = RunIndex(self.parent.config["files"]["hdf_fname"])
+        self.run_index.open()
+        self.filename = self.choose_file()
+
+        # create/open HDF file, groups, and datasets
+        # the file is kept open until the run stops, and is shared with readers through self.parent.hdf_file
+        self.hdf_file = h5py.File(self.filename, "a", libver="latest" if self.swmr else None)
+        self.create_run_group(self.hdf_file)
+        self.run_index.add(self.parent.run_name, self.filename, time.time())
+
+        # the HDF writer process opens the file itself
+        if self.process:
+            self.hdf_file.close()
+            self.setup_process()
+            self.active.set()
+            return
+
+        # SWMR mode can only be started once all groups, datasets and attributes have been created
+        if self.swmr:
+            self.start_swmr()
+
+        if self.spool:
+            self.setup_spool()
+
+        with self.parent.hdf_file_lock:
+            self.parent.hdf_file = self.hdf_file
+
+        self.active.set()
+
+    def create_run_group(self, f):
+        root = f.create_group(self.parent.run_name)
+
+        # write run attributes
+        root.attrs["time_offset"] = self.parent.config["time_offset"]
+        for key, val in self.parent.config["run_attributes"].items():
+            root.attrs[key] = val
+
+        for dev_name, dev in self.parent.devices.items():
+            # check device is enabled
+            if dev.config["control_params"]["enabled"]["value"] < 2:
+                continue
+
+            if not dev.config["control_params"]["HDF_enabled"]:
+                continue
+
+            grp = root.require_group(dev.config["hdf_group"])
+
+            # fast devices either create a new dataset for each acquisition ("records" layout),
+            # or append all acquisitions to a single extendable dataset ("consolidated" layout)
+            dev.hdf_layout = dev.config["hdf_layout"]
+            if dev.hdf_layout == "consolidated" and dev.config["compound_dataset"]:
+                logging.warning("HDF_writer warning: device {0} has a compound dataset, using records layout.".format(dev_name))
+                dev.hdf_layout = "records"
+
+            # create dataset for data if only one is needed
+            if dev.config["compound_dataset"]:
+                dev.dset_dtype = np.dtype([(name.strip(), dtype) for name, dtype in
+                                         zip(dev.config["attributes"]["column_names"].split(','),
+                                         dev.config["dtype"])])
+                # 'str' data type will  be converted to '<U', which is not supported by h5py
+            else:
+                dev.dset_dtype = np.dtype([(name.strip(), dev.config["dtype"]) for name in
+                                         dev.config["attributes"]["column_names"].split(',')])
+
+            if dev.config["slow_data"]:
+                dset = grp.create_dataset(
+                        dev.config["name"],
+                        (0,),
+                        maxshape=(None,),
+                        dtype=dev.dset_dtype
+                    )
+                for attr_name, attr in dev.config["attributes"].items():
+                    dset.attrs[attr_name] = attr
+            else:
+                for attr_name, attr in dev.config["attributes"].items():
+                    grp.attrs[attr_name] = attr
+                if dev.hdf_layout == "consolidated":
+                    create_consolidated_datasets(grp, dev_name, self.consolidated_spec(dev))
+
+            # create datasets for events
+            create_events_datasets(grp, dev.config["name"])
+
+    def rollover_limits(self):
+        # file size [MB] and age [hours] after which a new file is started (0: no limit)
+        limits = []
+        for key in ["hdf_rollover_MB", "hdf_rollover_hours"]:
+            try:
+                limits.append(float(self.parent.config["files"].get(key, "0") or 0))
+            except ValueError:
+                logging.warning("HDF_writer warning: invalid {0}.".format(key))
+                logging.info(traceback.format_exc())
+                limits.append(0)
+        return limits
+
+    def rollover_due(self, fname):
+        max_MB, max_hours = self.rollover_limits()
+        if max_MB and os.path.getsize(fname) >= max_MB*1024*1024:
+            return True
+        if max_hours:
+            time_start = self.run_index.file_start(fname)
+            if time_start and time.time() - time_start >= max_hours*3600:
+                return True
+        return False
+
+    def choose_file(self):
+        # without rollover, all runs go to hdf_fname; with rollover, to the latest file,
+        # unless it is over the limits
+        if not any(self.rollover_limits()):
+            return self.run_index.hdf_fname
+        fname = self.run_index.latest_file()
+        if fname and os.path.exists(fname) and not self.rollover_due(fname):
+            return fname
+        return self.new_file_name()
+
+    def new_file_name(self):
+        # e.g. data/data_example.hdf -> data/data_example_20200101_120000.hdf
+        stem, ext = os.path.splitext(self.run_index.hdf_fname)
+        fname = stem + time.strftime("_%Y%m%d_%H%M%S", time.localtime()) + ext
+        i = 1
+        while os.path.exists(fname):
+            fname = stem + time.strftime("_%Y%m%d_%H%M%S", time.localtime()) + "_{0}".format(i) + ext
+            i += 1
+        return fname
+
+    def check_rollover(self):
+        # continue the run in a new file if the current one is over the limits
+        if not any(self.rollover_limits()) or not self.rollover_due(self.filename):
+            return
+
+        old_fname, fname = self.filename, self.new_file_name()
+        new_file = h5py.File(fname, "a", libver="latest" if self.swmr else None)
+        self.create_run_group(new_file)
+
+        self.dedup_record_attrs(self.hdf_file)
+        old_file, self.hdf_file, self.filename = self.hdf_file, new_file, fname
+        if self.swmr:
+            self.start_swmr()
+        with self.parent.hdf_file_lock:
+            self.parent.hdf_file = self.hdf_file
+            old_file.close()
+
+        # the new file has its own events strings tables, and nothing to flush yet
+        self.events_strings = {}
+        self.unflushed = False
+
+        time_now = time.time()
+        self.run_index.stop(self.parent.run_name, old_fname, time_now)
+        self.run_index.add(self.parent.run_name, fname, time_now)
+        logging.warning("HDF_writer: run continues in new file {0}.".format(fname))
+
+    def setup_process(self):
+        # size of the shared memory ring buffer of each device
+        try:
+            ring_bytes = float(self.parent.config["general"].get("hdf_ring_size_MB", "64")) * 1024*1024
+        except ValueError:
+            logging.info(traceback.format_exc())
+            ring_bytes = 64 * 1024*1024
+
+        spec = {
+                "filename"        : self.filename,
+                "run_name"        : self.parent.run_name,
+                "time_offset"     : self.parent.config["time_offset"],
+                "swmr"            : self.swmr,
+                "hdf_loop_delay"  : self.parent.config["general"]["hdf_loop_delay"],
+                "hdf_flush_delay" : self.parent.config["general"].get("hdf_flush_delay", "2.0"),
+                "influxdb"        : dict(self.parent.config["influxdb"]),
+                "devices"         : {},
+            }
+
+        for dev_name, dev in self.parent.devices.items():
+            if dev.config["control_params"]["enabled"]["value"] < 2:
+                continue
+
+            ring_dtype = self.record_dtype(dev)
+            dev.hdf_ring = SharedRingBuffer(ring_dtype, capacity=max(16, int(ring_bytes // ring_dtype.itemsize)))
+
+            spec["devices"][dev_name] = {
+                    "hdf_group"        : dev.config["hdf_group"],
+                    "slow_data"        : dev.config["slow_data"],
+                    "hdf_layout"       : dev.hdf_layout,
+                    "dset_dtype"       : dev.dset_dtype,
+                    "col_names"        : split(dev.config["attributes"]["column_names"]),
+                    "HDF_enabled"      : bool(dev.config["control_params"]["HDF_enabled"]["value"]),
+                    "InfluxDB_enabled" : dev.config["control_params"]["InfluxDB_enabled"]["value"] in [1, 2, "1", "2", "True", "true"],
+                    "ring"             : dev.hdf_ring.spec(),
+                }
+
+        self.process_writer = HDF_writer_process(spec)
+
+    def record_dtype(self, dev):
+        # dtype of the records passed through shared memory or spool files
+        # slow data: one row of the device's dataset per record
+        # fast data: time, attributes, number of samples and a (# of channels, # of samples) array
+        # per record; records are passed as raw bytes, so the attributes (JSON) and the number of
+        # samples have a fixed maximum size, checked in Device.to_records(). Devices that change
+        # their number of samples during a run can be given room for more with hdf_max_samples.
+        if dev.config["slow_data"]:
+            return dev.dset_dtype
+        n_ch = len(split(dev.config["attributes"]["column_names"]))
+        n_samp = int(dev.config["shape"][-1]) if dev.config["shape"] else 1
+        try:
+            n_samp = max(n_samp, int(self.parent.config["general"].get("hdf_max_samples", "0")))
+        except ValueError:
+            logging.warning("HDF_writer warning: invalid hdf_max_samples.")
+            logging.info(traceback.format_exc())
+        return np.dtype([
+                ("time", "f8"),
+                ("attrs", "S2048"),
+                ("n_samp", "i4"),
+                ("data", dev.config["dtype"], (n_ch, n_samp)),
+            ])
+
+    def setup_spool(self):
+        # the spool files of a run go to hdf_spool_dir, by default a directory next to the HDF file
+        spool_dir = self.parent.config["general"].get("hdf_spool_dir", "")
+        if not spool_dir:
+            spool_dir = os.path.splitext(self.filename)[0] + "_spool"
+        os.makedirs(spool_dir, exist_ok=True)
+
+        self.spools = {}
+        for dev_name, dev in self.parent.devices.items():
+            if dev.config["control_params"]["enabled"]["value"] < 2:
+                continue
+            if not dev.config["control_params"]["HDF_enabled"]["value"]:
+                continue
+
+            meta = {
+                    "hdf_fname"   : os.path.abspath(self.filename),
+                    "hdf_index"   : os.path.abspath(self.run_index.hdf_fname),
+                    "run_name"    : self.parent.run_name,
+                    "time_offset" : self.parent.config["time_offset"],
+                    "dev_name"    : dev_name,
+                    "hdf_group"   : dev.config["hdf_group"],
+                    "slow_data"   : dev.config["slow_data"],
+                    "hdf_layout"  : dev.hdf_layout,
+                    "dset_dtype"  : dev.dset_dtype,
+                    "dtype"       : self.record_dtype(dev),
+                    "attributes"  : dict(dev.config["attributes"]),
+                }
+            if not dev.config["slow_data"] and dev.hdf_layout == "consolidated":
+                meta["consolidated"] = self.consolidated_spec(dev)
+            fname = os.path.join(spool_dir, "{0} {1}.spool".format(self.parent.run_name, dev_name))
+            self.spools[dev_name] = SpoolFile(fname, meta)
+
+        self.spool_merger = HDF_spool_merger(self)
+
+    def sync_spools(self, force=False):
+        # spooled records are handed to the OS every loop, and forced to disk on schedule
+        try:
+            dt = float(self.parent.config["general"].get("hdf_spool_fsync_delay", "1.0"))
+        except ValueError:
+            logging.info(traceback.format_exc())
+            dt = 1.0
+
+        fsync = force or (time.time() - self.time_last_fsync >= dt)
+        for spool in self.spools.values():
+            spool.fsync() if fsync else spool.sync()
+        if fsync:
+            self.time_last_fsync = time.time()
+
+    def stop_spool(self):
+        # merge what is left, then remove the spool files, unless something could not be merged
+        self.spool_merger.active.clear()
+        self.spool_merger.join()
+        for dev_name, spool in self.spools.items():
+            spool.close()
+            if self.spool_merger.offsets.get(dev_name, spool.data_start) == os.path.getsize(spool.fname):
+                spool.remove()
+            else:
+                logging.warning("HDF_writer warning: spool file {0} not fully merged, use recover_spool.py.".format(spool.fname))
+
+    def run_process(self):
+        self.process_writer.start()
+        self.parent.HDF_last_write = time.time()
+
+        while self.active.is_set():
+            self.forward_events()
+            self.update_process_status()
+
+            # loop delay
+            try:
+                dt = float(self.parent.config["general"]["hdf_loop_delay"])
+                if dt < 0.02:
+                    logging.warning("HDF writter dt too small.")
+                    raise ValueError
+            except Exception:
+                logging.info(traceback.format_exc())
+                dt = 0.5
+
+            time.sleep(dt)
 
-            # write run attributes
-            root.attrs["time_offset"] = self.parent.config["time_offset"]
-            for key, val in self.parent.config["run_attributes"].items():
-                root.attrs[key] = val
+        # let the process write everything that is left, then release the shared memory
+        self.forward_events()
+        self.process_writer.active.clear()
+        self.process_writer.join()
+        self.update_process_status()
+        self.run_index.stop(self.parent.run_name, self.filename, time.time())
+        self.run_index.close()
 
-            for dev_name, dev in self.parent.devices.items():
-                # check device is enabled
-                if dev.config["control_params"]["enabled"]["value"] < 2:
-                    continue
+        for dev_name, dev in self.parent.devices.items():
+            ring, dev.hdf_ring = dev.hdf_ring, None
+            if ring is None:
+                continue
+            if ring.dropped():
+                logging.warning("HDF_writer warning: {0} records of {1} were dropped (ring buffer full).".format(ring.dropped(), dev_name))
+            try:
+                ring.close()
+            except BufferError:
+                # still in use by the device thread; freed when the thread lets go of it
+                logging.info(traceback.format_exc())
 
-                if not dev.config["control_params"]["HDF_enabled"]:
-                    continue
+    def forward_events(self):
+        # events are a few short strings, so they are simply pickled over to the HDF writer process;
+        # only devices in its spec have datasets to write them to (see setup_process())
+        for dev_name, dev in self.parent.devices.items():
+            if not dev.control_started:
+                continue
+            events = self.get_data(dev.events_queue)
+            if dev_name not in self.process_writer.spec["devices"]:
+                continue
+            if events and dev.config["control_params"]["HDF_enabled"]["value"]:
+                self.process_writer.events_queue.put((dev_name, events))
+                dev.last_written_event = events[-1]
+
+    def update_process_status(self):
+        # get the latest status reported by the HDF writer process
+        status = None
+        while True:
+            try:
+                status = self.process_writer.status_queue.get_nowait()
+            except queue.Empty:
+                break
+
+        if status:
+            if status["error"]:
+                logging.warning("HDF_writer_process warning: " + status["error"])
+            self.parent.HDF_last_write = status["time"]
+            time_string = time.strftime("%Y-%m-%d  %H:%M:%S.", time.localtime(status["time"]))
+            time_string += "{:03.0f}".format((status["time"]%1)*1000)
+            self.parent.ControlGUI.HDF_status.setText(time_string)
+        elif not self.process_writer.is_alive() and self.process_writer.exitcode != 0:
+            # report only once
+            if self.parent.ControlGUI.HDF_status.text() != "HDF writer process stopped":
+                logging.error("HDF_writer error: the HDF writer process has stopped (exit code {0}).".format(self.process_writer.exitcode))
+                self.parent.ControlGUI.HDF_status.setText("HDF writer process stopped")
+
+    def consolidated_spec(self, dev):
+        # what create_consolidated_datasets() needs to know about a device (also kept in the
+        # metadata of spool files, so recovered datasets are made the same way)
+        return {
+                "dtype"                : np.dtype(dev.config["dtype"]).str,
+                "n_ch"                 : len(split(dev.config["attributes"]["column_names"])),
+                "n_samp"               : int(dev.config["shape"][-1]) if dev.config["shape"] else 1,
+                "attributes"           : dict(dev.config["attributes"]),
+                "hdf_chunk_shape"      : list(dev.config["hdf_chunk_shape"]),
+                "hdf_compression"      : dev.config["hdf_compression"],
+                "hdf_compression_opts" : dev.config["hdf_compression_opts"],
+            }
 
-                grp = root.require_group(dev.config["hdf_group"])
+    def start_swmr(self):
+        # fast devices using the records layout create a new dataset for each record,
+        # which is not allowed in SWMR mode
+        for dev_name, dev in self.parent.devices.items():
+            if dev.config["control_params"]["enabled"]["value"] < 2:
+                continue
+            if dev.config["control_params"]["HDF_enabled"]["value"] and dev.hdf_layout == "records" \
+                    and not dev.config["slow_data"]:
+                logging.warning("HDF_writer warning: SWMR mode not started, device {0} writes a new dataset for each record.".format(dev_name))
+                return
 
-                # create dataset for data if only one is needed
-                # (fast devices create a new dataset for each acquisition)
-                if dev.config["compound_dataset"]:
-                    dev.dset_dtype = np.dtype([(name.strip(), dtype) for name, dtype in
-                                             zip(dev.config["attributes"]["column_names"].split(','),
-                                             dev.config["dtype"])])
-                    # 'str' data type will  be converted to '<U', which is not supported by h5py
-                else:
-                    dev.dset_dtype = np.dtype([(name.strip(), dev.config["dtype"]) for name in
-                                             dev.config["attributes"]["column_names"].split(',')])
+        try:
+            self.hdf_file.swmr_mode = True
+        except (RuntimeError, ValueError) as err:
+            # e.g. the file was created by an older HDF5 version and has an old superblock
+            logging.warning("HDF_writer warning: cannot start SWMR mode: {0}".format(err))
+            logging.info(traceback.format_exc())
 
-                if dev.config["slow_data"]:
-                    dset = grp.create_dataset(
-                            dev.config["name"],
-                            (0,),
-                            maxshape=(None,),
-                            dtype=dev.dset_dtype
-                        )
-                    for attr_name, attr in dev.config["attributes"].items():
-                        dset.attrs[attr_name] = attr
-                else:
-                    for attr_name, attr in dev.config["attributes"].items():
-                        grp.attrs[attr_name] = attr
+    def flush(self):
+        # flush the HDF file to disk on schedule, instead of closing and reopening it every loop
+        try:
+            dt = float(self.parent.config["general"].get("hdf_flush_delay", "2.0"))
+        except ValueError:
+            logging.info(traceback.format_exc())
+            dt = 2.0
+
+        # nothing to flush if nothing was written since the last flush
+        if self.unflushed and time.time() - self.time_last_flush >= dt:
+            self.hdf_file.flush()
+            self.time_last_flush = time.time()
+            self.unflushed = False
+
+    def dedup_record_attrs(self, f):
+        # see dedup_record_attrs(); can't be done in SWMR mode, but records layout devices
+        # don't use SWMR mode anyway
+        if f.swmr_mode:
+            return
+        for dev_name, dev in self.parent.devices.items():
+            if dev.config["control_params"]["enabled"]["value"] < 2 or not dev.config["control_params"]["HDF_enabled"]["value"]:
+                continue
+            if dev.config["slow_data"] or dev.hdf_layout != "records":
+                continue
+            try:
+                dedup_record_attrs(f[self.parent.run_name][dev.config["hdf_group"]], dev_name)
+            except (KeyError, OSError, ValueError) as err:
+                logging.warning("HDF_writer warning: cannot deduplicate record attributes of {0}: {1}".format(dev_name, err))
+                logging.info(traceback.format_exc())
+
+    def write_device_stats(self):
+        # timing statistics of each device (ReadValue() schedule, see
+        # Device.schedule_next_read(), and the control loop, see Device.record_time()), as
+        # attributes of the device's group in the run; written once the devices have stopped,
+        # and after the file is closed, since attributes can't be added in SWMR mode
+        try:
+            with h5py.File(self.filename, "a") as f:
+                root = f[self.parent.run_name]
+                for dev_name, dev in self.parent.devices.items():
+                    if dev.config["hdf_group"] not in root:
+                        continue
+                    attrs = root[dev.config["hdf_group"]].attrs
+                    if dev.read_jitter.total:
+                        attrs["read_dt"] = dev.read_dt
+                        attrs["read_count"] = dev.read_jitter.total
+                        attrs["read_missed_slots"] = dev.missed_slots
+                        dev.read_jitter.write_attrs(attrs, "read_jitter")
+                        dev.read_overrun.write_attrs(attrs, "read_overrun")
+                    for section, hist in dev.timing.items():
+                        hist.write_attrs(attrs, "timing_" + section.replace(" ", "_").replace("()", ""))
+        except (OSError, KeyError, ValueError) as err:
+            logging.warning("HDF_writer warning: cannot write device timing statistics: {0}".format(err))
+            logging.info(traceback.format_exc())
 
-                # create dataset for events
-                events_dset = grp.create_dataset(dev.config["name"]+"_events", (0,3),
-                        maxshape=(None,3), dtype=h5py.special_dtype(vlen=str))
+    def close(self):
+        self.dedup_record_attrs(self.hdf_file)
 
-        self.active.set()
+        # stop sharing the handle with readers before closing the file
+        with self.parent.hdf_file_lock:
+            self.parent.hdf_file = None
+            self.hdf_file.close()
+        self.run_index.stop(self.parent.run_name, self.filename, time.time())
+        self.run_index.close()
 
     def run(self):
+        if self.process:
+            self.run_process()
+            return
+
+        self.time_last_flush = time.time()
+        if self.spool:
+            self.time_last_fsync = time.time()
+            self.spool_merger.start()
+
         while self.active.is_set():
-            # update the label that shows the time this loop last ran
-            self.parent.HDF_last_write = time.time()
-            time_string = time.strftime("%Y-%m-%d  %H:%M:%S.", time.localtime(self.parent.HDF_last_write))
-            time_string += "{:03.0f}".format((self.parent.HDF_last_write%1)*1000)
-            self.parent.ControlGUI.HDF_status.setText(time_string)
+            # write when a device has enough data waiting or its oldest record has waited too long;
+            # otherwise only check in every hdf_max_latency to show the writer is alive
+            write = self.write_due()
+            if write or (time.time() - self.time_last_cycle >= self.max_latency()):
+                self.time_last_cycle = time.time()
+
+                # update the label that shows the time this loop last ran
+                self.parent.HDF_last_write = time.time()
+                time_string = time.strftime("%Y-%m-%d  %H:%M:%S.", time.localtime(self.parent.HDF_last_write))
+                time_string += "{:03.0f}".format((self.parent.HDF_last_write%1)*1000)
+                self.parent.ControlGUI.HDF_status.setText(time_string)
+
+                # empty queues to HDF and InfluxDB
+                try:
+                    if self.spool:
+                        if write:
+                            self.write_queues_to_spool()
+                        self.sync_spools()
+                    else:
+                        if write:
+                            self.write_queues_to_HDF_InfluxDB(self.hdf_file)
+                            self.unflushed = True
+                        self.flush()
+                        self.check_rollover()
+                except OSError as err:
+                    logging.warning("HDF_writer warning: {0}".format(err))
+                    logging.info(traceback.format_exc())
 
-            # empty queues to HDF and InfluxDB
-            try:
-                with h5py.File(self.filename, "r+") as fname:
-                    self.write_queues_to_HDF_InfluxDB(fname)
-            except OSError as err:
-                logging.warning("HDF_writer warning: {0}".format(err))
-                logging.info(traceback.format_exc())
+                # time from queueing the oldest record of each device to having it written
+                for dev_name, time_queued in self.drained.items():
+                    self.parent.devices[dev_name].hdf_flush_latency = time.time() - time_queued
+                self.drained = {}
 
-            # loop delay
+            # polling delay
             try:
-                dt = float(self.parent.config["general"]["hdf_loop_delay"])
-                if dt < 0.02:
-                    logging.warning("HDF writter dt too small.")
+                dt = float(self.parent.config["general"].get("hdf_poll_delay", "0.05"))
+                if dt < 0.01:
+                    logging.warning("HDF writter poll delay too small.")
                     raise ValueError
             except Exception:
                 logging.info(traceback.format_exc())
-                dt = 0.5
+                dt = 0.05
 
             time.sleep(dt)
 
         # make sure everything is written to HDF and InfluxDB when the thread terminates
         try:
-            with h5py.File(self.filename, "r+") as fname:
-                self.write_queues_to_HDF_InfluxDB(fname)
+            if self.spool:
+                self.write_queues_to_spool()
+                self.sync_spools(force=True)
+                self.stop_spool()
+            else:
+                self.write_queues_to_HDF_InfluxDB(self.hdf_file)
         except OSError as err:
-            logging.warning("HDF_writer warning: ", err)
+            logging.warning("HDF_writer warning: {0}".format(err))
             logging.warning(traceback.format_exc())
+        finally:
+            self.close()
+
+    def float_option(self, key, default):
+        try:
+            return float(self.parent.config["general"].get(key, str(default)))
+        except ValueError:
+            logging.warning("HDF_writer warning: invalid {0}, using {1}.".format(key, default))
+            logging.info(traceback.format_exc())
+            return default
+
+    def max_latency(self):
+        # the longest time a record waits to be written; hdf_loop_delay if not given
+        try:
+            dt = float(self.parent.config["general"].get("hdf_max_latency", self.parent.config["general"]["hdf_loop_delay"]))
+            if dt < 0.02:
+                logging.warning("HDF writter max latency too small.")
+                raise ValueError
+        except Exception:
+            logging.info(traceback.format_exc())
+            dt = 0.5
+        return dt
+
+    def write_due(self):
+        # whether any device has more than hdf_flush_records records or hdf_flush_MB of data
+        # waiting, or has had data waiting for longer than the maximum latency
+        max_records = self.float_option("hdf_flush_records", 1000)
+        max_bytes = self.float_option("hdf_flush_MB", 16) * 1024*1024
+        max_latency = self.max_latency()
+
+        for dev_name, dev in self.parent.devices.items():
+            if not dev.control_started or len(dev.data_queue) == 0:
+                continue
+            if len(dev.data_queue) >= max_records or dev.queue_bytes >= max_bytes:
+                return True
+            if dev.queue_time and time.time() - dev.queue_time >= max_latency:
+                return True
+        return False
+
+    def drain_data_queue(self, dev):
+        # reset the backlog before taking the data, so anything queued meanwhile is counted again
+        time_queued, dev.queue_time, dev.queue_bytes = dev.queue_time, None, 0
+        data = dev.data_queue.get()
+        if data and time_queued:
+            self.drained[dev.config["name"]] = time_queued
+        return data
 
     def write_queues_to_HDF_InfluxDB(self, fname):
             root = fname.require_group(self.parent.run_name)
@@ -748,7 +2920,7 @@ class HDF_writer(threading.Thread):
                     continue
 
                 # get data
-                data = self.get_data(dev.data_queue)
+                data = self.drain_data_queue(dev)
                 if len(data) == 0:
                     continue
 
@@ -757,44 +2929,31 @@ class HDF_writer(threading.Thread):
                     if dev.config["control_params"]["InfluxDB_enabled"]["value"] in [1, 2, "1", "2", "True", "true"]:
                         self.write_to_influxdb(dev, data)
 
+                # get events, if any (also when they're not written, so they don't pile up)
+                events = self.get_data(dev.events_queue)
+
                 # check writing to HDF is enabled for this device
                 if not dev.config["control_params"]["HDF_enabled"]["value"]:
                     continue
 
-                # get events, if any, and write them to HDF
-                events = self.get_data(dev.events_queue)
+                # write the events to HDF
                 if len(events) != 0:
                     grp = root.require_group(dev.config["hdf_group"])
-                    events_dset = grp[dev.config["name"] + "_events"]
-                    events_dset.resize(events_dset.shape[0]+len(events), axis=0)
-                    events_dset[-len(events):,:] = events
+                    write_events(grp, dev.config["name"], events,
+                            self.events_strings.setdefault(dev.config["name"], {}))
+                    dev.last_written_event = events[-1]
 
                 grp = root.require_group(dev.config["hdf_group"])
 
                 # if writing all data from a single device to one dataset
                 if dev.config["slow_data"]:
                     dset = grp[dev.config["name"]]
-                    # check if one queue entry has multiple rows (one row is one time stamp)
-                    if np.shape(data)[0] >= 2:
-                        list_len = len(data)
-                        dset.resize(dset.shape[0]+list_len, axis=0)
-                        # iterate over queue entries with multiple rows and append
-                        for idx, d in enumerate(data):
-                            idx_start = -list_len + idx
-                            idx_stop = -list_len + idx + 1
-                            d =np.array([tuple(d)], dtype = dset.dtype)
-                            if idx_stop == 0:
-                                dset[idx_start:] = d
-                            else:
-                                dset[idx_start:idx_stop] = d
-                    else:
-                        dset.resize(dset.shape[0]+len(data), axis=0)
-                        try:
-                            data = np.array([tuple(data[0])], dtype = dset.dtype)
-                            dset[-len(data):] = data
-                        except (ValueError, TypeError) as err:
-                            logging.error("Error in write_all_queues_to_HDF(): " + str(err))
-                            logging.error(traceback.format_exc())
+                    # convert all queued rows (one row is one time stamp) at once,
+                    # so they are written with one resize and one write
+                    rows = rows_to_struct_array(data, dset.dtype)
+                    if len(rows) != 0:
+                        dset.resize(dset.shape[0]+len(rows), axis=0)
+                        dset[-len(rows):] = rows
 
                 # if writing each acquisition record to a separate dataset
                 else:
@@ -802,21 +2961,113 @@ class HDF_writer(threading.Thread):
                     if data==[np.nan] or data==np.nan:
                         continue
 
+                    if dev.hdf_layout == "consolidated":
+                        self.write_consolidated(grp, dev, data)
+                        continue
+
                     # parse and write the data
                     # data may have more than one ReadValue() return
+                    rec_num = next_record_number(grp, dev.config["name"])
+                    indices, rec_attrs = [], []
                     for record, all_attrs in data:
                         for waveforms, attrs in zip(record, all_attrs):
                             # data
                             rec_data = np.core.records.fromarrays(waveforms, dtype=dev.dset_dtype)
                             dset = grp.create_dataset(
-                                    name        = dev.config["name"] + "_{:06d}".format(len(grp)),
+                                    name        = dev.config["name"] + "_{:06d}".format(rec_num),
                                     data        = rec_data,
                                     shape       = (len(waveforms[0]),),
                                     compression = None
                                 )
-                            # metadata
-                            for key, val in attrs.items():
-                                dset.attrs[key] = val
+                            indices.append(rec_num)
+                            rec_attrs.append(attrs)
+                            rec_num += 1
+
+                    # metadata
+                    write_record_attrs(grp, dev.config["name"], indices, rec_attrs)
+
+    def write_queues_to_spool(self):
+        for dev_name, dev in self.parent.devices.items():
+            # check device has had control started
+            if not dev.control_started:
+                continue
+
+            data = self.drain_data_queue(dev)
+            events = self.get_data(dev.events_queue)
+
+            # write data to InfluxDB
+            if data and self.parent.config["influxdb"]["enabled"] in [1, 2, "2", "1", "True", "true"]:
+                if dev.config["control_params"]["InfluxDB_enabled"]["value"] in [1, 2, "1", "2", "True", "true"]:
+                    self.write_to_influxdb(dev, data)
+
+            spool = self.spools.get(dev_name)
+            if not spool or not dev.config["control_params"]["HDF_enabled"]["value"]:
+                continue
+
+            spool.append_events(events)
+            if events:
+                dev.last_written_event = events[-1]
+
+            if dev.config["slow_data"]:
+                spool.append_rows(rows_to_struct_array(data, spool.dtype))
+                continue
+
+            # fast data: all records of all ReadValue() returns are spooled as one record
+            rows = []
+            for d in data:
+                # check it is not a NaN return
+                if d==[np.nan] or d==np.nan:
+                    continue
+                try:
+                    rows.append(dev.to_records(d, spool.dtype))
+                except (ValueError, TypeError, IndexError) as err:
+                    logging.warning("HDF_writer warning: cannot spool data of {0}: {1}".format(dev_name, err))
+                    logging.info(traceback.format_exc())
+            if rows:
+                spool.append_rows(np.concatenate(rows))
+
+    def write_consolidated(self, grp, dev, data):
+        dset = grp[dev.config["name"]]
+        index_dset = grp[dev.config["name"] + "_index"]
+
+        # gather all records of all ReadValue() returns, so they are written with one resize and one write
+        records, all_attrs = [], []
+        for record, rec_attrs in data:
+            record = np.asarray(record)
+            if record.ndim != 3 or record.shape[1] != dset.shape[1]:
+                logging.warning("HDF_writer warning: device {0} returned data of shape {1}, expected (n, {2}, n_samples).".format(
+                        dev.config["name"], record.shape, dset.shape[1]))
+                continue
+            records.append(record)
+            all_attrs += list(rec_attrs) + [{}] * (len(record) - len(rec_attrs))
+        if not records:
+            return
+
+        # the number of samples may change during a run (e.g. PCIe6351_ai.update_samp_num())
+        n_samp = max(rec.shape[2] for rec in records)
+        if n_samp > dset.shape[2]:
+            dset.resize(n_samp, axis=2)
+        n_samp = dset.shape[2]
+
+        n_rec = sum(len(rec) for rec in records)
+        batch = np.full((n_rec, dset.shape[1], n_samp), dset.fillvalue, dtype=dset.dtype)
+        i = 0
+        for rec in records:
+            batch[i:i+len(rec), :, :rec.shape[2]] = rec
+            i += len(rec)
+
+        # write the data
+        n_old = dset.shape[0]
+        dset.resize(n_old + n_rec, axis=0)
+        dset[n_old:] = batch
+
+        # write the record index, time and attributes
+        index = np.zeros(n_rec, dtype=index_dset.dtype)
+        index["index"] = np.arange(n_old, n_old + n_rec)
+        index["time"] = time.time() - self.parent.config["time_offset"]
+        index["attrs"] = [json.dumps(attrs, default=str) for attrs in all_attrs]
+        index_dset.resize(n_old + n_rec, axis=0)
+        index_dset[n_old:] = index
 
     def get_data(self, fifo):
         data = []
@@ -829,24 +3080,8 @@ class HDF_writer(threading.Thread):
         if not dev.config["slow_data"]:
             return
 
-        meas = "Dev: " + dev.config["name"]
-        tag_name = "run_name"
-        tag_val = self.parent.run_name
-        record = []
-
-        for i in range(len(data)):
-            if len(data[i]) < 2:
-                continue
-            data_time = round((data[i][0] + self.parent.config["time_offset"])*1e9)
-            if np.isnan(data_time):
-                continue
-            for j in range(len(data[i])-1):
-                field_name = dev.col_names_list[j+1]
-                field_val = data[i][j+1]
-                if not np.isnan(field_val):
-                    data_point = Point(meas).tag(tag_name, tag_val).field(field_name, field_val).time(data_time)
-                    # print(data_point.to_line_protocol())
-                    record.append(data_point)
+        record = influxdb_points(dev.config["name"], self.parent.run_name,
+                    self.parent.config["time_offset"], dev.col_names_list, data)
 
         # push to InfluxDB
         try:
@@ -855,6 +3090,178 @@ class HDF_writer(threading.Thread):
             logging.warning("InfluxDB error: " + str(err))
             logging.warning(traceback.format_exc())
 
+class HDF_spool_merger(threading.Thread):
+    # Copies the records written to spool files by HDF_writer into the HDF file, and keeps
+    # track (in the spool files' .merged files) of how far each spool file has been merged,
+    # so that recover_spools() only adds what is missing after a crash.
+    def __init__(self, writer):
+        threading.Thread.__init__(self)
+        self.writer = writer
+        self.active = threading.Event()
+        self.active.set()
+        self.offsets = {}
+
+    def run(self):
+        while self.active.is_set():
+            try:
+                self.merge()
+            except OSError as err:
+                logging.warning("HDF_spool_merger warning: {0}".format(err))
+                logging.info(traceback.format_exc())
+
+            # merging (and flushing the HDF file) is done on the HDF flush schedule
+            try:
+                dt = float(self.writer.parent.config["general"].get("hdf_flush_delay", "2.0"))
+            except ValueError:
+                logging.info(traceback.format_exc())
+                dt = 2.0
+            self.active.wait(dt)
+
+        # merge everything that is left
+        try:
+            self.merge()
+        except OSError as err:
+            logging.warning("HDF_spool_merger warning: {0}".format(err))
+            logging.warning(traceback.format_exc())
+
+    def merge(self):
+        self.writer.check_rollover()
+        root = self.writer.hdf_file[self.writer.parent.run_name]
+        merged = {}
+        for dev_name, spool in self.writer.spools.items():
+            grp = root[spool.meta["hdf_group"]]
+            offset = self.offsets.get(dev_name, spool.data_start)
+            for kind, obj, offset in spool.read(offset):
+                if kind == SpoolFile.DATA:
+                    write_rows_to_HDF(grp, dev_name, spool.meta, obj)
+                else:
+                    write_events(grp, dev_name, obj, self.writer.events_strings.setdefault(dev_name, {}))
+            if offset != self.offsets.get(dev_name, spool.data_start):
+                merged[dev_name] = offset
+
+        # only count records as merged once they are flushed to the HDF file
+        if merged:
+            self.writer.hdf_file.flush()
+            for dev_name, offset in merged.items():
+                self.writer.spools[dev_name].set_merged_offset(offset)
+                self.offsets[dev_name] = offset
+
+class HDF_writer_process(multiprocessing.Process):
+    # Writes HDF (and InfluxDB) from a separate process, so that compression and large writes
+    # don't hold the GIL of the device threads. Devices hand over their data through shared
+    # memory ring buffers (see Device.queue_data()), and HDF_writer forwards events and
+    # reports the status of this process in the GUI.
+    def __init__(self, spec):
+        multiprocessing.Process.__init__(self, daemon=True)
+        self.spec = spec
+        self.active = multiprocessing.Event()
+        self.events_queue = multiprocessing.Queue()
+        self.status_queue = multiprocessing.Queue()
+        self.events_strings = {}
+        self.unknown_devices = set()
+        self.active.set()
+
+    def run(self):
+        rings = {dev_name: SharedRingBuffer(**dev["ring"]) for dev_name, dev in self.spec["devices"].items()}
+
+        # connect to InfluxDB
+        write_api = None
+        conf = self.spec["influxdb"]
+        if conf["enabled"] in [1, 2, "2", "1", "True", "true"]:
+            influxdb_client = InfluxDBClient(url=conf["url"], token=conf["username"]+":"+conf["password"], org="-")
+            write_api = influxdb_client.write_api(write_options=SYNCHRONOUS)
+
+        try:
+            with h5py.File(self.spec["filename"], "r+", libver="latest") as f:
+                error = self.start_swmr(f) if self.spec["swmr"] else ""
+
+                time_last_flush = time.time()
+                while self.active.is_set():
+                    n = 0
+                    try:
+                        n = self.write_rings_to_HDF_InfluxDB(f, rings, write_api)
+
+                        # flush on schedule
+                        if time.time() - time_last_flush >= float(self.spec["hdf_flush_delay"]):
+                            f.flush()
+                            time_last_flush = time.time()
+                    except OSError as err:
+                        error = str(err)
+                        logging.info(traceback.format_exc())
+
+                    self.status_queue.put({"time": time.time(), "records": n, "error": error})
+                    error = ""
+                    time.sleep(float(self.spec["hdf_loop_delay"]))
+
+                # make sure everything is written when the process terminates
+                self.write_rings_to_HDF_InfluxDB(f, rings, write_api)
+                if not f.swmr_mode:
+                    for dev_name, dev in self.spec["devices"].items():
+                        if dev["HDF_enabled"] and not dev["slow_data"] and dev["hdf_layout"] == "records":
+                            dedup_record_attrs(f[self.spec["run_name"]][dev["hdf_group"]], dev_name)
+                self.status_queue.put({"time": time.time(), "records": 0, "error": ""})
+        finally:
+            for dev_name, ring in rings.items():
+                ring.close()
+            if write_api:
+                write_api.__del__()
+                influxdb_client.__del__()
+
+    def start_swmr(self, f):
+        for dev_name, dev in self.spec["devices"].items():
+            if dev["HDF_enabled"] and not dev["slow_data"] and dev["hdf_layout"] == "records":
+                return "SWMR mode not started, device {0} writes a new dataset for each record; " \
+                       "the file can't be read until the run stops (use hdf_layout = consolidated).".format(dev_name)
+        try:
+            f.swmr_mode = True
+        except (RuntimeError, ValueError) as err:
+            return "cannot start SWMR mode: {0}".format(err)
+        return ""
+
+    def write_rings_to_HDF_InfluxDB(self, f, rings, write_api):
+        root = f[self.spec["run_name"]]
+        n_written = 0
+
+        # write events
+        events = {}
+        while True:
+            try:
+                dev_name, dev_events = self.events_queue.get_nowait()
+            except queue.Empty:
+                break
+            events.setdefault(dev_name, []).extend(dev_events)
+        for dev_name, dev_events in events.items():
+            if dev_name not in self.spec["devices"]:
+                # no datasets were made for it; report once
+                if dev_name not in self.unknown_devices:
+                    self.unknown_devices.add(dev_name)
+                    logging.warning("HDF_writer_process warning: events of unknown device {0} not written.".format(dev_name))
+                continue
+            write_events(root[self.spec["devices"][dev_name]["hdf_group"]], dev_name, dev_events,
+                    self.events_strings.setdefault(dev_name, {}))
+
+        for dev_name, dev in self.spec["devices"].items():
+            rows = rings[dev_name].get()
+            if len(rows) == 0:
+                continue
+            n_written += len(rows)
+
+            # write data to InfluxDB (slow data only)
+            if write_api and dev["InfluxDB_enabled"] and dev["slow_data"]:
+                record = influxdb_points(dev_name, self.spec["run_name"], self.spec["time_offset"], dev["col_names"], rows.tolist())
+                try:
+                    write_api.write(bucket=self.spec["influxdb"]["database"] + "/autogen", org=None, record=record, write_precision=WritePrecision.NS)
+                except Exception as err:
+                    logging.warning("InfluxDB error: " + str(err))
+                    logging.warning(traceback.format_exc())
+
+            if not dev["HDF_enabled"]:
+                continue
+
+            write_rows_to_HDF(root[dev["hdf_group"]], dev_name, dev, rows)
+
+        return n_written
+
 ##########################################################################
 ##########################################################################
 #######                                                 ##################
@@ -971,7 +3378,13 @@ class DeviceConfig(Config):
                 "shape"              : list,
                 "plots_fn"           : str,
                 "scan_params"        : list,
-                "block_thread"       : bool
+                "block_thread"       : bool,
+                "process_isolated"   : bool,
+                "process_timeout"    : float,
+                "hdf_layout"         : str,
+                "hdf_chunk_shape"    : list,
+                "hdf_compression"    : str,
+                "hdf_compression_opts" : int,
             }
 
         # list of keys permitted for runtime data (which cannot be written to .ini file)
@@ -980,9 +3393,9 @@ class DeviceConfig(Config):
                 "driver_class"            : None,
                 "shape"                   : tuple,
                 "dtype"                   : str,
-                "plots_queue"             : deque,
                 "monitoring_GUI_elements" : dict,
                 "control_GUI_elements"    : dict,
+                "indicators"              : dict,
             }
 
         # list of keys permitted as names of sections in the .ini file
@@ -999,6 +3412,12 @@ class DeviceConfig(Config):
         self["slow_data"] = True
         self["scan_params"] = []
         self["block_thread"] = False
+        self["process_isolated"] = False
+        self["process_timeout"] = 30.0
+        self["hdf_layout"] = "records"
+        self["hdf_chunk_shape"] = ["16"]
+        self["hdf_compression"] = "None"
+        self["hdf_compression_opts"] = 4
 
     def change_param(self, key, val, sect=None, sub_ctrl=None, row_col=None, nonTriState=False, GUI_element=None):
         if row_col != None:
@@ -1052,6 +3471,11 @@ class DeviceConfig(Config):
                 if self["compound_dataset"]:
                     self["dtype"] = [val.strip() for val in self["dtype"].split(',')]
 
+        # meta devices get a reference to the program, which can't be passed to another process
+        if self["process_isolated"] and self["meta_device"]:
+            logging.warning("Meta device {0} can't be process_isolated.".format(self.fname))
+            self["process_isolated"] = False
+
         # read device attributes
         self["attributes"] = params["attributes"]
 
@@ -1230,6 +3654,7 @@ class DeviceConfig(Config):
                         "rowspan"            : int(params[c].get("rowspan")) if params[c].get("rowspan") else None,
                         "colspan"            : int(params[c].get("colspan")) if params[c].get("colspan") else None,
                         "monitoring_command" : params[c]["monitoring_command"],
+                        "monitoring_interval": float(params[c]["monitoring_interval"]) if params[c].get("monitoring_interval") else None,
                         "states"             : split(params[c]["states"])
                     }
 
@@ -1245,6 +3670,7 @@ class DeviceConfig(Config):
                         "align"      : params[c].get("align"),
                         "tooltip"    : params[c].get("tooltip"),
                         "monitoring_command" : params[c]["monitoring_command"],
+                        "monitoring_interval": float(params[c]["monitoring_interval"]) if params[c].get("monitoring_interval") else None,
                         "action_commands"    : split(params[c]["action_commands"]),
                         "return_values"      : split(params[c]["return_values"]),
                         "checked"            : [True if x in ["1", "True"] else False for x in split(params[c]["checked"])],
@@ -1262,6 +3688,7 @@ class DeviceConfig(Config):
                         "value"      : params[c]["value"],
                         "tooltip"    : params[c].get("tooltip"),
                         "monitoring_command" : params[c]["monitoring_command"],
+                        "monitoring_interval": float(params[c]["monitoring_interval"]) if params[c].get("monitoring_interval") else None,
                     }
 
             elif params[c].get("type") == "dummy":
@@ -1276,6 +3703,41 @@ class DeviceConfig(Config):
         # self["control_params"] = ctrls
         # self["control_parama"] as a dict (a mutable object) is modified when ctrls is modified
 
+        self.check_commands()
+        self.index_indicators()
+
+    def index_indicators(self):
+        # the indicator controls of each monitoring command, so that Monitoring sends each
+        # command once (however many indicators show its return value) and finds the indicators
+        # of a monitoring event directly; a command shared by several indicators is sent at the
+        # shortest of their monitoring_interval (None: on every Monitoring cycle)
+        self["indicators"] = {}
+        for c_name, c in self["control_params"].items():
+            if c.get("type") not in ["indicator", "indicator_button", "indicator_lineedit"]:
+                continue
+            ind = self["indicators"].setdefault(c["monitoring_command"], {"controls": [], "interval": c["monitoring_interval"]})
+            ind["controls"].append(c_name)
+            if ind["interval"] is not None:
+                ind["interval"] = None if c["monitoring_interval"] is None else min(ind["interval"], c["monitoring_interval"])
+
+    def check_commands(self):
+        # check the commands of all controls are methods of the driver, and parse the
+        # monitoring commands (which are complete commands) ahead of time
+        driver = self["driver_class"]
+        for c_name, c in self["control_params"].items():
+            names = [c.get(key) for key in ["command", "cmd", "enter_cmd"]] + c.get("action_commands", [])
+            if c.get("monitoring_command"):
+                try:
+                    names.append(compile_command(c["monitoring_command"])[0])
+                except SyntaxError as err:
+                    logging.warning("Device config {0}: invalid monitoring_command of {1}: {2}".format(self.fname, c_name, err))
+            for name in names:
+                if not name or name.strip() in ["None", ""]:
+                    continue
+                if not callable(getattr(driver, name.strip(), None)):
+                    logging.warning("Device config {0}: {1} is not a method of driver {2} (control {3}).".format(
+                            self.fname, name.strip(), driver.__name__, c_name))
+
     def write_to_file(self):
         # collect the configuration parameters to be written
         config = configparser.ConfigParser()
@@ -1340,8 +3802,12 @@ class DeviceConfig(Config):
                 config[c_name]["image_path"] = str(c["image_path"])
             elif c["type"] == "indicator":
                 config[c_name]["monitoring_command"] = str(c.get("monitoring_command"))
+                if c.get("monitoring_interval"):
+                    config[c_name]["monitoring_interval"] = str(c["monitoring_interval"])
             elif c["type"] == "indicator_button":
                 config[c_name]["monitoring_command"] = str(c.get("monitoring_command"))
+                if c.get("monitoring_interval"):
+                    config[c_name]["monitoring_interval"] = str(c["monitoring_interval"])
                 config[c_name]["action_commands"] = ", ".join(c["action_commands"])
                 config[c_name]["return_values"] = ", ".join(c["return_values"])
                 config[c_name]["checked"] = ", ".join([str(x) for s in c["checked"]])
@@ -1351,6 +3817,8 @@ class DeviceConfig(Config):
                 config[c_name]["align"] = str(c.get("align"))
             elif c["type"] == "indicator_lineedit":
                 config[c_name]["enter_cmd"] = str(c["enter_cmd"])
+                if c.get("monitoring_interval"):
+                    config[c_name]["monitoring_interval"] = str(c["monitoring_interval"])
             elif c["type"] == "dummy":
                 config[c_name]["value"] = str(c["value"])
         # write them to file
@@ -1970,6 +4438,7 @@ class SequencerGUI(qt.QWidget):
             dev = self.parent.devices[name]
             if not dev.config["block_thread"]:
                 dev.sequencer_active = True
+                dev.wake()
         self.counter += 1
         self.progress.setValue(self.counter)
         if self.counter == len(self.seq_combine):
@@ -2157,7 +4626,8 @@ class ControlGUI(qt.QWidget):
         files_frame.addWidget(qt.QLabel("HDF writer loop delay:"), 2, 0)
 
         qle = newLineEdit()
-        qle.setToolTip("The loop delay determines how frequently acquired data is written to the HDF file.")
+        qle.setToolTip("The longest time acquired data waits to be written to the HDF file (unless hdf_max_latency is set);\n"
+                       "data is written sooner when a device has more than hdf_flush_records records or hdf_flush_MB waiting.")
         qle.setText(self.parent.config["general"]["hdf_loop_delay"])
         qle.editingFinished.connect(lambda qle=qle: self.parent.config.change("general", "hdf_loop_delay", qle.text()))
         files_frame.addWidget(qle, 2, 1)
@@ -2264,7 +4734,9 @@ class ControlGUI(qt.QWidget):
         gen_f.addWidget(qt.QLabel("Disk usage:"), 2, 0)
         self.free_qpb = qt.QProgressBar()
         gen_f.addWidget(self.free_qpb, 2, 1, 1, 2)
-        self.check_free_disk_space()
+        self.disk_monitor = DiskMonitor()
+        self.disk_warnings = WarningChannel()
+        self.show_disk_usage(self.check_free_disk_space())
 
         # InfluxDB controls
 
@@ -2317,11 +4789,24 @@ class ControlGUI(qt.QWidget):
             )
         gen_f.addWidget(qle, 5, 2)
 
+        # timing of the device control loops
+        qch = qt.QCheckBox("Device timing")
+        qch.setToolTip("Record how long the parts of each device's control loop take (shown in the device's monitoring box, and written to HDF at stop).")
+        qch.setTristate(False)
+        qch.setChecked(True if self.parent.config["general"].get("device_timing") in ["1", "True", "true"] else False)
+        qch.stateChanged[int].connect(self.set_device_timing)
+        gen_f.addWidget(qch, 6, 0, 1, 3)
+
         # for displaying warnings
         self.warnings_label = qt.QLabel("(no warnings)")
         self.warnings_label.setWordWrap(True)
         self.warnings_label.setMaximumHeight(60)
-        gen_f.addWidget(self.warnings_label, 6, 0, 1, 3)
+        gen_f.addWidget(self.warnings_label, 7, 0, 1, 3)
+
+    def set_device_timing(self, state):
+        self.parent.config.change("general", "device_timing", str(bool(state)))
+        for dev_name, dev in self.parent.devices.items():
+            dev.timing_enabled = bool(state)
 
     def enable_all_devices(self):
         for i, (dev_name, dev) in enumerate(self.parent.devices.items()):
@@ -2352,17 +4837,92 @@ class ControlGUI(qt.QWidget):
     def update_warnings(self, warnings):
         self.warnings_label.setText(warnings)
 
+    def apply_monitoring_update(self, changes):
+        # show the values that changed since the last Monitoring snapshot (in the GUI thread)
+        # (updates still queued when control is stopped are dropped)
+        if not self.parent.config['control_active']:
+            return
+
+        for (dev_name, key), value in changes.items():
+            if dev_name is None:
+                if key == "HDF_status":
+                    self.HDF_status.setProperty("state", value)
+                    self.update_style(self.HDF_status)
+                elif key == "warnings":
+                    self.update_warnings(value)
+                elif key == "disk_usage":
+                    self.show_disk_usage(value)
+                continue
+
+            dev = self.parent.devices.get(dev_name)
+            if not dev:
+                continue
+            if key in dev.config["monitoring_GUI_elements"]:
+                dev.config["monitoring_GUI_elements"][key].setText(value)
+                continue
+
+            # indicator controls
+            params = dev.config["control_params"][key]
+            if params.get("type") == "indicator":
+                ind = dev.config["control_GUI_elements"][key]["QLabel"]
+                if ind.text() != value[0]:
+                    ind.setText(value[0])
+                if value[1] is not None:
+                    ind.setProperty("state", value[1])
+                    self.update_style(ind)
+
+            elif params.get("type") == "indicator_button":
+                ind = dev.config["control_GUI_elements"][key]["QPushButton"]
+                ind.setText(value[0])
+                ind.setChecked(value[1])
+                ind.setProperty("state", value[2])
+                self.update_style(ind)
+
+            elif params.get("type") == "indicator_lineedit":
+                if not dev.config["control_GUI_elements"][key]["currently_editing"]:
+                    dev.config["control_GUI_elements"][key]["QLineEdit"].setText(value)
+                    # setText itself would emit a signal, so no need to call update_style
+
     def check_free_disk_space(self):
-        pythoncom.CoInitialize()
-        c = wmi.WMI ()
-        for d in c.Win32_LogicalDisk():
-            if d.Caption == self.parent.config["files"]["hdf_fname"][0:2]:
-                size_MB = float(d.Size) / 1024/1024
-                free_MB = float(d.FreeSpace) / 1024/1024
-                self.free_qpb.setMinimum(0)
-                self.free_qpb.setMaximum(int(size_MB))
-                self.free_qpb.setValue(int(size_MB - free_MB))
-                self.parent.app.processEvents()
+        # called on every Monitoring cycle (in the Monitoring thread, so no widgets are touched
+        # here), but the disk is only checked every disk_check_interval; returns what the disk
+        # usage bar shows, (used MB, total MB, format), or None if the disk couldn't be checked
+        try:
+            self.disk_monitor.interval = float(self.parent.config["general"].get("disk_check_interval", "5"))
+            warn_time = float(self.parent.config["general"].get("disk_warn_time", "3600"))
+        except ValueError:
+            logging.info(traceback.format_exc())
+            warn_time = 3600
+        writer = getattr(self, "HDF_writer", None)
+        written_fname = writer.filename if writer and writer.is_alive() else None
+        sampled = self.disk_monitor.sample(self.parent.config["files"]["hdf_fname"], written_fname)
+
+        usage, time_to_full = self.disk_monitor.usage, self.disk_monitor.time_to_full
+        if usage is None:
+            return
+
+        # warn before the disk fills up; Monitoring reports the warnings like those of the
+        # devices, so one that keeps coming is reported at most every warnings_interval
+        if sampled and time_to_full is not None and time_to_full < warn_time:
+            self.disk_warnings.put("disk of the HDF file full in {0} ({1:.1f} GB free, written at {2:.1f} MB/s)".format(
+                    format_duration(time_to_full), usage.free/1024**3, self.disk_monitor.rate/1024/1024),
+                    key="disk full")
+
+        if time_to_full is None:
+            fmt = "%p%"
+        else:
+            fmt = "%p% (full in " + format_duration(time_to_full) + ")"
+        return (int(usage.used/1024/1024), int(usage.total/1024/1024), fmt)
+
+    def show_disk_usage(self, disk_usage):
+        # (in the GUI thread)
+        if not disk_usage:
+            return
+        used_MB, total_MB, fmt = disk_usage
+        self.free_qpb.setMinimum(0)
+        self.free_qpb.setMaximum(total_MB)
+        self.free_qpb.setValue(used_MB)
+        self.free_qpb.setFormat(fmt)
 
     def toggle_control(self, val="", show_only=False):
         if not self.parent.config["control_visible"]:
@@ -2976,6 +5536,32 @@ class ControlGUI(qt.QWidget):
                     alignment = PyQt5.QtCore.Qt.AlignLeft,
                 )
 
+            # time from queueing data to writing it to HDF
+            df.addWidget(
+                    qt.QLabel("Write latency:"),
+                    4, 0,
+                    alignment = PyQt5.QtCore.Qt.AlignRight,
+                )
+            dev.config["monitoring_GUI_elements"]["hdf_flush"] = qt.QLabel("N/A")
+            df.addWidget(
+                    dev.config["monitoring_GUI_elements"]["hdf_flush"],
+                    4, 1, 1, 2,
+                    alignment = PyQt5.QtCore.Qt.AlignLeft,
+                )
+
+            # time taken by the parts of the control loop (with "Device timing" on)
+            df.addWidget(
+                    qt.QLabel("Timing (p50 / p99):"),
+                    5, 0,
+                    alignment = PyQt5.QtCore.Qt.AlignRight,
+                )
+            dev.config["monitoring_GUI_elements"]["timing"] = qt.QLabel("N/A")
+            df.addWidget(
+                    dev.config["monitoring_GUI_elements"]["timing"],
+                    5, 1, 1, 2,
+                    alignment = PyQt5.QtCore.Qt.AlignLeft,
+                )
+
         self.refresh_COM_ports()
 
     def rename_HDF(self, state):
@@ -3040,9 +5626,10 @@ class ControlGUI(qt.QWidget):
         if not self.open_dir("files", "config_dir", self.config_dir_qle):
             return
 
-        # update device controls
+        # update device controls (the drivers kept open belong to the old configs)
         for frame_name in self.devices_frame:
             self.devices_frame[frame_name].clear()
+        self.close_connections()
         self.make_devices()
         self.place_device_controls()
 
@@ -3086,6 +5673,7 @@ class ControlGUI(qt.QWidget):
 
     def queue_command(self, dev, cmd):
         dev.commands.append(cmd)
+        dev.wake()
 
     def refresh_COM_ports(self):
         self.parent.config["com_ports"] = pyvisa.ResourceManager().list_resources()
@@ -3134,39 +5722,52 @@ class ControlGUI(qt.QWidget):
         self.parent.config["time_offset"] = time.time()
 
         # setup & check connections of all devices
+        time_start = time.time()
+        keep_warm = self.parent.config["general"].get("keep_drivers_warm") in ["1", "True", "true"]
+        starting = []
         for dev_name, dev in self.parent.devices.items():
             if dev.config["control_params"]["enabled"]["value"]:
-                # update the status label
-                self.status_label.setText("Starting " + dev_name + " ...")
-                self.status_label.setStyleSheet("color: green; font: 16pt 'Helvetica'")
-                self.parent.app.processEvents()
-                # called to force processing the above line, otherwise it won't be done immediately
-
                 ## reinstantiate the thread (since Python only allows threads to
                 ## be started once, this is necessary to allow repeatedly stopping and starting control)
                 self.parent.devices[dev_name] = Device(dev.config)
+                # (with keep_drivers_warm, the driver left open by the last run, if any)
+                self.parent.devices[dev_name].connection, dev.connection = dev.connection, None
                 dev = self.parent.devices[dev_name]
-
-                # setup connection
-                dev.setup_connection(self.parent.config["time_offset"])
-                if dev.operational == 0:
-                    error_box("Device error", "Error: " + dev.config["name"] +\
-                            " error.", dev.error_message)
-                    self.status_label.setText("Device configuration error")
-                    self.status_label.setStyleSheet("color: red; font: 16pt 'Helvetica'")
-                    return
-                elif dev.operational == 1:
-                    still_running = qt.QMessageBox.warning(self, 'Device warning',
-                                            'Warning: '+dev.config["name"]+" error.\n"+dev.error_message+'\n\n Still running?',
-                                            qt.QMessageBox.Yes | qt.QMessageBox.No,
-                                            qt.QMessageBox.No)
-                    if still_running == qt.QMessageBox.No:
-                        dev.operational = 0
-                        self.status_label.setText("Device configuration error")
-                        self.status_label.setStyleSheet("color: red; font: 16pt 'Helvetica'")
-                        return
-                    else:
-                        dev.operational = 2
+                dev.timing_enabled = self.parent.config["general"].get("device_timing") in ["1", "True", "true"]
+                dev.keep_warm = keep_warm
+                starting.append(dev)
+            else:
+                dev.close_connection()
+        self.setup_connections(starting)
+        startup_time = time.time() - time_start
+        logging.info("Connections to {0} devices set up in {1:.1f} s.".format(len(starting), startup_time))
+
+        # the devices were set up together, so report all their errors (and warnings) at once
+        failed = [dev for dev in starting if dev.operational == 0]
+        if failed:
+            error_box("Device error", "Error: " + ", ".join(dev.config["name"] for dev in failed) +\
+                    " error.", "\n\n".join(dev.config["name"] + ": " + str(dev.error_message) for dev in failed))
+            self.close_connections()
+            self.status_label.setText("Device configuration error")
+            self.status_label.setStyleSheet("color: red; font: 16pt 'Helvetica'")
+            return
+        warned = [dev for dev in starting if dev.operational == 1]
+        if warned:
+            still_running = qt.QMessageBox.warning(self, 'Device warning',
+                                    'Warning: '+", ".join(dev.config["name"] for dev in warned)+" error.\n"+\
+                                    "\n".join(dev.config["name"]+": "+str(dev.error_message) for dev in warned)+'\n\n Still running?',
+                                    qt.QMessageBox.Yes | qt.QMessageBox.No,
+                                    qt.QMessageBox.No)
+            if still_running == qt.QMessageBox.No:
+                for dev in warned:
+                    dev.operational = 0
+                self.close_connections()
+                self.status_label.setText("Device configuration error")
+                self.status_label.setStyleSheet("color: red; font: 16pt 'Helvetica'")
+                return
+            else:
+                for dev in warned:
+                    dev.operational = 2
 
         if self.seq.sequencer_active:
             for name in list(self.seq.dev_sequence_cmd.keys()):
@@ -3184,11 +5785,26 @@ class ControlGUI(qt.QWidget):
         self.HDF_writer = HDF_writer(self.parent)
         self.HDF_writer.start()
 
-        # start control for all devices
+        # start control for all devices; with async_slow_devices, the slow data devices
+        # share one AsyncDeviceRuntime thread instead of having a thread each
+        async_devices = []
         for dev_name, dev in self.parent.devices.items():
             if dev.config["control_params"]["enabled"]["value"]:
                 dev.clear_queues()
-                dev.start()
+                if self.parent.config["general"].get("async_slow_devices") in ["1", "True", "true"] \
+                        and dev.config["slow_data"]:
+                    async_devices.append(dev)
+                else:
+                    dev.start()
+        self.device_runtime = None
+        if async_devices:
+            try:
+                max_workers = int(self.parent.config["general"].get("async_max_workers", "4"))
+            except ValueError:
+                logging.warning("async_max_workers not an integer, using 4.")
+                max_workers = 4
+            self.device_runtime = AsyncDeviceRuntime(async_devices, max(max_workers, 1))
+            self.device_runtime.start()
 
         # connect to InfluxDB
         conf = self.parent.config["influxdb"]
@@ -3202,13 +5818,13 @@ class ControlGUI(qt.QWidget):
 
         # update and start the monitoring thread
         self.monitoring = Monitoring(self.parent)
-        self.monitoring.update_style.connect(self.update_style)
+        self.monitoring.update_gui.connect(self.apply_monitoring_update)
         self.monitoring.active.set()
         self.monitoring.start()
 
         # update program status
         self.parent.config['control_active'] = True
-        self.status_label.setText("Running")
+        self.status_label.setText("Running (started in {0:.1f} s)".format(startup_time))
         self.status_label.setStyleSheet("color: green; font: 16pt 'Helvetica'")
 
         # update the values of the above controls
@@ -3217,6 +5833,57 @@ class ControlGUI(qt.QWidget):
         self.parent.PlotsGUI.refresh_all_run_lists(select_defaults=False)
         self.parent.PlotsGUI.clear_all_fast_y()
 
+    def setup_connections(self, devices):
+        # Device.setup_connection() for all the devices, several at a time: opening a serial
+        # port or creating DAQ tasks takes up to a second or so per device, mostly waiting.
+        # A device that doesn't finish within setup_timeout is treated as a device error (its
+        # thread is left to finish on its own, and closes the driver it opens, see abandon_setup()). Meta devices get a reference to this GUI, so
+        # they're set up here in the GUI thread, after the others.
+        try:
+            max_workers = int(self.parent.config["general"].get("setup_max_workers", "8"))
+            timeout = float(self.parent.config["general"].get("setup_timeout", "30"))
+        except ValueError:
+            logging.warning("setup_max_workers or setup_timeout not a number, using 8 and 30 s.")
+            max_workers, timeout = 8, 30
+
+        def setup(dev):
+            try:
+                dev.setup_connection(self.parent.config["time_offset"])
+            except Exception as err:
+                logging.warning(traceback.format_exc())
+                dev.operational = 0
+                dev.error_message = "setup_connection() failed: " + str(err)
+
+        self.status_label.setStyleSheet("color: green; font: 16pt 'Helvetica'")
+        pool_devices = [dev for dev in devices if not dev.config["meta_device"]]
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(max_workers, 1),
+                        thread_name_prefix="setup_connection")
+        futures = {executor.submit(setup, dev): dev for dev in pool_devices}
+        deadline = time.time() + timeout
+        pending = set(futures)
+        while pending and time.time() < deadline:
+            # update the status label, keeping the GUI responsive while waiting
+            self.status_label.setText("Starting {0} ... ({1}/{2} ready)".format(
+                    ", ".join(sorted(futures[f].config["name"] for f in pending)),
+                    len(futures) - len(pending), len(futures)))
+            self.parent.app.processEvents()
+            done, pending = concurrent.futures.wait(pending, timeout=0.1)
+        for f in pending:
+            futures[f].abandon_setup("No response within {0} s (setup_timeout).".format(timeout))
+        executor.shutdown(wait=False)
+
+        for dev in devices:
+            if dev.config["meta_device"]:
+                self.status_label.setText("Starting " + dev.config["name"] + " ...")
+                self.parent.app.processEvents()
+                setup(dev)
+
+    def close_connections(self):
+        # close the drivers left open by setup_connection() or a previous run
+        for dev_name, dev in self.parent.devices.items():
+            if not dev.active.is_set():
+                dev.close_connection()
+
     def stop_control(self):
         # check we're not stopped already
         if not self.parent.config['control_active']:
@@ -3270,9 +5937,18 @@ class ControlGUI(qt.QWidget):
                     #     ind = dev.config["control_GUI_elements"][c_name]["QLineEdit"]
                     #     ind.setText(params["label"])
 
-                # stop the device, and wait for it to finish
+                # stop the device, and wait for it to finish (devices on the
+                # AsyncDeviceRuntime have no thread of their own)
                 dev.active.clear()
-                dev.join()
+                dev.wake()
+                if dev.is_alive():
+                    dev.join()
+
+        if self.device_runtime:
+            self.device_runtime.join()
+
+        # the timing statistics are complete once the devices have stopped
+        self.HDF_writer.write_device_stats()
 
         if self.seq.counter >= 0:
             self.seq.stop_trigger()
@@ -3459,8 +6135,7 @@ class PlotsGUI(qt.QSplitter):
 
     def refresh_all_run_lists(self, select_defaults=True):
         # get list of runs
-        with h5py.File(self.parent.config["files"]["plotting_hdf_fname"], 'r') as f:
-            runs = list(f.keys())
+        runs = hdf_runs(self.parent, self.parent.config["files"]["plotting_hdf_fname"])
 
         # update all run QComboBoxes
         for col, col_plots in self.all_plots.items():
@@ -3572,8 +6247,7 @@ class Plotter(qt.QWidget):
 
         # get list of runs
         try:
-            with h5py.File(self.parent.config["files"]["plotting_hdf_fname"], 'r') as f:
-                runs = list(f.keys())
+            runs = hdf_runs(self.parent, self.parent.config["files"]["plotting_hdf_fname"])
         except OSError as err:
             runs = ["(no runs found)"]
             logging.warning("Warning in class Plotter: " + str(err))
@@ -3726,9 +6400,8 @@ class Plotter(qt.QWidget):
 
         # select latest run
         try:
-            with h5py.File(self.parent.config["files"]["plotting_hdf_fname"], 'r') as f:
-                self.config["run"] = list(f.keys())[-1]
-                self.run_cbx.setCurrentText(self.config["run"])
+            self.config["run"] = hdf_runs(self.parent, self.parent.config["files"]["plotting_hdf_fname"])[-1]
+            self.run_cbx.setCurrentText(self.config["run"])
         except OSError as err:
             logging.warning("Warning in class Plotter: " + str(err))
             logging.warning(traceback.format_exc())
@@ -3798,11 +6471,10 @@ class Plotter(qt.QWidget):
         if self.dev.config["control_params"]["HDF_enabled"]["value"] and self.config["from_HDF"]:
             # check run is valid
             try:
-                with h5py.File(self.parent.config["files"]["plotting_hdf_fname"], 'r') as f:
-                    if not self.config["run"] in f.keys():
-                        self.stop_animation()
-                        logging.warning("Plot error: Run not found in the HDF file:" + self.config["run"])
-                        return False
+                if not self.config["run"] in hdf_runs(self.parent, self.parent.config["files"]["plotting_hdf_fname"]):
+                    self.stop_animation()
+                    logging.warning("Plot error: Run not found in the HDF file:" + self.config["run"])
+                    return False
             except OSError:
                     logging.warning("Plot error: Not a valid HDF file.")
                     logging.warning(traceback.format_exc())
@@ -3810,7 +6482,7 @@ class Plotter(qt.QWidget):
                     return False
 
             # check dataset exists in the run
-            with h5py.File(self.parent.config["files"]["plotting_hdf_fname"], 'r') as f:
+            with open_HDF_reader(self.parent, self.run_fname()) as f:
                 try:
                     grp = f[self.config["run"] + "/" + self.dev.config["hdf_group"]]
                 except KeyError:
@@ -3833,27 +6505,46 @@ class Plotter(qt.QWidget):
         # return
         return True
 
+    def run_fname(self):
+        # the latest file of the selected run
+        return hdf_run_files(self.parent.config["files"]["plotting_hdf_fname"], self.config["run"])[-1]
+
     def get_raw_data_from_HDF(self):
         if not self.dev.config["control_params"]["HDF_enabled"]["value"]:
             logging.warning("Plot error: cannot plot from HDF when HDF is disabled")
             self.toggle_HDF_or_queue()
             return
 
-        with h5py.File(self.parent.config["files"]["plotting_hdf_fname"], 'r') as f:
-            grp = f[self.config["run"] + "/" + self.dev.config["hdf_group"]]
+        # slow data of a run that continued in new files (see HDF_writer.check_rollover())
+        # is read from all of them, fast data only from the latest
+        run_files = hdf_run_files(self.parent.config["files"]["plotting_hdf_fname"], self.config["run"])
 
-            if self.dev.config["slow_data"]:
-                dset = grp[self.dev.config["name"]]
-                x = dset[self.config["x"]]
-                y = dset[self.config["y"]]
+        if self.dev.config["slow_data"]:
+            x, y = [], []
+            for fname in run_files:
+                with open_HDF_reader(self.parent, fname) as f:
+                    dset = f[self.config["run"] + "/" + self.dev.config["hdf_group"] + "/" + self.dev.config["name"]]
+                    x.append(dset[self.config["x"]])
+                    y.append(dset[self.config["y"]])
+
+                    # divide y by z (if applicable)
+                    if self.config["z"] in self.param_list:
+                        y[-1] /= dset[self.config["z"]]
+            return np.concatenate(x), np.concatenate(y)
 
-                # divide y by z (if applicable)
-                if self.config["z"] in self.param_list:
-                    y /= dset[self.config["z"]]
+        with open_HDF_reader(self.parent, run_files[-1]) as f:
+            grp = f[self.config["run"] + "/" + self.dev.config["hdf_group"]]
+
+            # fast data in the consolidated layout: one dataset with all records
+            if not self.dev.config["slow_data"] and isinstance(grp.get(self.dev.config["name"]), h5py.Dataset):
+                return self.get_consolidated_data_from_HDF(grp[self.dev.config["name"]])
 
             if not self.dev.config["slow_data"]:
                 # find the latest record
-                rec_num = len(grp) - 1
+                if self.dev.config["name"] + "_attrs" in grp:
+                    rec_num = next_record_number(grp, self.dev.config["name"]) - 1
+                else:
+                    rec_num = len(grp) - 1
 
                 # get the latest curve
                 try:
@@ -3901,10 +6592,43 @@ class Plotter(qt.QWidget):
 
         return x, y
 
+    def get_consolidated_data_from_HDF(self, dset):
+        # dset has shape (# of records, # of channels, # of samples)
+        if dset.shape[0] == 0:
+            return None
+
+        if self.config["y"] == "(none)":
+            logging.warning("Plot error: y not valid.")
+            logging.warning("Plot warning: bad parameters")
+            return None
+
+        # average sanity check
+        n_average = max(self.config["n_average"], 1)
+        if n_average > dset.shape[0]:
+            logging.warning("Plot error: Cannot average more traces than exist.")
+            n_average = dset.shape[0]
+
+        # read only the latest n_average records of the selected channels
+        y = dset[-n_average:, self.param_list.index(self.config["y"]), :].astype(float)
+
+        # divide y by z (if applicable)
+        if self.config["z"] in self.param_list and self.config["z"] != "(none)":
+            y = y / dset[-n_average:, self.param_list.index(self.config["z"]), :]
+
+        # average last n curves (if applicable)
+        y = np.mean(y, axis=0)
+
+        if self.config['x'] == "(none)":
+            x = np.arange(len(y))
+        else:
+            x = dset[-1, self.param_list.index(self.config["x"]), :].astype(float)
+
+        return x, y
+
     def get_raw_data_from_queue(self):
         # for slow data: copy the queue contents into a np array
         if self.dev.config["slow_data"]:
-            dset = np.array(self.dev.config["plots_queue"])
+            dset = np.array(self.dev.data_queue.latest(self.dev.config["plots_queue_maxlen"]))
             if len(dset.shape) < 2:
                 return None
             x = dset[:, self.param_list.index(self.config["x"])]
@@ -3917,7 +6641,7 @@ class Plotter(qt.QWidget):
         # for fast data: return only the latest value
         if not self.dev.config["slow_data"]:
             try:
-                dset = self.dev.config["plots_queue"][-1]
+                dset = self.dev.data_queue.latest(1)[-1]
             except IndexError:
                 logging.info(traceback.format_exc())
                 return None
@@ -3949,9 +6673,10 @@ class Plotter(qt.QWidget):
 
             # average last n curves (if applicable)
             y_avg = np.array(y).astype(float)
+            recent = self.dev.data_queue.latest(self.config["n_average"])
             for i in range(self.config["n_average"] - 1):
                 try:
-                    dset = self.dev.config["plots_queue"][-(i+1)]
+                    dset = recent[-(i+1)]
                 except (KeyError,IndexError) as err:
                     logging.warning("Plot averaging error: " + str(err))
                     logging.warning(traceback.format_exc())
@@ -4241,6 +6966,11 @@ class CentrexGUI(qt.QMainWindow):
         # set debug level
         logging.getLogger().setLevel(self.config["general"]["logging_level"])
 
+        # HDF file handle kept open by HDF_writer while control is running,
+        # shared with Plotter (see open_HDF_reader())
+        self.hdf_file = None
+        self.hdf_file_lock = threading.RLock()
+
         # GUI elements
         self.ControlGUI = ControlGUI(self)
         self.PlotsGUI = PlotsGUI(self)
@@ -4304,4 +7034,5 @@ if __name__ == '__main__':
     main_window = CentrexGUI(app)
     app.exec_()
     main_window.ControlGUI.stop_control()
+    main_window.ControlGUI.close_connections()
     sys.exit(0)
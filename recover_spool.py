@@ -0,0 +1,22 @@
+import sys
+import logging
+import argparse
+
+from main import recover_spools
+
+# Rebuild HDF data from the spool files left behind when the program stopped without
+# merging them (see hdf_spool in the program config).
+# Usage: python recover_spool.py <spool directory> [--hdf <HDF file>] [--from-start]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write the records of leftover spool files to HDF.")
+    parser.add_argument("spool_dir", help="directory with the .spool files")
+    parser.add_argument("--hdf", default=None,
+            help="write all records to this HDF file instead of the file the spool files were written for")
+    parser.add_argument("--from-start", action="store_true",
+            help="also write the records that were already merged")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    recover_spools(args.spool_dir, args.hdf, args.from_start)
+    sys.exit(0)
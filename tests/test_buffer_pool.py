@@ -0,0 +1,53 @@
+import os
+import sys
+import numpy as np
+
+# make main.py importable, and device drivers findable
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.chdir(REPO_DIR)
+from main import DataQueue
+from drivers.buffer_pool import BufferPool
+
+# BufferPool with DataQueue: a buffer is reused only once it has been written and is no
+# longer among the latest records kept for the plots; buffers that are dropped, or held
+# elsewhere, are never handed out again while in use.
+
+def read_value(pool, i):
+    data = pool.borrow()
+    data[:] = i
+    return [data, [{}]]
+
+def test_reuse_after_write():
+    pool = BufferPool((1, 2, 4), np.float64)
+    queue = DataQueue(100, keep=2, on_release=lambda data: pool.release(data[0]))
+    taken = []
+    for i in range(50):
+        queue.put(read_value(pool, i))
+        if i % 5 == 4:
+            # what was taken by the last get() is still intact when the next one is made
+            assert all(np.all(data[0] == j) for j, data in taken)
+            taken = [(int(data[0].flat[0]), data) for data in queue.get()]
+        assert [int(data[0].flat[0]) for data in queue.latest(2)] == list(range(max(i-1, 0), i+1))
+    assert pool.allocated <= 12
+
+def test_dropped_records_not_reused_while_taken():
+    pool = BufferPool((1, 2, 4), np.float64)
+    queue = DataQueue(4, policy="drop-oldest", keep=1, on_release=lambda data: pool.release(data[0]))
+    for i in range(4):
+        queue.put(read_value(pool, i))
+    taken = queue.get()
+    # the writer is slow: the next records overwrite its slots
+    for i in range(4, 12):
+        queue.put(read_value(pool, i))
+    assert [int(data[0].flat[0]) for data in taken] == [0, 1, 2, 3]
+
+def test_release_ignores_foreign_arrays():
+    pool = BufferPool((2,), np.float64)
+    pool.release(np.zeros(2))
+    buf = pool.borrow()
+    pool.release(buf)
+    pool.release(buf)
+    assert pool.borrow() is buf
+    assert pool.borrow() is not buf
+    assert pool.allocated == 2
@@ -0,0 +1,59 @@
+import os
+import sys
+import queue
+import h5py
+import numpy as np
+
+# make main.py importable, and device drivers findable
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.chdir(REPO_DIR)
+from main import HDF_writer_process, SharedRingBuffer, create_events_datasets
+
+# HDF_writer_process.write_rings_to_HDF_InfluxDB(): records from the rings and events
+# from the events queue are written to the run group, and events of devices the process
+# has no datasets for are skipped instead of stopping the process.
+
+SLOW_DTYPE = np.dtype([("time", "f8"), ("value", "f8")])
+
+def writer_process(ring):
+    spec = {
+            "run_name"    : "run",
+            "time_offset" : 0.0,
+            "devices"     : {
+                "slow" : {
+                    "hdf_group"        : "slow",
+                    "slow_data"        : True,
+                    "hdf_layout"       : "records",
+                    "dset_dtype"       : SLOW_DTYPE,
+                    "col_names"        : ["time", "value"],
+                    "HDF_enabled"      : True,
+                    "InfluxDB_enabled" : False,
+                    "ring"             : ring.spec(),
+                },
+            },
+        }
+    process = HDF_writer_process(spec)
+    # read in this process, so a plain queue will do
+    process.events_queue = queue.Queue()
+    return process
+
+def test_events_of_unknown_device(tmp_path):
+    ring = SharedRingBuffer(SLOW_DTYPE, capacity=16)
+    try:
+        process = writer_process(ring)
+        with h5py.File(tmp_path / "data.hdf", "w", libver="latest") as f:
+            grp = f.create_group("run/slow")
+            grp.create_dataset("slow", (0,), maxshape=(None,), dtype=SLOW_DTYPE)
+            create_events_datasets(grp, "slow")
+
+            ring.put(np.array([(1.0, 2.0), (2.0, 4.0)], dtype=SLOW_DTYPE))
+            process.events_queue.put(("cmd_only_dev", [[1.0, "set(1)", None]]))
+            process.events_queue.put(("slow", [[1.5, "get()", 3]]))
+            assert process.write_rings_to_HDF_InfluxDB(f, {"slow": ring}, None) == 2
+
+            assert list(grp["slow"]["value"]) == [2.0, 4.0]
+            assert grp["slow_events"].shape == (1,)
+            assert "cmd_only_dev" in process.unknown_devices
+    finally:
+        ring.close()
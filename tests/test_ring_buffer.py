@@ -0,0 +1,72 @@
+import os
+import sys
+import multiprocessing
+import numpy as np
+
+# make main.py importable, and device drivers findable
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.chdir(REPO_DIR)
+from main import SharedRingBuffer
+
+# SharedRingBuffer: records come out in order, also when they wrap around the end of the
+# buffer, records that don't fit are dropped and counted, and another process can attach
+# to the buffer by name.
+
+DTYPE = np.dtype([("time", "f8"), ("data", "f8", (2, 3))])
+
+def rows(start, n):
+    rows = np.zeros(n, dtype=DTYPE)
+    rows["time"] = np.arange(start, start+n)
+    rows["data"] = np.arange(start, start+n)[:, None, None]
+    return rows
+
+def test_put_get_wraps_around():
+    ring = SharedRingBuffer(DTYPE, capacity=8)
+    try:
+        assert ring.put(rows(0, 6)) == 6
+        assert list(ring.get()["time"]) == [0, 1, 2, 3, 4, 5]
+
+        # the next records wrap around the end of the buffer
+        assert ring.put(rows(6, 5)) == 5
+        assert len(ring) == 5
+        got = ring.get()
+        assert list(got["time"]) == [6, 7, 8, 9, 10]
+        assert np.all(got["data"][:, 1, 2] == got["time"])
+        assert len(ring) == 0 and len(ring.get()) == 0
+    finally:
+        ring.close()
+
+def test_full_buffer_drops_newest():
+    ring = SharedRingBuffer(DTYPE, capacity=4)
+    try:
+        assert ring.put(rows(0, 3)) == 3
+        assert ring.put(rows(3, 3)) == 1
+        assert ring.dropped() == 2
+        assert list(ring.get()["time"]) == [0, 1, 2, 3]
+    finally:
+        ring.close()
+
+def consume(spec, n, results):
+    ring = SharedRingBuffer(**spec)
+    got = []
+    while len(got) < n:
+        got += list(ring.get()["time"])
+    results.put(got)
+    ring.close()
+
+def test_other_process():
+    ring = SharedRingBuffer(DTYPE, capacity=16)
+    try:
+        ctx = multiprocessing.get_context("spawn")
+        results = ctx.Queue()
+        consumer = ctx.Process(target=consume, args=(ring.spec(), 100, results))
+        consumer.start()
+        i = 0
+        while i < 100:
+            i += ring.put(rows(i, min(10, 100-i)))
+        assert results.get(timeout=30) == list(range(100))
+        consumer.join(timeout=30)
+        assert consumer.exitcode == 0
+    finally:
+        ring.close()
@@ -0,0 +1,45 @@
+import os
+import sys
+import threading
+import h5py
+
+# make main.py importable, and device drivers findable
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.chdir(REPO_DIR)
+from main import RunIndex, hdf_runs, hdf_run_files
+
+# RunIndex: a new index lists the runs already in the HDF file once, a run is listed once
+# per file it was written to, and browsing a file doesn't create an index next to it.
+
+class Parent:
+    # the parts of CentrexGUI that open_HDF_reader() uses, with no run in progress
+    def __init__(self):
+        self.hdf_file_lock = threading.RLock()
+        self.hdf_file = None
+
+def test_new_index(tmp_path):
+    fname = str(tmp_path / "data.hdf")
+    with h5py.File(fname, "w") as f:
+        f.create_group("old run")
+
+    # as HDF_writer does: open the index, create the run group, then add the run
+    index = RunIndex(fname)
+    index.open()
+    with h5py.File(fname, "a") as f:
+        f.create_group("new run")
+    index.add("new run", fname, 1.0)
+    index.add("new run", fname, 1.0)
+    index.close()
+
+    assert hdf_runs(Parent(), fname) == ["old run", "new run"]
+    assert hdf_run_files(fname, "new run") == [os.path.normpath(fname)]
+
+def test_browsing_leaves_no_index(tmp_path):
+    fname = str(tmp_path / "data.hdf")
+    with h5py.File(fname, "w") as f:
+        f.create_group("run")
+
+    assert hdf_runs(Parent(), fname) == ["run"]
+    assert hdf_run_files(fname, "run") == [fname]
+    assert os.listdir(tmp_path) == ["data.hdf"]
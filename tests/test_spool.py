@@ -0,0 +1,147 @@
+import os
+import sys
+import h5py
+import numpy as np
+
+# make main.py importable, and device drivers findable
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.chdir(REPO_DIR)
+from main import SpoolFile, recover_spools
+
+# SpoolFile and recover_spools(): records are read back up to the first incomplete or
+# corrupted one, and recovery writes what wasn't merged into HDF.
+
+FAST_DTYPE = np.dtype([("time", "f8"), ("attrs", "S2048"), ("n_samp", "i4"), ("data", "f8", (2, 5))])
+
+def spool_meta(tmp_path, **kwargs):
+    meta = {
+            "hdf_fname"   : str(tmp_path / "data.hdf"),
+            "hdf_index"   : "",
+            "run_name"    : "run",
+            "time_offset" : 0.0,
+            "dev_name"    : "fast",
+            "hdf_group"   : "fast",
+            "slow_data"   : False,
+            "hdf_layout"  : "consolidated",
+            "dset_dtype"  : "f8",
+            "dtype"       : FAST_DTYPE,
+            "attributes"  : {"column_names": "a, b"},
+        }
+    meta.update(kwargs)
+    return meta
+
+def fast_rows(n, n_samp=5, start=0):
+    rows = np.zeros(n, dtype=FAST_DTYPE)
+    rows["time"] = np.arange(start, start+n)
+    rows["attrs"] = b"{}"
+    rows["n_samp"] = n_samp
+    rows["data"][:, :, :n_samp] = np.arange(start, start+n)[:, None, None]
+    return rows
+
+def test_read_back(tmp_path):
+    spool = SpoolFile(str(tmp_path / "fast.spool"), spool_meta(tmp_path))
+    spool.append_rows(fast_rows(3))
+    spool.append_events([[1.0, "set(1)", None]])
+    spool.close()
+
+    records = list(SpoolFile(spool.fname).read())
+    assert [kind for kind, obj, offset in records] == [SpoolFile.DATA, SpoolFile.EVENTS]
+    assert list(records[0][1]["time"]) == [0, 1, 2]
+    assert records[1][1] == [[1.0, "set(1)", None]]
+    assert records[-1][2] == os.path.getsize(spool.fname)
+
+def test_read_stops_at_corrupted_record(tmp_path):
+    spool = SpoolFile(str(tmp_path / "fast.spool"), spool_meta(tmp_path))
+    spool.append_rows(fast_rows(3))
+    spool.sync()
+    size = os.path.getsize(spool.fname)
+    spool.append_rows(fast_rows(3, start=3))
+    spool.close()
+
+    # flip a byte of the payload of the second record: the CRC doesn't match anymore
+    with open(spool.fname, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xFF]))
+
+    records = list(SpoolFile(spool.fname).read())
+    assert len(records) == 1
+    assert records[0][2] == size
+
+def test_read_stops_at_incomplete_record(tmp_path):
+    spool = SpoolFile(str(tmp_path / "fast.spool"), spool_meta(tmp_path))
+    spool.append_rows(fast_rows(3))
+    spool.close()
+    with open(spool.fname, "ab") as f:
+        f.write(SpoolFile.RECORD_MAGIC + b"\x00\x01")
+
+    assert len(list(SpoolFile(spool.fname).read())) == 1
+
+def test_recover_unmerged_records(tmp_path):
+    spool_dir = tmp_path / "spool"
+    spool_dir.mkdir()
+    spool = SpoolFile(str(spool_dir / "run fast.spool"), spool_meta(tmp_path))
+    spool.append_rows(fast_rows(2, n_samp=3))
+    spool.sync()
+    merged = os.path.getsize(spool.fname)
+    spool.append_rows(fast_rows(2, n_samp=5, start=2))
+    spool.append_events([[2.0, "get()", 7]])
+    spool.close()
+
+    # the first record was merged before the crash
+    spool.set_merged_offset(merged)
+    recover_spools(str(spool_dir))
+    with h5py.File(tmp_path / "data.hdf", "r") as f:
+        dset = f["run/fast/fast"]
+        assert dset.shape == (2, 2, 5)
+        assert np.all(dset[:, 0, 0] == [2, 3])
+        assert list(f["run/fast/fast_index"]["time"]) == [2, 3]
+        assert f["run/fast/fast_events"].shape == (1,)
+
+    # all records, into another file
+    recover_spools(str(spool_dir), str(tmp_path / "new.hdf"))
+    with h5py.File(tmp_path / "new.hdf", "r") as f:
+        dset = f["run/fast/fast"]
+        assert dset.shape == (4, 2, 5)
+        # the first records had 3 samples, the rest of them is left unwritten (NaN)
+        assert np.all(dset[0:2, 0, 0:3] == [[0, 0, 0], [1, 1, 1]])
+        assert np.all(np.isnan(dset[0:2, :, 3:]))
+        assert np.all(dset[2:4, 0, :] == [[2]*5, [3]*5])
+
+def test_recovered_datasets_match_the_writer(tmp_path):
+    spool_dir = tmp_path / "spool"
+    spool_dir.mkdir()
+    consolidated = {"dtype": "<f8", "n_ch": 2, "n_samp": 5, "attributes": {"column_names": "a, b"},
+                    "hdf_chunk_shape": ["8"], "hdf_compression": "gzip", "hdf_compression_opts": 4}
+    index = str(tmp_path / "data_index.sqlite")
+    spool = SpoolFile(str(spool_dir / "run fast.spool"),
+                      spool_meta(tmp_path, consolidated=consolidated, hdf_index=str(tmp_path / "data.hdf")))
+    spool.append_rows(fast_rows(2))
+    spool.close()
+
+    recover_spools(str(spool_dir))
+    with h5py.File(tmp_path / "data.hdf", "r") as f:
+        dset = f["run/fast/fast"]
+        assert dset.compression == "gzip"
+        assert dset.chunks == (8, 2, 5)
+        assert np.isnan(dset.fillvalue)
+    # the run index is only read
+    assert not os.path.exists(index)
+
+def test_recovered_records_numbering(tmp_path):
+    spool_dir = tmp_path / "spool"
+    spool_dir.mkdir()
+    spool = SpoolFile(str(spool_dir / "run fast.spool"),
+                      spool_meta(tmp_path, hdf_layout="records", dset_dtype=np.dtype([("a", "f8"), ("b", "f8")])))
+    spool.append_rows(fast_rows(2))
+    spool.append_rows(fast_rows(1, start=2))
+    spool.close()
+
+    # the first record follows <dev_name>_events, as it always has
+    recover_spools(str(spool_dir))
+    with h5py.File(tmp_path / "data.hdf", "r") as f:
+        names = [name for name in f["run/fast"] if not name.endswith(("events", "strings", "attrs"))]
+        assert names == ["fast_000001", "fast_000002", "fast_000003"]
+        assert list(f["run/fast/fast_000003"]["a"]) == [2]*5